@@ -0,0 +1,235 @@
+"""
+Micro benchmarks of everything that turns packets and messages into bytes and back.
+Covers building, encoding and decoding every kind of packet with every codec, message logs of 100, 1000 and 10000
+messages as strings and as columns, and turning messages from strings and database rows into Message instances.
+Results can be saved as JSON, and compared against earlier results to catch regressions:
+    python -m benchmarks.codecs --save before.json
+    python -m benchmarks.codecs --compare before.json [--threshold 0.1]
+Comparing exits with 1 if anything got slower by more than the threshold.
+Run from the repository root, add --filter to only run benchmarks with a name containing it.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+from benchmarks.wire_bytes import WORDS, USERS
+from packet import *
+from message import Message, User
+from session import ServerSession
+
+LOG_SIZES = (100, 1000, 10000)
+
+
+def make_messages(count, seed=0):
+    """
+    Makes count messages of typical length, from a handful of users.
+    :param count:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    return [
+        Message(
+            message_id,
+            User(rng.choice(USERS)),
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15))),
+            now + message_id,
+            "general",
+        )
+        for message_id in range(1, count + 1)
+    ]
+
+
+def packet_builders():
+    """
+    Returns every packet builder in packet.py, named, with typical arguments.
+    :return:
+    """
+    messages = make_messages(20)
+    return {
+        "server_info_request": lambda: server_info_request(),
+        "server_info": lambda: server_info("Messenger Server", 200, 20, True, 200, SUPPORTED_FEATURES, CODEC_BINARY),
+        "login_message": lambda: login_message("alice", "hunter2"),
+        "log_message": lambda: log_message(messages[0].message, "general"),
+        "error_message": lambda: error_message("Too many requests, slow down.", 1.5),
+        "success_message": lambda: success_message(),
+        "message_log_addition": lambda: message_log_addition(messages[0]),
+        "message_log_addition/columnar": lambda: message_log_addition(messages[0], columnar=True),
+        "message_log_batch": lambda: message_log_batch(messages[:5]),
+        "message_log_set": lambda: message_log_set(messages, "general"),
+        "message_log_set/columnar": lambda: message_log_set(messages, "general", columnar=True),
+        "message_log_since_request": lambda: message_log_since_request(1000, "general"),
+        "message_log_since": lambda: message_log_since(messages[:5], "general"),
+        "message_log_page_request": lambda: message_log_page_request(1000, 20, "general"),
+        "message_log_page": lambda: message_log_page(messages, 1000, True, "general"),
+        "logout_message": lambda: logout_message(),
+        "message_log_set_request": lambda: message_log_set_request("general"),
+        "create_user": lambda: create_user("alice", "hunter2"),
+        "resync": lambda: resync(),
+        "join_room": lambda: join_room("general"),
+        "leave_room": lambda: leave_room("general"),
+    }
+
+
+def codecs():
+    """
+    Returns a factory for every codec, and compression mode of it, by name.
+    :return:
+    """
+    return {
+        CODEC_JSON: lambda: create_codec(CODEC_JSON),
+        CODEC_BINARY: lambda: create_codec(CODEC_BINARY),
+        "binary_stream": lambda: create_codec(CODEC_BINARY, (FEATURE_ZLIB_STREAM, FEATURE_ZLIB_DICTIONARY)),
+    }
+
+
+def benchmarks():
+    """
+    Returns every benchmark, by name, as a function to time.
+    :return:
+    """
+    cases = {}
+
+    for name, build in packet_builders().items():
+        cases[f"build/{name}"] = build
+
+    packets = {name: build() for name, build in packet_builders().items()}
+    for log_size in LOG_SIZES:
+        packets[f"message_log_set/{log_size}"] = message_log_set(make_messages(log_size), "general")
+        packets[f"message_log_set/{log_size}/columnar"] = message_log_set(make_messages(log_size), "general", True)
+
+    for codec_name, make_codec in codecs().items():
+        for name, packet in packets.items():
+            if codec_name == "binary_stream":
+                # Stream codecs depend on everything sent before, so both ends are timed together.
+                sender, receiver = make_codec(), make_codec()
+                cases[f"round_trip/{codec_name}/{name}"] = (
+                    lambda sender=sender, receiver=receiver, packet=packet: receiver.decode(sender.encode(packet))
+                )
+                continue
+            codec = make_codec()
+            encoded_packet = codec.encode(packet)
+            cases[f"encode/{codec_name}/{name}"] = lambda codec=codec, packet=packet: codec.encode(packet)
+            cases[f"decode/{codec_name}/{name}"] = lambda codec=codec, data=encoded_packet: codec.decode(data)
+
+    for log_size in LOG_SIZES:
+        messages = make_messages(log_size)
+        encoded_log = JsonPacket.encode_message_log(messages)
+        cases[f"encode_message_log/{log_size}"] = lambda messages=messages: JsonPacket.encode_message_log(messages)
+        cases[f"decode_message_log/{log_size}"] = lambda string=encoded_log: JsonPacket.decode_message_log(string)
+        columns = JsonPacket.encode_message_columns(messages)
+        cases[f"encode_message_columns/{log_size}"] = (
+            lambda messages=messages: JsonPacket.encode_message_columns(messages)
+        )
+        cases[f"decode_message_columns/{log_size}"] = (
+            lambda columns=columns: JsonPacket.decode_message_columns(columns)
+        )
+        # Everything a client does with a whole log, from the bytes it receives to a list of messages.
+        for codec_name in (CODEC_JSON, CODEC_BINARY):
+            codec = create_codec(codec_name)
+            for layout, columnar in (("strings", False), ("columnar", True)):
+                data = codec.encode(message_log_set(messages, "general", columnar))
+                cases[f"receive_log/{codec_name}/{layout}/{log_size}"] = (
+                    lambda codec=codec, data=data: codec.decode(data).get_messages()
+                )
+
+    message = make_messages(1)[0]
+    row = (message.id, message.message, message.timestamp, message.sender.name, message.room)
+    cases["message/str"] = lambda: str(message)
+    cases["message/from_string"] = lambda string=str(message): Message.from_string(string)
+    cases["message/from_database_to_message_instance"] = lambda: ServerSession.from_database_to_message_instance(row)
+    return cases
+
+
+def measure(function, repeat):
+    """
+    Times a function, returning the fastest time one call of it took over repeat rounds, in seconds.
+    Every round runs it enough times to take around a fifth of a second.
+    :param function:
+    :param repeat:
+    :return:
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(name_filter, repeat):
+    """
+    Runs every benchmark whose name contains name_filter, printing each result as it goes.
+    Returns the results, as benchmark names to seconds per call.
+    :param name_filter:
+    :param repeat:
+    :return:
+    """
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        for name, function in benchmarks().items():
+            if name_filter and name_filter not in name:
+                continue
+            # Some of the code being measured prints, that goes nowhere instead of into the results.
+            with contextlib.redirect_stdout(devnull):
+                seconds = measure(function, repeat)
+            results[name] = seconds
+            print(f"{name:<60}{seconds * 1e6:>14.2f} us")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how every result compares to the same benchmark in baseline.
+    Returns the names of the ones that got slower by more than threshold.
+    :param results:
+    :param baseline:
+    :param threshold: Fraction, 0.1 allows 10% slower.
+    :return:
+    """
+    regressions = []
+    print()
+    print(f"{'benchmark':<60}{'before us':>14}{'after us':>14}{'change':>10}")
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        change = seconds / baseline[name] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  slower"
+        print(f"{name:<60}{baseline[name] * 1e6:>14.2f}{seconds * 1e6:>14.2f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks encoding and decoding packets and messages.")
+    parser.add_argument("--filter", default="", help="Only run benchmarks with a name containing this.")
+    parser.add_argument("--repeat", type=int, default=5, help="Rounds to time every benchmark over.")
+    parser.add_argument("--save", default=None, help="File to save the results to, as JSON.")
+    parser.add_argument("--compare", default=None, help="Results saved earlier to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="How much slower counts as a regression.")
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat)
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump(
+                {"python": platform.python_version(), "machine": platform.machine(), "seconds_per_call": results},
+                save_file,
+                indent=4,
+            )
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["seconds_per_call"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks got slower by more than {args.threshold:.0%}.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
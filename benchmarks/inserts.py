@@ -0,0 +1,80 @@
+"""
+Measures how many messages per second ServerSession can log, with and without write behind.
+Run from the repository root:
+    python -m benchmarks.inserts [--messages N]
+
+Measured with the defaults (2000 messages, the repository's config.toml otherwise), on one core of a virtual
+Intel Xeon with an ext4 disk, Python 3.11 and SQLite 3.40, best of three runs:
+    commit per message, synchronous=FULL      ~3,900 messages/sec
+    commit per message, synchronous=NORMAL    ~9,300 messages/sec
+    write behind, synchronous=FULL           ~92,000 messages/sec
+    write behind, synchronous=NORMAL         ~85,000 messages/sec
+Runs vary by about a third from one to the next, write behind at FULL and NORMAL is within that noise.
+"""
+import argparse
+import os
+import tempfile
+import time
+import toml
+from twisted.internet import defer, task
+from twisted.internet.task import Clock
+from constants import CONFIG_FILE
+from session import ServerSession
+
+
+def make_config(folder, **database_settings):
+    """
+    Writes a copy of the config file that keeps its data in folder, with some database settings changed.
+    Returns the path to it.
+    :param folder:
+    :param database_settings:
+    :return:
+    """
+    config = toml.load(CONFIG_FILE)
+    config['structure']['data_folder'] = folder
+    config['session']['database'].update(database_settings)
+    path = os.path.join(folder, "config.toml")
+    with open(path, "w") as config_file:
+        toml.dump(config, config_file)
+    return path
+
+
+@defer.inlineCallbacks
+def messages_per_second(message_count, **database_settings):
+    """
+    Logs message_count messages into a fresh database, firing with how many were logged per second.
+    Time spent waiting for every write to finish at the end is included.
+    Needs a running reactor, as the writes happen in the session's database threads.
+    :param message_count:
+    :param database_settings:
+    :return:
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        # A clock that never advances, so write behind only flushes when enough rows are queued, or at the end.
+        session = ServerSession(make_config(folder, **database_settings), clock=Clock())
+        start = time.perf_counter()
+        logged = [session.log_message_from_server(f"Benchmark message number {i}.") for i in range(message_count)]
+        yield defer.gatherResults(logged)
+        yield session.close()
+        return message_count / (time.perf_counter() - start)
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description="Benchmarks logging messages into the database.")
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    modes = [
+        ("commit per message, synchronous=FULL", {"write_behind": False, "synchronous": "FULL"}),
+        ("commit per message, synchronous=NORMAL", {"write_behind": False, "synchronous": "NORMAL"}),
+        ("write behind, synchronous=FULL", {"write_behind": True, "synchronous": "FULL"}),
+        ("write behind, synchronous=NORMAL", {"write_behind": True, "synchronous": "NORMAL"}),
+    ]
+    for name, settings in modes:
+        rate = yield messages_per_second(args.messages, **settings)
+        print(f"{name:<42}{rate:>12.0f} messages/sec")
+
+
+if __name__ == "__main__":
+    task.react(main)
@@ -0,0 +1,327 @@
+"""
+Load test: runs a real server on localhost and has many simulated clients chat with it at a steady rate.
+Every client creates its account, logs in, joins a room with a few others and sends messages at --rate per second.
+Latency is measured from sending a LOG_MESSAGE to its own message coming back in a MESSAGE_LOG_ADDITION (or batch).
+Prints a JSON report with latency percentiles, throughput and the server's memory use.
+Run from the repository root:
+    python -m benchmarks.load [--clients 1000] [--rate 1] [--duration 30] [--room-size 20] [--workers 1]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.workers import SERVER, PORT, write_config, wait_for_port
+
+RSS_SAMPLE_INTERVAL = 0.5  # Seconds between measurements of the server's memory.
+DRAIN_TIMEOUT = 10.0  # Seconds clients wait for their last messages to come back before giving up on them.
+
+
+def raise_file_limit():
+    """
+    Allows this process, and the ones it starts, as many open files as the system lets it.
+    Every client connection is one on both ends.
+    :return:
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def process_tree_rss(pid):
+    """
+    Gets the resident memory of a process and all its children in bytes, None if it can't be read.
+    Only works where there is a /proc, like on Linux.
+    :param pid:
+    :return:
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            rss = next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmRSS:"))
+        children = []
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as task_children:
+                children += [int(child) for child in task_children.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(process_tree_rss(child) or 0 for child in children)
+
+
+def percentile(ordered, fraction):
+    """
+    Gets the nearest rank percentile of an already sorted list.
+    :param ordered:
+    :param fraction: Between 0 and 1.
+    :return:
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def run_clients(names, rooms, rate, duration, results):
+    """
+    Runs in a process of its own. Connects a client for every name, in the room of the same index,
+    and has each chat at rate messages per second for duration seconds.
+    Puts a dict with what they measured on results once they are all done.
+    :param names:
+    :param rooms:
+    :param rate:
+    :param duration:
+    :param results:
+    :return:
+    """
+    import random
+    from twisted.internet import reactor
+    from twisted.internet.protocol import Protocol, ClientFactory
+    from twisted.internet.task import LoopingCall
+    from packet import (
+        PacketType, PacketBuffer, CODEC_JSON, FEATURE_FRAMING, FRAME_HEADER, create_codec, server_info_request,
+        create_user, login_message, join_room, leave_room, log_message
+    )
+
+    stats = {
+        "latencies": [],
+        "sent": 0,
+        "errors": 0,
+        "resyncs": 0,
+        "lost": 0,  # Messages that never came back.
+        "disconnects": 0,  # Clients the server hung up on.
+        "first_sent": None,
+        "last_received": None,
+    }
+    finished = []
+
+    class LoadClient(Protocol):
+        def __init__(self, name, room):
+            self.name = name
+            self.room = room
+            self.packet_buffer = PacketBuffer()
+            self.codec = create_codec(CODEC_JSON)
+            self.setup = []  # Requests still to make before chatting, one at a time.
+            self.chatting = False
+            self.done = False
+            self.sequence = 0
+            self.in_flight = {}  # Contents of sent messages to when they were sent.
+            self.chat_loop = LoopingCall(self.send_message)
+
+        def connectionMade(self):
+            self.send(server_info_request())
+
+        def send(self, packet):
+            encoded_packet = self.codec.encode(packet)
+            if self.packet_buffer.framed:
+                self.transport.writeSequence((FRAME_HEADER.pack(len(encoded_packet)), encoded_packet))
+            else:
+                self.transport.write(encoded_packet)
+
+        def dataReceived(self, data):
+            for encoded_packet in self.packet_buffer.feed(data):
+                self.handle_packet(self.codec.decode(encoded_packet))
+
+        def handle_packet(self, packet):
+            if packet.type == PacketType.MESSAGE_LOG_ADDITION:
+                self.message_received(packet.get_message())
+            elif packet.type == PacketType.MESSAGE_LOG_BATCH:
+                for message in packet.get_messages():
+                    self.message_received(message)
+            elif packet.type == PacketType.RESYNC:
+                stats["resyncs"] += 1
+            elif packet.type == PacketType.SERVER_INFO:
+                features = packet.features or []
+                self.packet_buffer.framed = FEATURE_FRAMING in features
+                self.codec = create_codec(packet.codec or CODEC_JSON, features)
+                default_room = packet.default_room or "general"
+                self.setup = [leave_room(default_room), join_room(self.room), login_message(self.name, "load")]
+                # The account might be left over from an earlier run, that error is fine.
+                self.send(create_user(self.name, "load"))
+            elif packet.type in (PacketType.SUCCESS, PacketType.ERROR):
+                if self.chatting:
+                    if packet.type == PacketType.ERROR:
+                        stats["errors"] += 1
+                elif self.setup:
+                    self.send(self.setup.pop())
+                else:
+                    self.start_chatting()
+
+        def start_chatting(self):
+            self.chatting = True
+            # Spread out when clients send, so they don't all send in the same instant.
+            reactor.callLater(random.uniform(0, 1 / rate), self.chat_loop.start, 1 / rate)
+            reactor.callLater(duration, self.stop_chatting)
+
+        def send_message(self):
+            self.sequence += 1
+            content = f"load {self.sequence}"
+            now = time.perf_counter()
+            self.in_flight[content] = now
+            if stats["first_sent"] is None:
+                stats["first_sent"] = time.time()
+            stats["sent"] += 1
+            self.send(log_message(content, self.room))
+
+        def message_received(self, message):
+            if message.sender.name != self.name:
+                return
+            sent_at = self.in_flight.pop(message.message, None)
+            if sent_at is not None:
+                stats["latencies"].append(time.perf_counter() - sent_at)
+                stats["last_received"] = time.time()
+                if not self.chat_loop.running and not self.in_flight:
+                    self.finish()
+
+        def stop_chatting(self):
+            if self.chat_loop.running:
+                self.chat_loop.stop()
+            if self.in_flight:
+                reactor.callLater(DRAIN_TIMEOUT, self.finish)
+            else:
+                self.finish()
+
+        def finish(self):
+            if self.done:
+                return
+            self.done = True
+            stats["lost"] += len(self.in_flight)
+            self.transport.loseConnection()
+            finished.append(self.name)
+            if len(finished) == len(names):
+                reactor.stop()
+
+        def connectionLost(self, reason):
+            if self.chat_loop.running:
+                self.chat_loop.stop()
+            if not self.done:
+                stats["disconnects"] += 1
+                self.finish()
+
+    class LoadClientFactory(ClientFactory):
+        def __init__(self, name, room):
+            self.name = name
+            self.room = room
+
+        def buildProtocol(self, addr):
+            return LoadClient(self.name, self.room)
+
+        def clientConnectionFailed(self, connector, reason):
+            stats["disconnects"] += 1
+            finished.append(self.name)
+            if len(finished) == len(names):
+                reactor.stop()
+
+    for name, room in zip(names, rooms):
+        reactor.connectTCP("127.0.0.1", PORT, LoadClientFactory(name, room), timeout=30)
+    reactor.run()
+    results.put(stats)
+
+
+def run_load(client_count, rate, duration, room_size, workers, processes):
+    """
+    Starts a server with this many workers and puts the clients to work on it.
+    Returns the report.
+    :param client_count:
+    :param rate: Messages per second every client sends.
+    :param duration: How many seconds every client chats for.
+    :param room_size: How many clients share each room.
+    :param workers:
+    :param processes: How many processes to spread the clients across.
+    :return:
+    """
+    names = [f"load{i}" for i in range(client_count)]
+    rooms = [f"load{i // room_size}" for i in range(client_count)]
+    rss_samples = []
+    with tempfile.TemporaryDirectory() as folder:
+        write_config(folder, workers)
+        server = subprocess.Popen([sys.executable, SERVER], cwd=folder, stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port()
+            time.sleep(0.5 * workers)  # The first worker listening doesn't mean all of them are.
+
+            context = multiprocessing.get_context("spawn")
+            results = context.Queue()
+            clients = [
+                context.Process(
+                    target=run_clients, args=(names[i::processes], rooms[i::processes], rate, duration, results)
+                )
+                for i in range(processes)
+            ]
+            for process in clients:
+                process.start()
+            outcomes = []
+            while len(outcomes) < len(clients):
+                try:
+                    outcomes.append(results.get(timeout=RSS_SAMPLE_INTERVAL))
+                except queue.Empty:
+                    rss_samples.append(process_tree_rss(server.pid))
+            rss_samples.append(process_tree_rss(server.pid))
+            for process in clients:
+                process.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = sorted(latency for outcome in outcomes for latency in outcome["latencies"])
+    first_sent = min((outcome["first_sent"] for outcome in outcomes if outcome["first_sent"]), default=None)
+    last_received = max((outcome["last_received"] for outcome in outcomes if outcome["last_received"]), default=None)
+    elapsed = last_received - first_sent if first_sent and last_received else None
+    rss_samples = [rss for rss in rss_samples if rss is not None]
+
+    def milliseconds(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {
+        "clients": client_count,
+        "rate_per_client": rate,
+        "duration": duration,
+        "room_size": room_size,
+        "workers": workers,
+        "sent": sum(outcome["sent"] for outcome in outcomes),
+        "received": len(latencies),
+        "lost": sum(outcome["lost"] for outcome in outcomes),
+        "errors": sum(outcome["errors"] for outcome in outcomes),
+        "resyncs": sum(outcome["resyncs"] for outcome in outcomes),
+        "disconnects": sum(outcome["disconnects"] for outcome in outcomes),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,  # Messages per second.
+        # Every message also goes out to the rest of its room.
+        "deliveries_per_second": round(len(latencies) * min(room_size, client_count) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": milliseconds(percentile(latencies, 0.5)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "p999": milliseconds(percentile(latencies, 0.999)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        },
+        "server_rss_bytes": {
+            "peak": max(rss_samples, default=None),
+            "end": rss_samples[-1] if rss_samples else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests a server on localhost with many simulated clients.")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second every client sends.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds every client chats for.")
+    parser.add_argument("--room-size", type=int, default=20, help="How many clients share each room.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes the server runs.")
+    parser.add_argument("--processes", type=int, default=None, help="Processes to run the clients in.")
+    parser.add_argument("--output", default=None, help="File to write the report to, as well as printing it.")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    processes = args.processes or max(1, min(os.cpu_count() or 1, args.clients // 250 or 1))
+    report = run_load(args.clients, args.rate, args.duration, args.room_size, args.workers, processes)
+    text = json.dumps(report, indent=4)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Measures how many messages per second the server handles with each log level, to show what debug logging costs.
+Messages are fed straight into a MessagingProtocol, so the numbers are of the server's own work, and not the network's.
+Write behind is on, so SQLite's commits don't hide the difference.
+Run from the repository root:
+    python -m benchmarks.log_levels [--messages N]
+"""
+import argparse
+import os
+import tempfile
+import time
+import toml
+from twisted.internet import defer, task
+from twisted.internet.testing import StringTransport
+from twisted.logger import globalLogBeginner, globalLogPublisher
+from constants import CONFIG_FILE
+from logs import make_observer, sample_packet_log
+from packet import create_user, login_message, log_message
+from server import MessagingFactory
+
+
+def make_config(folder):
+    """
+    Writes a copy of the config file that keeps its data in folder, without rate limits.
+    Returns the path to it.
+    :param folder:
+    :return:
+    """
+    config = toml.load(CONFIG_FILE)
+    config['structure']['data_folder'] = folder
+    config['session']['database']['allow_user_creation'] = True
+    config['session']['database']['write_behind'] = True
+    config['rate_limits'] = {}  # The benchmark sends as fast as it can on purpose.
+    path = os.path.join(folder, "config.toml")
+    with open(path, "w") as config_file:
+        toml.dump(config, config_file)
+    return path
+
+
+@defer.inlineCallbacks
+def wait_until(reactor, condition):
+    """
+    Fires once condition returns true, checking every millisecond.
+    :param reactor:
+    :param condition:
+    :return:
+    """
+    while not condition():
+        yield task.deferLater(reactor, 0.001, lambda: None)
+
+
+@defer.inlineCallbacks
+def messages_per_second(reactor, factory, client, folder, message_count, level, sample_rate):
+    """
+    Has client send message_count messages while logging at level to a file in folder,
+    firing with how many were handled per second.
+    :param reactor:
+    :param factory:
+    :param client: A logged in MessagingProtocol.
+    :param folder:
+    :param message_count:
+    :param level:
+    :param sample_rate: With debug, one in how many per packet lines is written.
+    :return:
+    """
+    observer, file_observer = make_observer(os.path.join(folder, f"{level}-{sample_rate}.log"), level)
+    sample_packet_log.enabled = level == "debug"
+    sample_packet_log.every = sample_rate
+    globalLogPublisher.addObserver(observer)
+
+    data = b"".join(log_message(f"Benchmark message number {i}.").encode() for i in range(message_count))
+    last_id = factory.session.next_message_id + message_count
+    start = time.perf_counter()
+    client.dataReceived(data)
+    yield wait_until(reactor, lambda: factory.session.next_message_id >= last_id and not client.waiting)
+    elapsed = time.perf_counter() - start
+
+    globalLogPublisher.removeObserver(observer)
+    file_observer.close()
+    client.transport.clear()
+    return message_count / elapsed
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description="Benchmarks handling messages with each log level.")
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+
+    # Nothing is logged anywhere but the files each run sets up.
+    globalLogBeginner.beginLoggingTo([], redirectStandardIO=False)
+    with tempfile.TemporaryDirectory() as folder:
+        factory = MessagingFactory(make_config(folder))
+        client = factory.buildProtocol(None)
+        client.makeConnection(StringTransport())
+        client.dataReceived(create_user("benchmark", "benchmark").encode())
+        yield wait_until(reactor, lambda: not client.waiting)
+        client.dataReceived(login_message("benchmark", "benchmark").encode())
+        yield wait_until(reactor, lambda: client.logged_in)
+
+        modes = [
+            ("info", "info", 1),
+            ("debug, every packet", "debug", 1),
+            ("debug, one in 100 packets", "debug", 100),
+        ]
+        for name, level, sample_rate in modes:
+            rate = yield messages_per_second(reactor, factory, client, folder, args.messages, level, sample_rate)
+            print(f"{name:<30}{rate:>12.0f} messages/sec")
+
+        factory.prune_loop.stop()
+        factory.lag_monitor.stop()
+        yield factory.session.close()
+
+
+if __name__ == "__main__":
+    task.react(main)
@@ -0,0 +1,82 @@
+"""
+Measures how many bytes a typical chat session puts on the wire with each codec and compression mode.
+Run from the repository root:
+    python -m benchmarks.wire_bytes
+"""
+import random
+import time
+from packet import *
+from message import Message, User
+
+WORDS = (
+    "hello there how is everyone doing today i just got back from lunch did anyone see the game last night "
+    "yeah it was great the server seems fast now can someone send me the link again thanks see you later"
+).split()
+USERS = ["alice", "bob", "carol", "dave", "erin"]
+
+
+def chat_session(message_count=500, seed=0):
+    """
+    Builds the packets a client exchanges with the server while chatting.
+    Returns the packets the client sends and the ones the server sends back directly to it.
+    :param message_count:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    sent = [login_message("alice", "hunter2")]
+    received = [success_message()]
+    for message_id in range(1, message_count + 1):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+        sender = rng.choice(USERS)
+        if sender == "alice":
+            sent.append(log_message(text))
+            received.append(success_message())
+        received.append(message_log_addition(Message(message_id, User(sender), text, time.time())))
+    return sent, received
+
+
+def wire_bytes(packets, codec, framed, shared_broadcasts=False):
+    """
+    Returns how many bytes the packets take up once encoded with codec, frame headers included.
+    :param packets:
+    :param codec:
+    :param framed:
+    :param shared_broadcasts: Encode additions the way the broadcast scheduler does, outside the connection stream.
+    :return:
+    """
+    overhead = FRAME_HEADER.size if framed else 0
+    total = 0
+    for packet in packets:
+        if shared_broadcasts and packet.type == PacketType.MESSAGE_LOG_ADDITION:
+            total += len(codec.encode_shared(packet)) + overhead
+        else:
+            total += len(codec.encode(packet)) + overhead
+    return total
+
+
+def main():
+    sent, received = chat_session()
+    modes = [
+        ("json + zlib (unframed)", lambda: create_codec(CODEC_JSON), False),
+        ("binary", lambda: create_codec(CODEC_BINARY), True),
+        ("binary + zlib stream", lambda: create_codec(CODEC_BINARY, [FEATURE_ZLIB_STREAM]), True),
+        (
+            "binary + zlib stream + dictionary",
+            lambda: create_codec(CODEC_BINARY, [FEATURE_ZLIB_STREAM, FEATURE_ZLIB_DICTIONARY]),
+            True
+        ),
+    ]
+    print(f"{len(sent)} packets sent, {len(received)} packets received.")
+    print(f"{'mode':<36}{'client -> server':>18}{'server -> client':>18}{'(shared broadcasts)':>22}")
+    for name, make_codec, framed in modes:
+        print(
+            f"{name:<36}"
+            f"{wire_bytes(sent, make_codec(), framed):>18}"
+            f"{wire_bytes(received, make_codec(), framed):>18}"
+            f"{wire_bytes(received, make_codec(), framed, shared_broadcasts=True):>22}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Measures how message throughput scales with the number of worker processes the server runs.
+Starts a real server for every worker count, with clients in separate processes sending messages as fast as they
+get replies. Every client chats in a room of its own, so the numbers show how many messages the workers can handle
+rather than how many copies of each one go out. Write behind is on, so SQLite's commits don't hide the scaling.
+Run from the repository root, on a machine with at least as many cores as the most workers:
+    python -m benchmarks.workers [--workers 1 2 4] [--clients 32] [--messages 200]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import toml
+from constants import CONFIG_FILE
+
+SERVER = os.path.abspath("server.py")
+PORT = 49200
+
+
+def write_config(folder, workers):
+    """
+    Writes a copy of the config file that runs the benchmark server in folder.
+    :param folder:
+    :param workers:
+    :return:
+    """
+    config = toml.load(CONFIG_FILE)
+    config['port'] = PORT
+    config['structure']['data_folder'] = os.path.join(folder, "data")
+    config.setdefault('network', {})['workers'] = workers
+    config['session']['database']['allow_user_creation'] = True
+    config['session']['database']['write_behind'] = True
+    config['rate_limits'] = {}  # The clients send as fast as they can on purpose.
+    os.mkdir(config['structure']['data_folder'])
+    with open(os.path.join(folder, "config.toml"), "w") as config_file:
+        toml.dump(config, config_file)
+
+
+def wait_for_port(timeout=10.0):
+    """
+    Waits until the server accepts connections.
+    :param timeout:
+    :return:
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", PORT)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start.")
+
+
+def run_clients(names, message_count, results):
+    """
+    Runs in a process of its own. Connects a client for every name, and has each send message_count messages.
+    Puts the number of messages sent, and when the first and last of them were sent, on results.
+    :param names:
+    :param message_count:
+    :param results:
+    :return:
+    """
+    from twisted.internet import reactor
+    from twisted.internet.protocol import Protocol, ClientFactory
+    from packet import (
+        PacketType, PacketBuffer, JsonPacket, server_info_request, login_message, join_room, leave_room, log_message
+    )
+
+    finished = []
+    times = []
+
+    class BenchmarkClient(Protocol):
+        def __init__(self, name):
+            self.name = name
+            self.packet_buffer = PacketBuffer()
+            # One request at a time, the next goes out when the server answers the previous one.
+            self.requests = [login_message(name, "benchmark"), join_room(name), leave_room("general")]
+            self.requests += [log_message(f"Benchmark message number {i}.", name) for i in range(message_count)]
+            self.requests.reverse()
+
+        def connectionMade(self):
+            # No features or codecs, so the server talks the original unframed json protocol.
+            self.transport.write(server_info_request(features=(), codecs=()).encode())
+
+        def dataReceived(self, data):
+            for encoded_packet in self.packet_buffer.feed(data):
+                packet = JsonPacket.decode(encoded_packet)
+                if packet.type in (PacketType.SUCCESS, PacketType.ERROR):
+                    self.send_next()
+
+        def send_next(self):
+            if len(self.requests) == message_count:
+                times.append(time.time())
+            if not self.requests:
+                times.append(time.time())
+                finished.append(self.name)
+                self.transport.loseConnection()
+                if len(finished) == len(names):
+                    reactor.stop()
+                return
+            self.transport.write(self.requests.pop().encode())
+
+    class BenchmarkFactory(ClientFactory):
+        def __init__(self, name):
+            self.name = name
+
+        def buildProtocol(self, addr):
+            return BenchmarkClient(self.name)
+
+    for name in names:
+        reactor.connectTCP("127.0.0.1", PORT, BenchmarkFactory(name))
+    reactor.run()
+    results.put((len(names) * message_count, min(times), max(times)))
+
+
+def create_users(names):
+    """
+    Creates an account for every name.
+    :param names:
+    :return:
+    """
+    from packet import PacketBuffer, JsonPacket, PacketType, server_info_request, create_user
+    connection = socket.create_connection(("127.0.0.1", PORT))
+    packet_buffer = PacketBuffer()
+    replies = []
+
+    def wait_for_reply():
+        while not replies:
+            for encoded_packet in packet_buffer.feed(connection.recv(65536)):
+                packet = JsonPacket.decode(encoded_packet)
+                if packet.type in (PacketType.SUCCESS, PacketType.ERROR):
+                    replies.append(packet)
+        replies.pop()
+
+    connection.sendall(server_info_request(features=(), codecs=()).encode())
+    wait_for_reply()
+    for name in names:
+        connection.sendall(create_user(name, "benchmark").encode())
+        wait_for_reply()
+    connection.close()
+
+
+def messages_per_second(workers, client_count, message_count, processes):
+    """
+    Starts a server with this many workers, and returns how many messages per second the clients got through.
+    :param workers:
+    :param client_count:
+    :param message_count: How many messages every client sends.
+    :param processes: How many processes to spread the clients across.
+    :return:
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        write_config(folder, workers)
+        server = subprocess.Popen([sys.executable, SERVER], cwd=folder, stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port()
+            time.sleep(0.5 * workers)  # The first worker listening doesn't mean all of them are.
+            names = [f"bench{i}" for i in range(client_count)]
+            create_users(names)
+
+            context = multiprocessing.get_context("spawn")
+            results = context.Queue()
+            clients = [
+                context.Process(target=run_clients, args=(names[i::processes], message_count, results))
+                for i in range(processes)
+            ]
+            for process in clients:
+                process.start()
+            outcomes = [results.get() for _ in clients]
+            for process in clients:
+                process.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    sent = sum(outcome[0] for outcome in outcomes)
+    elapsed = max(outcome[2] for outcome in outcomes) - min(outcome[1] for outcome in outcomes)
+    return sent / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks message throughput against the number of workers.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=200, help="Messages sent by every client.")
+    parser.add_argument("--processes", type=int, default=None, help="Processes to run the clients in.")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores, {args.clients} clients sending {args.messages} messages each.")
+    baseline = None
+    for workers in args.workers:
+        processes = args.processes or max(args.workers)
+        rate = messages_per_second(workers, args.clients, args.messages, processes)
+        baseline = baseline or rate
+        print(f"{workers:>3} workers{rate:>12.0f} messages/sec{rate / baseline:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import time
+from twisted.internet import reactor
+from packet import FEATURE_BATCH, FEATURE_COLUMNAR_LOG, message_log_addition, message_log_batch
+from metrics import broadcast_seconds, encode_seconds
+
+
+class BroadcastScheduler:
+    """
+    Collects the messages that need to go out to the members of their rooms, and sends them together.
+    Everything queued within the same reactor tick (or within the configured window) is encoded once per codec,
+    and every connection gets a single write for the whole batch.
+    """
+    def __init__(self, session, window=0.0, clock=reactor):
+        """
+        :param session: The session whose rooms the broadcasts go out to.
+        :param window: How many seconds to wait for more messages before flushing. 0 flushes on the next tick.
+        :param clock: What to schedule flushes with, the reactor by default.
+        """
+        self.session = session
+        self.window = window
+        self.clock = clock
+        self.pending = []
+        self.first_queued_at = None
+        self.delayed_flush = None
+
+        # Counters, for keeping an eye on how well messages are being batched.
+        self.flush_count = 0
+        self.message_count = 0
+        self.largest_batch = 0
+        self.total_flush_latency = 0.0  # Time from a batch's first message being queued to it being written.
+        self.last_flush_latency = 0.0
+
+    def queue(self, message):
+        """
+        Queues a message to be sent to every member of its room on the next flush.
+        :param message:
+        :return:
+        """
+        if not self.pending:
+            self.first_queued_at = time.perf_counter()
+            self.delayed_flush = self.clock.callLater(self.window, self.flush)
+        self.pending.append(message)
+
+    def flush(self):
+        """
+        Sends every queued message out to every member of its room.
+        Clients that support batches get one packet for all of them, the rest get one packet per message.
+        :return:
+        """
+        if self.delayed_flush is not None and self.delayed_flush.active():
+            self.delayed_flush.cancel()
+        self.delayed_flush = None
+
+        messages, self.pending = self.pending, []
+        if not messages:
+            return
+
+        start = time.perf_counter()
+        rooms = {}
+        for message in messages:
+            rooms.setdefault(message.room, []).append(message)
+        for room, room_messages in rooms.items():
+            self.send_to_room(room, room_messages)
+        broadcast_seconds.observe(time.perf_counter() - start)
+
+        self.last_flush_latency = time.perf_counter() - self.first_queued_at
+        self.total_flush_latency += self.last_flush_latency
+        self.flush_count += 1
+        self.message_count += len(messages)
+        self.largest_batch = max(self.largest_batch, len(messages))
+
+    def send_to_room(self, room, messages):
+        """
+        Sends messages from one room to every member of it.
+        :param room:
+        :param messages:
+        :return:
+        """
+        # Every packet is encoded at most once per codec and layout, however many clients it goes to.
+        # Connection zlib streams are left out of it, those would need an encoding per client.
+        encoded_additions = {}
+        encoded_batches = {}
+        if room not in self.session.rooms:
+            return  # Taken out of memory since, so it has no members.
+        for user in self.session.rooms[room].members:
+            codec = user.codec
+            columnar = FEATURE_COLUMNAR_LOG in user.features
+            key = (codec.name, columnar)
+            if len(messages) > 1 and FEATURE_BATCH in user.features:
+                if key not in encoded_batches:
+                    start = time.perf_counter()
+                    encoded_batches[key] = codec.encode_shared(message_log_batch(messages, columnar))
+                    encode_seconds.observe(time.perf_counter() - start)
+                user.broadcast_encoded(encoded_batches[key])
+            else:
+                if key not in encoded_additions:
+                    start = time.perf_counter()
+                    encoded_additions[key] = [
+                        codec.encode_shared(message_log_addition(message, columnar)) for message in messages
+                    ]
+                    encode_seconds.observe(time.perf_counter() - start)
+                user.broadcast_encoded(*encoded_additions[key])
+
+    def stats(self):
+        """
+        Returns the counters of this scheduler.
+        :return:
+        """
+        return {
+            "flushes": self.flush_count,
+            "messages": self.message_count,
+            "largest_batch": self.largest_batch,
+            "average_batch": self.message_count / self.flush_count if self.flush_count else 0,
+            "average_flush_latency": self.total_flush_latency / self.flush_count if self.flush_count else 0,
+            "last_flush_latency": self.last_flush_latency,
+        }
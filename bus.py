@@ -0,0 +1,202 @@
+from twisted.internet import defer
+from twisted.internet.protocol import Factory
+from twisted.protocols import amp
+from twisted.logger import Logger
+from message import Message, User
+
+log = Logger()
+
+# The bus that connects the worker processes of a server running with more than one worker.
+# The launcher runs the hub, every worker connects to it over a Unix socket.
+# The hub hands out message ids, so they stay in order across workers, relays every new message
+# to the other workers, and keeps track of which worker every logged in user is on.
+
+
+class Register(amp.Command):
+    """
+    Sent by a worker as soon as it connects, with the id it would give its next message by itself.
+    """
+    arguments = [(b"next_message_id", amp.Integer())]
+    response = []
+
+
+class NextMessageId(amp.Command):
+    """
+    Asks the hub for the id of a new message.
+    """
+    arguments = []
+    response = [(b"id", amp.Integer())]
+
+
+class Publish(amp.Command):
+    """
+    A new message, from a worker to the hub, and from the hub to every other worker.
+    """
+    arguments = [
+        (b"id", amp.Integer()),
+        (b"sender", amp.Unicode()),
+        (b"message", amp.Unicode()),
+        (b"timestamp", amp.Float()),
+        (b"room", amp.Unicode()),
+    ]
+    response = []
+    requiresAnswer = False
+
+
+class Claim(amp.Command):
+    """
+    Asks the hub for a username, before logging in a user with it. Only one worker can have it at a time.
+    """
+    arguments = [(b"name", amp.Unicode())]
+    response = [(b"claimed", amp.Boolean())]
+
+
+class Release(amp.Command):
+    """
+    Gives a username back to the hub, once its user logged out.
+    """
+    arguments = [(b"name", amp.Unicode())]
+    response = []
+    requiresAnswer = False
+
+
+class Hub:
+    """
+    What the hub knows about every worker.
+    """
+    def __init__(self):
+        self.next_message_id = 1
+        self.workers = set()
+        self.claims = {}  # Logged in usernames to the connection of the worker they are on.
+
+
+class HubProtocol(amp.AMP):
+    """
+    The hub's end of the connection to one worker.
+    """
+    def __init__(self, hub):
+        super().__init__()
+        self.hub = hub
+
+    def connectionMade(self):
+        self.hub.workers.add(self)
+
+    def connectionLost(self, reason):
+        log.info("Worker left the bus. {reason!r}", reason=reason)
+        self.hub.workers.discard(self)
+        # Its users are gone with it.
+        for name in [name for name, worker in self.hub.claims.items() if worker is self]:
+            del self.hub.claims[name]
+        super().connectionLost(reason)
+
+    @Register.responder
+    def register(self, next_message_id):
+        self.hub.next_message_id = max(self.hub.next_message_id, next_message_id)
+        return {}
+
+    @NextMessageId.responder
+    def next_message_id(self):
+        message_id = self.hub.next_message_id
+        self.hub.next_message_id += 1
+        return {"id": message_id}
+
+    @Publish.responder
+    def publish(self, **message):
+        for worker in self.hub.workers:
+            if worker is not self:
+                worker.callRemote(Publish, **message)
+        return {}
+
+    @Claim.responder
+    def claim(self, name):
+        if self.hub.claims.setdefault(name, self) is not self:
+            return {"claimed": False}
+        return {"claimed": True}
+
+    @Release.responder
+    def release(self, name):
+        if self.hub.claims.get(name) is self:
+            del self.hub.claims[name]
+        return {}
+
+
+class HubFactory(Factory):
+    def __init__(self):
+        self.hub = Hub()
+
+    def buildProtocol(self, addr):
+        return HubProtocol(self.hub)
+
+
+class BusClient(amp.AMP):
+    """
+    A worker's end of the bus.
+    Messages the other workers published are passed to on_message, as Message instances.
+    """
+    def __init__(self, on_message):
+        super().__init__()
+        self.on_message = on_message
+
+    def next_message_id(self):
+        """
+        Returns a Deferred that fires with the id of a new message.
+        :return:
+        """
+        d = self.callRemote(NextMessageId)
+        d.addCallback(lambda response: response["id"])
+        return d
+
+    def publish(self, message):
+        """
+        Sends a new message to every other worker.
+        :param message:
+        :return:
+        """
+        self.callRemote(
+            Publish,
+            id=message.id,
+            sender=message.sender.name,
+            message=message.message,
+            timestamp=float(message.timestamp),
+            room=message.room,
+        )
+
+    def claim(self, name):
+        """
+        Returns a Deferred that fires with whether this worker got the username.
+        :param name:
+        :return:
+        """
+        d = self.callRemote(Claim, name=name)
+        d.addCallback(lambda response: response["claimed"])
+        return d
+
+    def release(self, name):
+        """
+        Gives back a username claimed before.
+        :param name:
+        :return:
+        """
+        self.callRemote(Release, name=name)
+
+    @Publish.responder
+    def published(self, id, sender, message, timestamp, room):
+        self.on_message(Message(id, User(sender), message, timestamp, room))
+        return {}
+
+
+@defer.inlineCallbacks
+def connect_bus(endpoint, session, on_message):
+    """
+    Connects a worker to the hub, and makes its session use the bus.
+    Returns a Deferred that fires with the connected BusClient.
+    :param endpoint: Where the hub listens.
+    :param session: The session of the worker.
+    :param on_message: Gets called with every message published by other workers.
+    :return:
+    """
+    bus = BusClient(on_message)
+    yield endpoint.connect(Factory.forProtocol(lambda: bus))
+    yield bus.callRemote(Register, next_message_id=session.next_message_id)
+    session.bus = bus
+    return bus
@@ -0,0 +1,85 @@
+from collections import deque
+from packet import MessageLogSetPacket, message_log_fields
+
+
+class MessageLogCache:
+    """
+    Keeps the MESSAGE_LOG_SET packet of a room ready to send, already encoded for every codec and layout asked for.
+    Repeat requests are just a write. New messages extend the cached log and drop the stale encodings,
+    which get rebuilt on the next request.
+    """
+    def __init__(self, session, room=None):
+        """
+        :param session:
+        :param room: Name of the room whose log is cached, the default room if not given.
+        """
+        self.session = session
+        self.room = session.get_room(room).name
+        self.entries = None
+        self.last_id = 0
+        self.load_entries()
+        self.fields = {}  # Whether columnar, to the fields carrying the entries, shared by every codec.
+        self.encoded = {}  # Codec name and whether columnar, to the encoded packet.
+
+        self.hits = 0
+        self.misses = 0
+
+    def message_added(self, message):
+        """
+        Adds a newly logged message to the cached log.
+        :param message:
+        :return:
+        """
+        if message.id > self.last_id:
+            self.last_id = message.id
+            self.entries.appendleft(message)
+        else:
+            # Either already in the cache, or from another worker and older than the newest cached message.
+            # The recent messages of the room have it in the right place either way.
+            self.load_entries()
+        self.fields.clear()
+        self.encoded.clear()
+
+    def load_entries(self):
+        """
+        Fills the cached log from the recent messages of the room.
+        :return:
+        """
+        log = self.session.get_message_log(room=self.room)
+        # Newest first, like get_message_log returns them.
+        self.entries = deque(log, maxlen=self.session.max_shown_messages)
+        # Messages can be in the recent ones before they are added here, those must not be added twice.
+        self.last_id = log[0].id if log else 0
+
+    def get(self, codec, columnar=False):
+        """
+        Returns the MESSAGE_LOG_SET packet encoded with codec, encoding it only if it isn't cached yet.
+        :param codec:
+        :param columnar: Whether the client negotiated FEATURE_COLUMNAR_LOG.
+        :return:
+        """
+        key = (codec.name, columnar)
+        encoded_packet = self.encoded.get(key)
+        if encoded_packet is not None:
+            self.hits += 1
+            return encoded_packet
+
+        self.misses += 1
+        fields = self.fields.get(columnar)
+        if fields is None:
+            fields = self.fields[columnar] = message_log_fields(self.entries, columnar)
+        encoded_packet = codec.encode_shared(MessageLogSetPacket(room=self.room, **fields))
+        self.encoded[key] = encoded_packet
+        return encoded_packet
+
+    def stats(self):
+        """
+        Returns the hit and miss counts of this cache.
+        :return:
+        """
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0,
+        }
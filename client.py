@@ -1,63 +1,125 @@
 #!/usr/bin/env python3
 import sys
-from packet import JsonPacket, PacketType, server_info_request
 from constants import STANDARD_PORT
 from twisted.internet import reactor, tksupport
 from twisted.python import log
-from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.internet.protocol import ClientFactory
 import customtkinter
-from client_gui import ClientApp, Popup
-from session import Message
-import traceback
+from client_core import ClientCore
+from client_gui import ClientApp, Popup, MAX_HISTORY
+from client_cache import MessageCache, DEFAULT_CACHE_FILE
 import argparse
 
 
-class Client(Protocol):
-    def __init__(self):
+class Client:
+    """
+    Shows the connection of a ClientCore in the GUI, which gets made once the server sent its info.
+    Messages are cached on disk, so the ones seen before show up straight away the next time.
+    """
+    def __init__(self, core, host, port, max_history=MAX_HISTORY, cache_file=DEFAULT_CACHE_FILE):
+        """
+        :param core:
+        :param host: The server's host and port, the cache is kept apart for every server.
+        :param port:
+        :param max_history: How many messages to keep at most, in the GUI and in the cache of every room.
+        :param cache_file: Where to cache messages, None not to.
+        """
+        self.core = core
+        self.host = host
+        self.port = port
+        self.max_history = max_history
+        self.cache_file = cache_file
+        self.cache = None
         self.gui = None
+        core.on("server_info", self.server_info)
+        core.on("message", self.message)
+        core.on("log_set", self.log_set)
+        core.on("delta", self.delta)
+        core.on("page", self.page)
+        core.on("resync", lambda: self.gui.resend_message_log())
+        core.on("error", self.error)
+        core.on("success", self.success)
+        core.on(
+            "protocol_error",
+            lambda: Popup(title="Client Error", text="The server sent something unreadable.", master=self.gui)
+        )
+        core.on(
+            "client_error",
+            lambda: Popup(title="Client Error", text="An error has occurred with the client.", master=self.gui)
+        )
 
-    def connectionMade(self):
-        log.msg("Asking server for info...")
-        self.transport.write(server_info_request().encode())
-
-    def dataReceived(self, data):
-        try:
-            message = JsonPacket.decode(data)
-            if message.type == PacketType.MESSAGE_LOG_ADDITION:
-                message_instance = Message.from_string(message.content)
-                self.gui.message_box.add_message(message_instance)
-            elif message.type == PacketType.MESSAGE_LOG_SET:
-                log_ = JsonPacket.decode_message_log(message.content)
-                self.gui.message_box.set_message_log(log_)
-            elif message.type == PacketType.ERROR:
-                Popup(title="Session Error", text=message.content, master=self.gui)
-            elif message.type == PacketType.SUCCESS:
-                Popup(title="Success", text="Success.", master=self.gui)
-            elif message.type == PacketType.SERVER_INFO:
-                log.msg("Got server info. Starting client...")
-                customtkinter.set_default_color_theme("blue")
-                customtkinter.set_appearance_mode("dark")
-                self.gui = ClientApp(
-                    self,
-                    message.server_name,
-                    message.char_limit,
-                    message.name_char_limit,
-                    message.user_creation_allowed,
-                    message.max_shown,
-                )
-                tksupport.install(self.gui)
-        except Exception as e:
-            Popup(title="Client Error", text="An error has occurred with the client.", master=self.gui)
-            traceback.print_exc()
+    def server_info(self, message):
+        log.msg("Got server info. Starting client...")
+        if self.cache_file is not None:
+            self.cache = MessageCache(self.cache_file, self.host, self.port, message.server_name, self.max_history)
+            reactor.addSystemEventTrigger("before", "shutdown", self.cache.close)
+        customtkinter.set_default_color_theme("blue")
+        customtkinter.set_appearance_mode("dark")
+        self.gui = ClientApp(
+            self.core,
+            message.server_name,
+            message.char_limit,
+            message.name_char_limit,
+            message.user_creation_allowed,
+            message.max_shown,
+            self.max_history,
+            self.cache,
+        )
+        self.gui.message_box.set_message_log(self.gui.cached_messages(self.core.room))
+        tksupport.install(self.gui)
+
+    def cache_messages(self, messages):
+        if self.cache is not None:
+            self.cache.store(self.core.room, messages)
+
+    def message(self, message):
+        self.gui.message_box.add_message(message)
+        self.cache_messages([message])
+
+    def delta(self, messages):
+        self.gui.message_box.apply_delta(messages)
+        self.cache_messages(messages)
+
+    def page(self, messages, has_more):
+        self.gui.message_box.add_older_messages(messages, has_more)
+        self.cache_messages(messages)
+
+    def log_set(self, messages):
+        merged = self.gui.message_box.merge_message_log(messages)
+        if self.cache is not None and not merged:
+            self.cache.replace(self.core.room, messages)
+        else:
+            self.cache_messages(messages)
+
+    def success(self):
+        if self.gui.logging_in:
+            # Catch up on what was missed since the cached messages, the server merges them in.
+            self.gui.logging_in = False
+            self.gui.resend_message_log()
+        Popup(title="Success", text="Success.", master=self.gui)
+
+    def error(self, text, retry_after):
+        self.gui.logging_in = False
+        if retry_after is not None:
+            text += f" Try again in {retry_after:.1f} seconds."
+        Popup(title="Session Error", text=text, master=self.gui)
 
 
 class MessagingClientFactory(ClientFactory):
+    def __init__(self, host, port, max_history=MAX_HISTORY, cache_file=DEFAULT_CACHE_FILE):
+        self.host = host
+        self.port = port
+        self.max_history = max_history
+        self.cache_file = cache_file
+
     def startedConnecting(self, connector):
         log.msg("Trying to connect...")
 
     def buildProtocol(self, addr):
         log.msg('Connected.')
-        return Client()
+        core = ClientCore()
+        Client(core, self.host, self.port, self.max_history, self.cache_file)
+        return core
 
     def clientConnectionLost(self, connector, reason):
         log.msg('Lost connection.  Reason:', reason)
@@ -74,9 +136,15 @@ if __name__ == "__main__":
     )
     parser.add_argument('-ht', '--host', required=True)
     parser.add_argument('-p', '--port', default=STANDARD_PORT)
+    parser.add_argument('--max-history', type=int, default=MAX_HISTORY, help="How many messages to keep at most.")
+    parser.add_argument('--cache', default=DEFAULT_CACHE_FILE, help="File to cache messages in between runs.")
+    parser.add_argument('--no-cache', action='store_true', help="Don't cache messages.")
     args = parser.parse_args()
 
     log.startLogging(sys.stdout)
-    reactor.connectTCP(args.host, args.port, MessagingClientFactory())
+    cache_file = None if args.no_cache else args.cache
+    reactor.connectTCP(
+        args.host, int(args.port), MessagingClientFactory(args.host, int(args.port), args.max_history, cache_file)
+    )
     reactor.run()
     sys.exit()
@@ -0,0 +1,114 @@
+import os
+import sqlite3
+from twisted.internet import reactor
+from message import Message, User
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".messenger", "cache.db")
+FLUSH_DELAY = 1.0  # Seconds new messages wait before being written, so bursts get written together.
+
+
+class MessageCache:
+    """
+    Keeps the messages a client has seen in a local SQLite database, for every server and room,
+    so they can be shown straight away the next time it connects, before the server sent anything.
+    Servers are told apart by their host, port and name. Only the newest max_messages of every room are kept.
+    """
+    def __init__(self, path, host, port, server_name, max_messages, clock=reactor):
+        """
+        :param path: The SQLite file to keep the cache in, made if it doesn't exist.
+        :param host:
+        :param port:
+        :param server_name:
+        :param max_messages: How many messages to keep for every room, the oldest are deleted first.
+        :param clock:
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode=WAL;")
+        self.con.execute("PRAGMA synchronous=NORMAL;")  # Losing the last few messages in a crash is fine for a cache.
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS cached_messages("
+            "server text NOT NULL, room text NOT NULL, id integer NOT NULL, sender text, message text, timestamp, "
+            "PRIMARY KEY(server, room, id)) WITHOUT ROWID;"
+        )
+        self.con.commit()
+        self.server = f"{host}:{port}/{server_name}"
+        self.max_messages = max_messages
+        self.clock = clock
+        self.pending = {}  # Room keys to the rows waiting to be written for them.
+        self.delayed_flush = None
+
+    @staticmethod
+    def room_key(room):
+        return room or ""  # Servers from before rooms have a single one, without a name.
+
+    def load(self, room):
+        """
+        Returns the cached messages of a room, oldest first.
+        :param room:
+        :return:
+        """
+        self.flush()
+        rows = self.con.execute(
+            "SELECT id, sender, message, timestamp FROM cached_messages WHERE server=? AND room=? "
+            "ORDER BY id DESC LIMIT ?;",
+            (self.server, self.room_key(room), self.max_messages),
+        ).fetchall()
+        return [Message(row[0], User(row[1]), row[2], row[3], room) for row in reversed(rows)]
+
+    def store(self, room, messages):
+        """
+        Queues messages of a room to be written, replacing any cached ones with the same id.
+        :param room:
+        :param messages:
+        :return:
+        """
+        rows = self.pending.setdefault(self.room_key(room), [])
+        rows.extend((message.id, message.sender.name, message.message, message.timestamp) for message in messages)
+        if self.delayed_flush is None:
+            self.delayed_flush = self.clock.callLater(FLUSH_DELAY, self.flush)
+
+    def replace(self, room, messages):
+        """
+        Throws away everything cached for a room, and caches messages instead.
+        For when the server's log doesn't connect to the cached one, so keeping both would leave a gap.
+        :param room:
+        :param messages:
+        :return:
+        """
+        key = self.room_key(room)
+        self.pending.pop(key, None)
+        with self.con:
+            self.con.execute("DELETE FROM cached_messages WHERE server=? AND room=?;", (self.server, key))
+        self.store(room, messages)
+
+    def flush(self):
+        """
+        Writes every queued message in one transaction, then deletes the oldest of every room past max_messages.
+        :return:
+        """
+        if self.delayed_flush is not None and self.delayed_flush.active():
+            self.delayed_flush.cancel()
+        self.delayed_flush = None
+
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with self.con:
+            for key, rows in pending.items():
+                self.con.executemany(
+                    "INSERT OR REPLACE INTO cached_messages(server, room, id, sender, message, timestamp) "
+                    "VALUES(?, ?, ?, ?, ?, ?);",
+                    [(self.server, key) + row for row in rows],
+                )
+                self.con.execute(
+                    "DELETE FROM cached_messages WHERE server=? AND room=? AND id <= ("
+                    "SELECT id FROM cached_messages WHERE server=? AND room=? ORDER BY id DESC LIMIT 1 OFFSET ?);",
+                    (self.server, key, self.server, key, self.max_messages),
+                )
+
+    def close(self):
+        self.flush()
+        self.con.close()
@@ -0,0 +1,234 @@
+import zlib
+from twisted.internet import reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.protocol import Protocol
+from twisted.logger import Logger
+from errors import ProtocolError
+from packet import (
+    PacketType, PacketBuffer, PacketHandlers, CODEC_JSON, FEATURE_FRAMING, FRAME_HEADER, SUPPORTED_FEATURES,
+    SUPPORTED_CODECS, create_codec, server_info_request, login_message, logout_message, create_user, log_message,
+    message_log_set_request, message_log_since_request, message_log_page_request, join_room, leave_room
+)
+
+log = Logger()
+
+# Everything a ClientCore tells its callbacks about, and what they get called with.
+EVENTS = (
+    "server_info",  # The SERVER_INFO packet, once the connection is ready for requests.
+    "message",  # A new Message in the room being shown.
+    "log_set",  # The whole log of the room, as a list of Messages.
+    "delta",  # The Messages missed since the last one asked about, as a list.
+    "page",  # A list of older Messages, and whether there are even older ones.
+    "resync",  # Nothing. The server skipped messages for this client, the log should be asked for again.
+    "error",  # The error's text, and how many seconds to wait before trying again or None.
+    "success",  # Nothing. The last request went through.
+    "protocol_error",  # Nothing. The server sent something unreadable, and the connection is being closed.
+    "client_error",  # Nothing. A packet couldn't be handled, the error is logged.
+    "disconnected",  # Why the connection was lost.
+)
+
+
+class ClientCore(Protocol):
+    """
+    The network side of a messenger client, without any user interface.
+    Negotiates the protocol with the server, sends requests through its methods, and passes everything the server
+    sends on to the callbacks registered for it with on. The GUI client is one user of it, bots can use it directly.
+    """
+    handlers = PacketHandlers()  # Packet types to the methods handling them, see handle_message.
+
+    def __init__(self, features=SUPPORTED_FEATURES, codecs=SUPPORTED_CODECS):
+        """
+        :param features: The optional features to ask the server for. Leaving out the zlib stream ones saves
+        around 45KB of memory per connection, for processes running lots of clients.
+        :param codecs: The codecs to offer the server.
+        """
+        self.offered_features = features
+        self.offered_codecs = codecs
+        self.packet_buffer = PacketBuffer()
+        self.features = []
+        self.codec = create_codec(CODEC_JSON)
+        self.server_info = None  # The SERVER_INFO packet, once it arrived.
+        self.default_room = None  # None for servers from before rooms, requests then leave the room out.
+        self.room = None  # The room being shown.
+        self.callbacks = {}  # Event names to the callbacks registered for them, see EVENTS.
+
+    def on(self, event, callback):
+        """
+        Registers a callback for an event.
+        :param event: One of EVENTS.
+        :param callback:
+        :return:
+        """
+        if event not in EVENTS:
+            raise ValueError(f"Unknown event {event!r}, expected one of {EVENTS}.")
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.callbacks.get(event, ()):
+            callback(*args)
+
+    def connectionMade(self):
+        self.send(server_info_request(self.offered_features, self.offered_codecs))
+
+    def connectionLost(self, reason):
+        self.emit("disconnected", reason)
+
+    def send(self, packet):
+        """
+        Encodes a packet and sends it to the server, framing it if the server agreed to framing.
+        :param packet:
+        :return:
+        """
+        encoded_packet = self.codec.encode(packet)
+        if self.packet_buffer.framed:
+            self.transport.writeSequence((FRAME_HEADER.pack(len(encoded_packet)), encoded_packet))
+        else:
+            self.transport.write(encoded_packet)
+
+    def login(self, user, password):
+        self.send(login_message(user, password))
+
+    def logout(self):
+        self.send(logout_message())
+        self.room = self.default_room
+
+    def create_user(self, user, password):
+        self.send(create_user(user, password))
+
+    def send_message(self, text):
+        """
+        Sends a message to the room being shown.
+        :param text:
+        :return:
+        """
+        self.send(log_message(text, self.room))
+
+    def request_log(self):
+        """
+        Asks for the whole log of the room being shown.
+        :return:
+        """
+        self.send(message_log_set_request(self.room))
+
+    def request_since(self, last_id):
+        """
+        Asks for the messages after the one with this id. If there are too many, the whole log comes instead.
+        :param last_id:
+        :return:
+        """
+        self.send(message_log_since_request(last_id, self.room))
+
+    def request_history(self, before_id, size):
+        """
+        Asks for a page of the messages before the one with this id.
+        :param before_id:
+        :param size:
+        :return:
+        """
+        self.send(message_log_page_request(before_id, size, self.room))
+
+    def switch_room(self, room):
+        """
+        Leaves the room being shown, joins another one and asks for its log.
+        :param room:
+        :return:
+        """
+        self.send(leave_room(self.room))
+        self.send(join_room(room))
+        self.room = room
+        self.request_log()
+
+    def dataReceived(self, data):
+        try:
+            for encoded_packet in self.packet_buffer.feed(data):
+                self.handle_packet(encoded_packet)
+        except (zlib.error, ProtocolError):
+            log.failure("The server sent something unreadable.")
+            self.emit("protocol_error")
+            self.transport.loseConnection()
+
+    def handle_packet(self, data):
+        message = self.codec.decode(data)
+        try:
+            self.handle_message(message)
+        except Exception:
+            log.failure("Error while handling {type}", type=message.type.name)
+            self.emit("client_error")
+
+    def handle_message(self, message):
+        """
+        Passes a decoded packet from the server on to its handler, which calls the callbacks of its event.
+        :param message:
+        :return:
+        """
+        # Not every type of packet has a room, the ones that don't are about this connection.
+        if getattr(message, "room", None) not in (None, self.room):
+            log.debug("Ignoring {type} for room {room!r}, showing {current!r}.",
+                      type=message.type.name, room=message.room, current=self.room)
+            return
+        handler = self.handlers.get(message.type)
+        if handler is None:
+            log.debug("Ignoring {type}, clients don't handle it.", type=message.type.name)
+            return
+        handler(self, message)
+
+    @handlers.handles(PacketType.MESSAGE_LOG_ADDITION)
+    def handle_addition(self, message):
+        self.emit("message", message.get_message())
+
+    @handlers.handles(PacketType.MESSAGE_LOG_BATCH)
+    def handle_batch(self, message):
+        for message_instance in message.get_messages():
+            self.emit("message", message_instance)
+
+    @handlers.handles(PacketType.MESSAGE_LOG_SINCE)
+    def handle_since(self, message):
+        if message.too_far_behind:
+            log.info("Too far behind the server for a partial update, asking for the whole log...")
+            self.request_log()
+        else:
+            self.emit("delta", message.get_messages())
+
+    @handlers.handles(PacketType.MESSAGE_LOG_PAGE)
+    def handle_page(self, message):
+        self.emit("page", message.get_messages(), message.has_more)
+
+    @handlers.handles(PacketType.MESSAGE_LOG_SET)
+    def handle_log_set(self, message):
+        self.emit("log_set", message.get_messages())
+
+    @handlers.handles(PacketType.RESYNC)
+    def handle_resync(self, message):
+        log.info("Missed messages while too slow, syncing the log again...")
+        self.emit("resync")
+
+    @handlers.handles(PacketType.ERROR)
+    def handle_error(self, message):
+        self.emit("error", message.content, message.retry_after)
+
+    @handlers.handles(PacketType.SUCCESS)
+    def handle_success(self, message):
+        self.emit("success")
+
+    @handlers.handles(PacketType.SERVER_INFO)
+    def handle_server_info(self, message):
+        # Older servers don't send features or a codec, and keep talking the original unframed json protocol.
+        self.features = message.features or []
+        self.packet_buffer.framed = FEATURE_FRAMING in self.features
+        self.codec = create_codec(message.codec or CODEC_JSON, self.features)
+        self.default_room = self.room = message.default_room
+        self.server_info = message
+        self.emit("server_info", message)
+
+
+def connect(host, port, client=None, clock=reactor):
+    """
+    Connects a client to a server.
+    Returns a Deferred that fires with the client once connected, its server_info event fires once it's ready.
+    :param host:
+    :param port:
+    :param client: A ClientCore with its callbacks registered, a new one if None.
+    :param clock: The reactor to connect with.
+    :return:
+    """
+    return connectProtocol(TCP4ClientEndpoint(clock, host, int(port)), client or ClientCore())
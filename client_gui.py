@@ -1,7 +1,19 @@
+import bisect
+import time
 import customtkinter
 from tkinter import *
 from twisted.internet import reactor
-from packet import *
+from twisted.logger import Logger
+
+log = Logger()
+
+HISTORY_PAGE_SIZE = 50  # How many older messages to ask for at a time when scrolling back.
+MAX_HISTORY = 10000  # How many messages the client keeps at most, by default.
+ROW_HEIGHT = 40  # Height of every message in the message box, in pixels.
+OVERSCAN_ROWS = 2  # Rows kept past the bottom of the message box, so a partly shown one is never empty.
+SCROLL_ROWS = 3  # How many rows a turn of the mouse wheel scrolls.
+FRAME_MS = 16  # New messages are drawn at most once every this many milliseconds, together.
+FRAME_LOG_INTERVAL = 10  # Seconds between the frame times written to the log.
 
 
 class ServerInfoDialog(customtkinter.CTkToplevel):
@@ -184,64 +196,270 @@ class CredentialsPopup(customtkinter.CTkToplevel):
         return self.credentials
 
 
-class ScrollableMessageBox(customtkinter.CTkScrollableFrame):
-    def __init__(self, master, **kwargs):
+class FrameStats:
+    """
+    Keeps track of how long drawing frames of new messages takes, and writes it to the log every so often.
+    """
+    def __init__(self, interval=FRAME_LOG_INTERVAL):
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.frames = 0
+        self.messages = 0
+        self.total = 0.0
+        self.longest = 0.0
+
+    def add(self, duration, messages):
+        """
+        Records a frame.
+        :param duration: How long drawing it took, in seconds.
+        :param messages: How many messages it drew.
+        :return:
+        """
+        self.frames += 1
+        self.messages += messages
+        self.total += duration
+        self.longest = max(self.longest, duration)
+        if duration * 1000 > FRAME_MS:
+            log.warn(
+                "Drawing {messages} messages took {ms:.1f}ms, longer than a frame.", messages=messages, ms=duration * 1000
+            )
+
+        now = time.monotonic()
+        if now - self.started >= self.interval:
+            log.info(
+                "Drew {messages} messages in {frames} frames, {average:.2f}ms on average and {longest:.2f}ms at most.",
+                messages=self.messages,
+                frames=self.frames,
+                average=self.total / self.frames * 1000,
+                longest=self.longest * 1000,
+            )
+            self.reset()
+
+
+class ScrollableMessageBox(customtkinter.CTkFrame):
+    """
+    Shows the message log, newest message at the top.
+    Only has labels for the rows that fit in view, plus a few more. Scrolling shows other messages in the same labels,
+    so drawing stays just as fast however long the log gets. Every message takes up a single row of ROW_HEIGHT.
+    New messages are queued and drawn together once per frame, so a burst of them costs one redraw.
+    """
+    def __init__(self, master, request_older=None, max_messages=MAX_HISTORY, **kwargs):
+        """
+        :param master:
+        :param request_older: Called with the id of the oldest message shown when the user scrolls to the end of
+            the history, to fetch the messages before it.
+        :param max_messages: How many messages to keep. New ones push the oldest out past it, and scrolling back
+            stops asking for older ones once there are this many.
+        :param kwargs:
+        """
         super().__init__(master, **kwargs)
-        self.message_log = []
-        self.labels_list = []
+        self.message_log = []  # Sorted by id, oldest first.
+        self.message_ids = set()
+        self.max_messages = max_messages
+        self.top = 0  # How many of the newest messages are scrolled past.
+        self.rows = []  # The labels messages are drawn in, from the top of the view down.
+        self.visible_rows = 1
+        self.request_older = request_older
+        self.has_older = True
+        self.loading_older = False
+        self.pending = []  # Messages waiting for the next frame to be drawn.
+        self.frame_scheduled = False
+        self.frame_stats = FrameStats()
+
+        self.grid_propagate(False)  # Rows past the bottom are cut off, instead of growing the box.
+        self.columnconfigure(0, weight=1)
+        self.scrollbar = customtkinter.CTkScrollbar(self, command=self.on_scrollbar)
+        self.scrollbar.grid(row=0, column=1, rowspan=1000, sticky="ns")
+        self.bind("<Configure>", self.on_resize)
+        self.bind_scrolling(self)
 
-    def add_message(self, message):
+    def bind_scrolling(self, widget):
+        widget.bind("<MouseWheel>", self.on_mouse_wheel)
+        widget.bind("<Button-4>", lambda event: self.scroll(-SCROLL_ROWS))
+        widget.bind("<Button-5>", lambda event: self.scroll(SCROLL_ROWS))
+
+    def on_resize(self, event):
         """
-        Draw a new message onto the screen.
-        :param message:
+        Makes sure there are enough rows to fill the box, once it knows how big it is.
+        :param event:
+        :return:
+        """
+        self.visible_rows = max(1, event.height // ROW_HEIGHT)
+        while len(self.rows) < self.visible_rows + OVERSCAN_ROWS:
+            label = customtkinter.CTkLabel(self, text="", font=("Arial", 25), height=ROW_HEIGHT, anchor="w")
+            label.grid(row=len(self.rows), column=0, sticky="ew")
+            label.default_text_color = label.cget("text_color")
+            label.message_id = None
+            self.bind_scrolling(label)
+            self.rows.append(label)
+        self.scroll_to(self.top)  # A taller view might need older messages to fill it.
+
+    def on_mouse_wheel(self, event):
+        self.scroll(-SCROLL_ROWS if event.delta > 0 else SCROLL_ROWS)
+
+    def on_scrollbar(self, action, amount, unit=None):
+        """
+        Called by the scrollbar when it's dragged or clicked.
+        :param action: "moveto" with the fraction to show from, or "scroll" by an amount of units or pages.
+        :param amount:
+        :param unit:
         :return:
         """
-        self.message_log.append(message)
-        self.draw_new_message(message)
+        if action == "moveto":
+            self.scroll_to(round(float(amount) * len(self.message_log)))
+        elif unit == "pages":
+            self.scroll(int(float(amount)) * self.visible_rows)
+        else:
+            self.scroll(int(float(amount)))
+
+    def scroll(self, rows):
+        self.scroll_to(self.top + rows)
 
-    def clear(self):
+    def scroll_to(self, top):
         """
-        Destroys all the labels in this message box.
-        Does not clear it's message log.
+        Scrolls so the message this many from the newest is at the top of the view.
+        Asks for older messages once the end of the history comes into view,
+        which it already is when the log is too short to fill the view.
+        :param top:
         :return:
         """
-        for label in self.labels_list:
-            label.destroy()
-        self.labels_list = []
+        self.top = max(0, min(top, len(self.message_log) - self.visible_rows))
+        self.redraw()
+        scrolled_to_end = bool(self.message_log) and self.top + self.visible_rows >= len(self.message_log)
+        if scrolled_to_end and self.has_older and not self.loading_older and self.request_older is not None:
+            if len(self.message_log) < self.max_messages:
+                self.loading_older = True
+                self.request_older(self.message_log[0].id)
 
-    def draw_new_message(self, message):
+    def redraw(self):
         """
-        Draws a new message and inserts it into the top of the frame.
-        :param side_to_insert:
+        Shows the messages that are scrolled to in the rows, and updates the scrollbar.
+        Rows already showing the right message are left alone.
+        :return:
+        """
+        total = len(self.message_log)
+        for row, label in enumerate(self.rows):
+            index = total - 1 - (self.top + row)
+            message = self.message_log[index] if index >= 0 else None
+            message_id = message.id if message is not None else None
+            if label.message_id == message_id:
+                continue
+            label.message_id = message_id
+            if message is None:
+                label.configure(text="")
+            elif message.sender.name == "server":
+                label.configure(text=f"{message.message}", text_color="red")
+            else:
+                label.configure(text=f"{message.sender.name}: {message.message}", text_color=label.default_text_color)
+
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.visible_rows) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def insert(self, message):
+        """
+        Adds a message to the log, in id order. Returns whether it was new.
         :param message:
         :return:
         """
-        if message.sender.name == "server":
-            label = customtkinter.CTkLabel(self, text=f"{message.message}", font=("Arial", 25), text_color="red")
+        if message.id in self.message_ids:
+            return False
+        self.message_ids.add(message.id)
+        if not self.message_log or message.id > self.message_log[-1].id:
+            self.message_log.append(message)
         else:
-            label = customtkinter.CTkLabel(
-                self,
-                text=f"{message.sender.name}: {message.message}",
-                font=("Arial", 25)
-            )
-        # label.grid(row=len(self.labels_list), column=0, padx=(0, 0), stick='w')
-        previous_label = None
-        if len(self.labels_list) > 0:
-            previous_label = self.labels_list[-1]
+            bisect.insort(self.message_log, message, key=lambda m: m.id)
+        return True
+
+    def forget_oldest(self):
+        """
+        Forgets the oldest messages past max_messages. They can be asked for again by scrolling back.
+        :return:
+        """
+        extra = len(self.message_log) - self.max_messages
+        if extra > 0:
+            for message in self.message_log[:extra]:
+                self.message_ids.discard(message.id)
+            del self.message_log[:extra]
+            self.has_older = True
+
+    def add_message(self, message):
+        """
+        Queues a new message to be drawn with the next frame.
+        Messages that are already in the log are ignored.
+        :param message:
+        :return:
+        """
+        self.apply_delta([message])
+
+    def apply_delta(self, messages):
+        """
+        Queues the messages that were missed since the last one in the log, to be drawn with the next frame.
+        :param messages:
+        :return:
+        """
+        self.pending.extend(messages)
+        if not self.frame_scheduled:
+            self.frame_scheduled = True
+            self.after(FRAME_MS, self.draw_frame)
 
-        label.pack(before=previous_label, anchor="w", side=TOP)
-        self.labels_list.append(label)
+    def draw_frame(self):
+        """
+        Adds every queued message to the log and redraws once for all of them.
+        Only follows the newest messages if the view was already showing them, otherwise it stays where it was.
+        :return:
+        """
+        start = time.perf_counter()
+        self.frame_scheduled = False
+        messages, self.pending = self.pending, []
+        added = sum(self.insert(message) for message in messages)
+        if added and self.top > 0:
+            self.top += added  # Keeps showing the same messages when scrolled back, instead of jumping.
+        self.forget_oldest()
+        self.scroll_to(self.top)
+        self.frame_stats.add(time.perf_counter() - start, len(messages))
+
+    def add_older_messages(self, messages, has_more):
+        """
+        Adds a page of messages older than everything in the log, drawing them below the rest.
+        :param messages:
+        :param has_more: Whether the server has even older messages.
+        :return:
+        """
+        self.loading_older = False
+        added = sum(self.insert(message) for message in messages)
+        # Nothing new would only get the same page again.
+        self.has_older = has_more and added > 0
+        # Asks for the next page straight away if the log still doesn't fill the view.
+        self.scroll_to(self.top)
 
-    def draw_all_messages(self):
+    def last_message_id(self):
         """
-        Takes everything in the message log and draws it to the screen.
-        First clears everything from the labels list.
+        Returns the id of the newest message in the log, or None if it's empty.
         :return:
         """
-        self.clear()
-        self.message_log.sort()
-        for message in self.message_log:  # Go in reverse
-            self.draw_new_message(message)
+        if not self.message_log:
+            return None
+        return self.message_log[-1].id
+
+    def merge_message_log(self, new_log):
+        """
+        Merges a whole log from the server into ours, only drawing the messages we didn't have.
+        If it doesn't connect to ours, with messages in between missing from both, it replaces ours instead.
+        Returns whether it was merged.
+        :param new_log:
+        :return:
+        """
+        newest = self.last_message_id()
+        if newest is not None and new_log and min(message.id for message in new_log) <= newest:
+            self.apply_delta(new_log)
+            return True
+        self.set_message_log(new_log)
+        return False
 
     def set_message_log(self, new_log):
         """
@@ -249,12 +467,20 @@ class ScrollableMessageBox(customtkinter.CTkScrollableFrame):
         :param new_log:
         :return:
         """
-        self.message_log = new_log
-        self.draw_all_messages()
+        self.pending = []  # Anything still queued belongs to the log being replaced.
+        self.message_log = sorted(new_log, key=lambda m: m.id)
+        self.message_ids = {message.id for message in self.message_log}
+        self.has_older = True
+        self.loading_older = False
+        self.forget_oldest()
+        self.scroll_to(0)
 
 
 class ClientApp(customtkinter.CTk):
-    def __init__(self, client, server_name, char_limit, name_char_limit, user_creation_allowed, max_shown):
+    def __init__(
+            self, client, server_name, char_limit, name_char_limit, user_creation_allowed, max_shown,
+            max_history=MAX_HISTORY, cache=None
+    ):
         super().__init__()
         self.server_name = server_name
         self.char_limit = char_limit
@@ -262,6 +488,8 @@ class ClientApp(customtkinter.CTk):
         self.user_creation_allowed = user_creation_allowed
         self.max_shown = max_shown
         self.client = client
+        self.cache = cache  # A MessageCache, or None if messages aren't cached.
+        self.logging_in = False  # Set while waiting on the server to answer a login.
 
         self.title(self.server_name)
         self.grid_rowconfigure(0, weight=1)
@@ -272,6 +500,8 @@ class ClientApp(customtkinter.CTk):
 
         self.message_box = ScrollableMessageBox(
             master=self,
+            request_older=self.request_older_messages,
+            max_messages=max_history,
             width=self.message_box_width
         )
 
@@ -318,6 +548,7 @@ class ClientApp(customtkinter.CTk):
             ("Info", self.server_info),
             ("Login", self.login_popup),
             ("Reload", self.resend_message_log),
+            ("Room", self.switch_room_popup),
             ("Logout", self.logout),
             ("Create User", self.create_user_popup),
             ("Quit", self.on_quit),
@@ -361,9 +592,32 @@ class ClientApp(customtkinter.CTk):
     def resend_message_log(self):
         """
         When the user presses the "reload" button.
+        Only asks for what was missed if there's a log already, the server falls back to a whole set if needed.
         :return:
         """
-        self.client.transport.write(message_log_set_request().encode())
+        last_id = self.message_box.last_message_id()
+        if last_id is None:
+            self.client.request_log()
+        else:
+            self.client.request_since(last_id)
+
+    def cached_messages(self, room):
+        """
+        Gets the messages of a room cached from earlier, oldest first.
+        :param room:
+        :return:
+        """
+        if self.cache is None:
+            return []
+        return self.cache.load(room)
+
+    def request_older_messages(self, before_id):
+        """
+        When the user scrolls to the end of the message history.
+        :param before_id:
+        :return:
+        """
+        self.client.request_history(before_id, HISTORY_PAGE_SIZE)
 
     def login_popup(self):
         """
@@ -373,15 +627,36 @@ class ClientApp(customtkinter.CTk):
         dialog = CredentialsPopup(self, title="Login")
         credentials = dialog.get_credentials()
         if credentials is not None:
-            self.client.transport.write(login_message(credentials[0], credentials[1]).encode())
+            self.logging_in = True
+            self.client.login(credentials[0], credentials[1])
 
     def logout(self):
         """
         When the user presses the "logout" button.
         :return:
         """
-        self.client.transport.write(logout_message().encode())
-        self.message_box.clear()
+        self.client.logout()
+        self.message_box.set_message_log([])
+        self.title(self.server_name)
+
+    def switch_room_popup(self):
+        """
+        When the user presses the "room" button.
+        Leaves the room being shown and joins the one asked for, showing its log instead.
+        :return:
+        """
+        if self.client.default_room is None:
+            Popup(self, "Server does not have rooms.", "Error")
+            return
+
+        dialog = customtkinter.CTkInputDialog(title="Switch room", text="Room name")
+        room = dialog.get_input()
+        if not room or room == self.client.room:
+            return
+
+        self.message_box.set_message_log(self.cached_messages(room))
+        self.client.switch_room(room)
+        self.title(f"{self.server_name} - {room}")
 
     def create_user_popup(self):
         """
@@ -399,7 +674,7 @@ class ClientApp(customtkinter.CTk):
         )
         credentials = dialog.get_credentials()
         if credentials is not None:
-            self.client.transport.write(create_user(credentials[0], credentials[1]).encode())
+            self.client.create_user(credentials[0], credentials[1])
 
     def log_message(self, event=None):
         """
@@ -409,5 +684,5 @@ class ClientApp(customtkinter.CTk):
         :param event:
         :return:
         """
-        self.client.transport.write(log_message(self.entry.get()).encode())
+        self.client.send_message(self.entry.get())
         self.entry.delete(0, END)
@@ -1,2 +1,22 @@
 class SessionError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the bytes sent by the other party can't be read as packets at all.
+    """
+    pass
+
+
+class RateLimitError(SessionError):
+    """
+    Raised when a client makes requests faster than it's allowed to.
+    """
+    def __init__(self, message, retry_after):
+        """
+        :param message:
+        :param retry_after: How many seconds until the request would be allowed.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,121 @@
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.logger import (
+    ILogObserver, LogLevel, FilteringLogObserver, LogLevelFilterPredicate, globalLogBeginner,
+    formatEventAsClassicLogText
+)
+from twisted.python.logfile import LogFile
+
+LOG_LEVELS = ("debug", "info", "warn", "error", "critical")
+FLUSH_BYTES = 64 * 1024  # Buffered lines are written once there are this many bytes of them, even between flushes.
+
+
+@implementer(ILogObserver)
+class BufferedLogFileObserver:
+    """
+    Writes log events to a rotating log file, a batch at a time instead of one write per line.
+    Errors are written straight away, so the lines leading up to a crash aren't lost with it.
+    """
+    def __init__(self, log_file, flush_interval=1.0, clock=reactor):
+        """
+        :param log_file: A twisted LogFile, which rotates itself once it gets too big.
+        :param flush_interval: How many seconds lines can wait in the buffer.
+        :param clock:
+        """
+        self.log_file = log_file
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.flush_loop = LoopingCall(self.flush)
+        self.flush_loop.clock = clock
+        self.flush_loop.start(flush_interval, now=False)
+
+    def __call__(self, event):
+        text = formatEventAsClassicLogText(event)
+        if not text:
+            return
+        data = text.encode("utf-8")
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        if self.buffered_bytes >= FLUSH_BYTES or event.get("log_level", LogLevel.info) >= LogLevel.error:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered line to the log file.
+        :return:
+        """
+        if self.buffer:
+            self.log_file.write(b"".join(self.buffer))
+            self.log_file.flush()
+            self.buffer = []
+            self.buffered_bytes = 0
+
+    def close(self):
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+        self.log_file.close()
+
+
+class PacketLogSampler:
+    """
+    Decides which of the log lines written for every single packet actually get logged.
+    Never logs them unless debug logging is on, and then only one in every so many.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.every = 1
+        self.count = 0
+
+    def __call__(self):
+        if not self.enabled:
+            return False
+        self.count += 1
+        return self.count % self.every == 0
+
+
+sample_packet_log = PacketLogSampler()
+
+
+def make_observer(path, level="info", rotate_bytes=10 * 1024 * 1024, max_rotated_files=5, flush_interval=1.0):
+    """
+    Makes an observer that writes every log event of level or above to a log file at path.
+    Returns the observer to log to, and the BufferedLogFileObserver behind it.
+    :param path:
+    :param level: One of LOG_LEVELS.
+    :param rotate_bytes: Size at which the log file gets rotated.
+    :param max_rotated_files: How many rotated log files to keep, older ones are deleted.
+    :param flush_interval: How many seconds lines can wait before being written.
+    :return:
+    """
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level {level!r}, expected one of {LOG_LEVELS}.")
+
+    log_file = LogFile.fromFullPath(path, rotateLength=rotate_bytes, maxRotatedFiles=max_rotated_files)
+    file_observer = BufferedLogFileObserver(log_file, flush_interval)
+    predicate = LogLevelFilterPredicate(defaultLogLevel=LogLevel.levelWithName(level))
+    return FilteringLogObserver(file_observer, [predicate]), file_observer
+
+
+def start_logging(path, settings):
+    """
+    Starts logging to the file at path, according to the [logging] table of the config.
+    :param path:
+    :param settings:
+    :return:
+    """
+    level = settings.get('level', "info")
+    observer, file_observer = make_observer(
+        path,
+        level,
+        settings.get('rotate_bytes', 10 * 1024 * 1024),
+        settings.get('max_rotated_files', 5),
+        settings.get('flush_interval_ms', 1000) / 1000,
+    )
+    sample_packet_log.enabled = level == "debug"
+    sample_packet_log.every = max(1, settings.get('debug_sample_rate', 1))
+    globalLogBeginner.beginLoggingTo([observer])
+    # After everything else, so whatever gets logged while shutting down makes it into the file too.
+    reactor.addSystemEventTrigger("after", "shutdown", file_observer.close)
+    return file_observer
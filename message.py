@@ -0,0 +1,51 @@
+class User:
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return type(other) == type(self) and self.name == other.name
+
+    def __repr__(self):
+        return f"{self.name}"
+
+
+class Message:
+    # Clients can hold tens of thousands of these, slots keep each one small and quick to make.
+    __slots__ = ("id", "sender", "message", "timestamp", "room")
+
+    def __init__(self, id: int, user: User, message: str, timestamp, room=None):
+        """
+        Represents a message from one user.
+        :param id:
+        :param user:
+        :param message:
+        :param timestamp:
+        :param room: Name of the room it was sent in, None when it isn't known, like on the client.
+        """
+        self.id = id
+        self.sender = user
+        self.message = message
+        self.timestamp = timestamp
+        self.room = room
+
+    def __lt__(self, other):
+        if type(other) != type(self):
+            return False
+
+        return self.timestamp < other.timestamp
+
+    def __repr__(self):
+        return f"{self.id}:{self.sender.name}:{self.timestamp}:{self.message}"
+
+    @staticmethod
+    def from_string(string):
+        """
+        converts into this class from a string
+        :param string:
+        :return:
+        """
+        # The message itself can contain colons, so only the first three separate fields.
+        message_id, sender, timestamp, message = string.split(":", 3)
+        return Message(int(message_id), User(sender), message, timestamp)
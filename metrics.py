@@ -0,0 +1,205 @@
+import bisect
+import threading
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+# The server's metrics, served in the Prometheus text format when [metrics] is enabled in the config.
+# Anything can record into the metrics below, they are only turned into text when they get scraped.
+
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+# In seconds, from tens of microseconds for decoding a packet, to seconds for a struggling disk.
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5,
+)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """
+    A number that only goes up, optionally one for every value of a label.
+    """
+    kind = "counter"
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        for label_value, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            if self.label is None:
+                yield self.name, value
+            else:
+                yield f'{self.name}{{{self.label}="{escape_label(label_value)}"}}', value
+
+
+class Gauge:
+    """
+    A number that can go up and down, read from a function whenever the metrics get scraped.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, description, function):
+        self.name = name
+        self.description = description
+        self.function = function
+
+    def samples(self):
+        yield self.name, self.function()
+
+
+class CounterFunction(Gauge):
+    """
+    A number that only goes up, kept by something else and read from a function whenever the metrics get scraped.
+    """
+    kind = "counter"
+
+
+class Histogram:
+    """
+    Counts how many observed values fell under each of its buckets, along with their sum.
+    Can be observed from any thread, the database threads time their commits with one.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is for values above every bucket.
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{format_value(float(bound))}"}}', cumulative
+        yield f"{self.name}_sum", total
+        yield f"{self.name}_count", cumulative
+
+
+class Registry:
+    """
+    Every metric the server exposes, by name.
+    A registry made with a parent also renders every metric of the parent, ahead of its own.
+    """
+    def __init__(self, parent=None):
+        """
+        :param parent: A registry of metrics shared with others, like the process wide one below.
+        """
+        self.parent = parent
+        self.metrics = {}
+
+    def register(self, metric):
+        """
+        Adds a metric, replacing any with the same name.
+        :param metric:
+        :return:
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, label=None):
+        return self.register(Counter(name, description, label))
+
+    def gauge(self, name, description, function):
+        return self.register(Gauge(name, description, function))
+
+    def counter_function(self, name, description, function):
+        return self.register(CounterFunction(name, description, function))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, buckets))
+
+    def all_metrics(self):
+        """
+        Yields the metrics of the parent, then this registry's own.
+        :return:
+        """
+        if self.parent is not None:
+            yield from self.parent.all_metrics()
+        yield from self.metrics.values()
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text format.
+        :return:
+        """
+        lines = []
+        for metric in self.all_metrics():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Recorded into from anywhere in the process. Metrics read from a factory or its session go in its own registry,
+# made with this one as its parent, so every factory's can be told apart.
+registry = Registry()
+packets_received = registry.counter("messenger_packets_received_total", "Packets received from clients.", "type")
+connections_total = registry.counter("messenger_connections_total", "Connections accepted since the server started.")
+decode_seconds = registry.histogram("messenger_packet_decode_seconds", "Time taken to decode a packet.")
+handle_seconds = registry.histogram(
+    "messenger_packet_handle_seconds", "Time from a packet being decoded to its reply, including database waits."
+)
+encode_seconds = registry.histogram("messenger_packet_encode_seconds", "Time taken to encode a packet.")
+db_insert_seconds = registry.histogram(
+    "messenger_db_insert_seconds", "Time from handing messages to the writer to them being committed."
+)
+sqlite_commit_seconds = registry.histogram("messenger_sqlite_commit_seconds", "Time taken by SQLite commits.")
+broadcast_seconds = registry.histogram(
+    "messenger_broadcast_fanout_seconds", "Time taken to send a batch of new messages to every member of their rooms."
+)
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics_registry):
+        super().__init__()
+        self.registry = metrics_registry
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", CONTENT_TYPE)
+        return self.registry.render().encode("utf-8")
+
+
+def listen_metrics(port, interface="127.0.0.1", metrics_registry=registry):
+    """
+    Serves the metrics over HTTP, at any path.
+    :param port:
+    :param interface: Address to listen on, only the local machine by default.
+    :param metrics_registry:
+    :return:
+    """
+    site = Site(MetricsResource(metrics_registry))
+    site.noisy = False
+    return reactor.listenTCP(port, site, interface=interface)
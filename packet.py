@@ -1,9 +1,10 @@
-import copy
+import struct
 import time
 from enum import Enum
 import json
 import zlib
-from session import Message
+from errors import ProtocolError
+from message import Message, User
 
 
 class PacketType(Enum):
@@ -15,40 +16,224 @@ class PacketType(Enum):
     MESSAGE_LOG_SET = "MESSAGE_LOG_SET"  # Sets a clients message log to that of the servers.
     MESSAGE_LOG_SET_REQUEST = "MESSAGE_LOG_SET_REQUEST"  # A way for clients to request to be sent a new message log set
     MESSAGE_LOG_ADDITION = "MESSAGE_LOG_ADDITION"  # Adds a new entry into the logs of each client.
+    MESSAGE_LOG_BATCH = "MESSAGE_LOG_BATCH"  # Adds several new entries into the logs of each client at once.
+    MESSAGE_LOG_SINCE_REQUEST = "MESSAGE_LOG_SINCE_REQUEST"  # Asks only for the messages after the last one a client has.
+    MESSAGE_LOG_SINCE = "MESSAGE_LOG_SINCE"  # The messages a client missed, or a note that it needs a whole new set.
+    MESSAGE_LOG_PAGE_REQUEST = "MESSAGE_LOG_PAGE_REQUEST"  # Asks for a page of the messages older than a given one.
+    MESSAGE_LOG_PAGE = "MESSAGE_LOG_PAGE"  # A page of older messages, for scrolling back through history.
     CREATE_USER = "CREATE_USER"  # Adds a new entry into the logs of each client.
     SERVER_INFO = "SERVER_INFO"  # The info the server sends to it's users about itself.
     SERVER_INFO_REQUEST = "SERVER_INFO_REQUEST"  # Asks the server for info about itself.
+    JOIN_ROOM = "JOIN_ROOM"  # Starts getting the messages of a room, and lets the client send to it.
+    LEAVE_ROOM = "LEAVE_ROOM"  # Stops getting the messages of a room.
+    RESYNC = "RESYNC"  # Tells a client it missed new messages while it was too slow, and should sync its log.
+
+
+# Optional protocol features. Clients list the ones they support in their SERVER_INFO_REQUEST,
+# and the server answers in SERVER_INFO with the ones that will be used on that connection.
+FEATURE_FRAMING = "framing"  # Every packet is prefixed with its length, see PacketBuffer.
+FEATURE_BATCH = "batch"  # New messages can arrive several at a time, in a MESSAGE_LOG_BATCH.
+FEATURE_ZLIB_STREAM = "zlib_stream"  # Binary packets are compressed with one zlib stream per connection.
+# Those streams start out seeded with PRESET_DICTIONARY. Versioned, as earlier builds offered "zlib_dictionary"
+# with other bytes.
+FEATURE_ZLIB_DICTIONARY = "zlib_dictionary_v2"
+FEATURE_RESYNC = "resync"  # Slow clients miss broadcasts and get a RESYNC, instead of being disconnected.
+FEATURE_COLUMNAR_LOG = "columnar_log"  # Messages are sent as fields, and logs as columns of them, instead of strings.
+SUPPORTED_FEATURES = (
+    FEATURE_FRAMING, FEATURE_BATCH, FEATURE_ZLIB_STREAM, FEATURE_ZLIB_DICTIONARY, FEATURE_RESYNC, FEATURE_COLUMNAR_LOG
+)
+
+FRAME_HEADER = struct.Struct("!I")  # Big-endian length of the packet that follows.
+MAX_PACKET_SIZE = 16 * 1024 * 1024  # Anything bigger than this, compressed or not, is treated as a broken peer.
+# Unframed packets can only be told apart by decompressing them, so they get a much smaller limit on what they
+# decompress to. Big enough for a whole message log from a server, servers allow clients far less.
+MAX_UNFRAMED_PACKET_SIZE = 4 * 1024 * 1024
+MAX_UNFRAMED_REQUEST_SIZE = 64 * 1024
+
+# Codecs, in order of preference. The first one a client also supports gets used on its connection.
+CODEC_BINARY = "binary"
+CODEC_JSON = "json"  # The original codec, every peer understands it.
+SUPPORTED_CODECS = (CODEC_BINARY, CODEC_JSON)
+
+# Byte used for each packet type by the binary codec. Never renumber these, only add new ones.
+PACKET_TYPE_CODES = {
+    PacketType.LOGIN_REQUEST: 1,
+    PacketType.LOGOUT_REQUEST: 2,
+    PacketType.LOG_MESSAGE: 3,
+    PacketType.SUCCESS: 4,
+    PacketType.ERROR: 5,
+    PacketType.MESSAGE_LOG_SET: 6,
+    PacketType.MESSAGE_LOG_SET_REQUEST: 7,
+    PacketType.MESSAGE_LOG_ADDITION: 8,
+    PacketType.CREATE_USER: 9,
+    PacketType.SERVER_INFO: 10,
+    PacketType.SERVER_INFO_REQUEST: 11,
+    PacketType.MESSAGE_LOG_BATCH: 12,
+    PacketType.MESSAGE_LOG_SINCE_REQUEST: 13,
+    PacketType.MESSAGE_LOG_SINCE: 14,
+    PacketType.MESSAGE_LOG_PAGE_REQUEST: 15,
+    PacketType.MESSAGE_LOG_PAGE: 16,
+    PacketType.JOIN_ROOM: 17,
+    PacketType.LEAVE_ROOM: 18,
+    PacketType.RESYNC: 19,
+}
+PACKET_TYPES_BY_CODE = {code: packet_type for packet_type, code in PACKET_TYPE_CODES.items()}
+
+BINARY_HEADER = struct.Struct("!BB")  # Packet type code, flags.
+FLAG_COMPRESSED = 0x01  # The fields of the packet are zlib compressed.
+FLAG_STREAM_COMPRESSED = 0x02  # The fields of the packet are compressed with the connection's zlib stream.
+COMPRESSION_THRESHOLD = 512  # Packets with fewer bytes of fields than this are never compressed.
+STREAM_COMPRESSION_THRESHOLD = 32  # A warmed up stream pays off much sooner, but not for empty packets.
+# Connection streams use a smaller window and less memory than zlib's defaults, there can be a lot of them.
+STREAM_WBITS = 12
+STREAM_MEM_LEVEL = 5
+
+SYNC_FLUSH_TRAILER = b"\x00\x00\xff\xff"  # Ends every sync flush, so it's left off the wire and put back on decode.
+
+REDACTED_FIELDS = ("password",)  # Never shown when a packet is turned into a string.
+MAX_LOGGED_FIELD_LENGTH = 200  # Longer fields are cut short when a packet is turned into a string.
+
+UINT8 = struct.Struct("!B")
+UINT32 = struct.Struct("!I")
+INT64 = struct.Struct("!q")
+DOUBLE = struct.Struct("!d")
+MAX_NESTING = 32  # How many lists and dicts can be nested in each other in a binary packet, more is a broken peer.
+
+
+# What connection streams get seeded with, so even their first packets compress well. The names of every packet
+# type, then common field names the way the binary codec writes them, the most common last as zlib favours the end.
+# Both ends need the exact same bytes, so this is never built from the lists above: changing a single byte means
+# bumping the version in FEATURE_ZLIB_DICTIONARY, so peers with the old bytes stop negotiating it.
+PRESET_DICTIONARY = (
+    b'LOGIN_REQUESTLOGOUT_REQUESTLOG_MESSAGESUCCESSERRORMESSAGE_LOG_SETMESSAGE_LOG_SET_REQUEST'
+    b'MESSAGE_LOG_ADDITIONMESSAGE_LOG_BATCHMESSAGE_LOG_SINCE_REQUESTMESSAGE_LOG_SINCEMESSAGE_LOG_PAGE_REQUEST'
+    b'MESSAGE_LOG_PAGECREATE_USERSERVER_INFOSERVER_INFO_REQUESTJOIN_ROOMLEAVE_ROOMRESYNC'
+    b'\x0bserver_name\nchar_limit\x0fname_char_limit\x15user_creation_allowed\tmax_shown\x08features\x05codec'
+    b'\x06codecs\x0cdefault_room\x08username\x04user\x08password\tbefore_id\x04size\x08has_more\x07last_id'
+    b'\x0etoo_far_behind\x0bretry_after\ttimestamp\x04room\x07content'
+)
+
+
+# Types a decoded field can have. Values have to be exactly one of them, so booleans never pass as ints.
+STRING = (str,)
+INTEGER = (int,)
+NUMBER = (int, float)
+BOOLEAN = (bool,)
+LIST = (list,)
+DICT = (dict,)
+TIMESTAMP = (int, float, str)  # Messages logged before timestamps were checked can have them as strings.
+# Timestamps sent by clients have to be finite, and small enough for SQLite to store as sent. NaN is never within.
+MAX_TIMESTAMP = 2.0 ** 53
+
+# The columns of a columnar message log, and the types of their values.
+MESSAGE_COLUMNS = {
+    "ids": INTEGER,
+    "senders": STRING,
+    "sender_indexes": INTEGER,
+    "timestamps": TIMESTAMP,
+    "texts": STRING,
+}
+
+
+def check_message_columns(columns):
+    """
+    Checks the columns of a message log all have the right types and the same length,
+    and that every sender index points at a sender. Raises a ProtocolError if not.
+    :param columns:
+    :return:
+    """
+    for name, types in MESSAGE_COLUMNS.items():
+        column = columns.get(name)
+        if type(column) is not list:
+            raise ProtocolError(f"Message log column {name} is missing.")
+        if not set(map(type, column)).issubset(types):
+            raise ProtocolError(f"Message log column {name} has values of the wrong type.")
+
+    length = len(columns["ids"])
+    if not len(columns["sender_indexes"]) == len(columns["timestamps"]) == len(columns["texts"]) == length:
+        raise ProtocolError("The columns of a message log have different lengths.")
+    sender_indexes = columns["sender_indexes"]
+    if sender_indexes and (min(sender_indexes) < 0 or max(sender_indexes) >= len(columns["senders"])):
+        raise ProtocolError("A message log points at a sender it doesn't have.")
 
 
 class JsonPacket:
     """
     A class to represent a certain kind of message, be it success or failure for example.
+    Every PacketType has a subclass of its own, see PACKET_CLASSES, declaring the fields its packets can have.
+    Fields that aren't given are None, and aren't sent.
     """
-    def __init__(self, m_type: PacketType = None, **kwargs):
-        self.type = m_type
-        self.__dict__.update(kwargs)
+    __slots__ = ()
+    type = None  # The PacketType of every packet of the class.
+    fields = {}  # Field names to the types their values can have, checked when a packet gets decoded.
+    required = ()  # Fields a packet can't be decoded without, the rest can be left out.
+
+    def __init__(self, **kwargs):
+        for name in self.fields:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(f"{type(self).__name__} has no fields called {', '.join(kwargs)}.")
+
+    def items(self):
+        """
+        Yields the name and value of every field this packet has.
+        Fields that are None are left out, so peers from before a field was added never see it.
+        :return:
+        """
+        for name in self.fields:
+            value = getattr(self, name)
+            if value is not None:
+                yield name, value
 
     def encode(self):
         """
         Converts this message into a json byte string.
         :return:
         """
-        data = copy.deepcopy(vars(self))
-        data['type'] = data['type'].name
+        data = dict(self.items())
+        data['type'] = self.type.name
         return zlib.compress(json.dumps(data).encode())
 
     @staticmethod
     def decode(byte_string):
         """
-        Decodes a byte string into a type of this class, returning an instance.
+        Decodes a byte string into the class of its type, returning an instance.
         :return:
         """
-        packet = JsonPacket()
-        raw_packet = json.loads(zlib.decompress(byte_string))
-        raw_packet['type'] = PacketType[raw_packet['type']]
-        packet.__dict__ = raw_packet
+        try:
+            raw_packet = json.loads(decompress(byte_string))
+            packet_class = PACKET_CLASSES[PacketType[raw_packet.pop('type')]]
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ProtocolError(f"Malformed json packet: {e!r}") from e
+        return packet_class.from_fields(raw_packet)
+
+    @classmethod
+    def from_fields(cls, raw_fields):
+        """
+        Makes a packet of this class out of its decoded fields, checking every one of them.
+        Raises a ProtocolError for a missing or mistyped field. Fields this class doesn't have are ignored.
+        :param raw_fields: Field names to their values.
+        :return:
+        """
+        packet = cls.__new__(cls)
+        for name, types in cls.fields.items():
+            value = raw_fields.get(name)
+            if value is None:
+                if name in cls.required:
+                    raise ProtocolError(f"{cls.type.name} packet is missing its {name}.")
+            elif type(value) not in types:
+                raise ProtocolError(f"The {name} of a {cls.type.name} packet can't be a {type(value).__name__}.")
+            setattr(packet, name, value)
+        packet.validate()
         return packet
 
+    def validate(self):
+        """
+        Checks whatever the types of the fields alone don't cover, raising a ProtocolError if something is wrong.
+        Called once a packet is decoded.
+        :return:
+        """
+
     @staticmethod
     def encode_message_log(log):
         """
@@ -76,30 +261,753 @@ class JsonPacket:
 
         return result
 
+    @staticmethod
+    def encode_message_columns(log):
+        """
+        Lays a list of messages out as columns, one list per field, with every sender's name only in there once.
+        Much quicker to decode than a string per message, and the binary codec packs every column in one go.
+        :param log:
+        :return:
+        """
+        senders = {}  # Names to their index in the senders column.
+        ids = []
+        sender_indexes = []
+        timestamps = []
+        texts = []
+        for message in log:
+            ids.append(message.id)
+            sender_indexes.append(senders.setdefault(message.sender.name, len(senders)))
+            timestamps.append(message.timestamp)
+            texts.append(message.message)
+        return {
+            "ids": ids,
+            "senders": list(senders),
+            "sender_indexes": sender_indexes,
+            "timestamps": timestamps,
+            "texts": texts,
+        }
+
+    @staticmethod
+    def decode_message_columns(columns):
+        """
+        Converts the columns of a message log back to a list of messages.
+        The columns have to be checked with check_message_columns first, decoding a packet does that.
+        :param columns:
+        :return:
+        """
+        # Messages from the same sender share one User.
+        users = [User(name) for name in columns["senders"]]
+        return [
+            Message(message_id, users[sender_index], text, timestamp)
+            for message_id, sender_index, timestamp, text in zip(
+                columns["ids"], columns["sender_indexes"], columns["timestamps"], columns["texts"]
+            )
+        ]
+
     def __str__(self):
-        return str(vars(self))
+        # Used in log lines, so it leaves out passwords and cuts long fields short.
+        fields = {"type": self.type}
+        for name, value in self.items():
+            if name in REDACTED_FIELDS:
+                value = "<redacted>"
+            elif isinstance(value, str) and len(value) > MAX_LOGGED_FIELD_LENGTH:
+                value = f"{value[:MAX_LOGGED_FIELD_LENGTH]}... <{len(value)} characters>"
+            elif isinstance(value, dict):
+                # Message log columns, which can hold thousands of messages.
+                text = str(value)
+                if len(text) > MAX_LOGGED_FIELD_LENGTH:
+                    value = f"{text[:MAX_LOGGED_FIELD_LENGTH]}... <{len(text)} characters>"
+            fields[name] = value
+        return str(fields)
 
 
-def server_info_request():
+class MessageLogPacket(JsonPacket):
+    """
+    A packet carrying a list of messages, either as strings in its content or as columns in its log.
+    """
+    __slots__ = ()
+
+    def validate(self):
+        if self.log is not None:
+            check_message_columns(self.log)
+        elif self.content is None:
+            raise ProtocolError(f"{self.type.name} packet has neither a content nor a log.")
+
+    def get_messages(self):
+        """
+        Returns the messages of this packet, whether they were sent as columns or as strings.
+        :return:
+        """
+        if self.log is not None:
+            return JsonPacket.decode_message_columns(self.log)
+        return JsonPacket.decode_message_log(self.content)
+
+
+class LoginRequestPacket(JsonPacket):
+    fields = {"user": STRING, "password": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.LOGIN_REQUEST
+    required = ("user", "password")
+
+
+class LogoutRequestPacket(JsonPacket):
+    __slots__ = ()
+    type = PacketType.LOGOUT_REQUEST
+
+
+class LogMessagePacket(JsonPacket):
+    fields = {"content": STRING, "timestamp": NUMBER, "room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.LOG_MESSAGE
+    required = ("content", "timestamp")
+
+    def validate(self):
+        if not -MAX_TIMESTAMP <= self.timestamp <= MAX_TIMESTAMP:
+            raise ProtocolError("LOG_MESSAGE packet has a timestamp that isn't a finite number of seconds.")
+
+
+class SuccessPacket(JsonPacket):
+    __slots__ = ()
+    type = PacketType.SUCCESS
+
+
+class ErrorPacket(JsonPacket):
+    fields = {"content": STRING, "retry_after": NUMBER}
+    __slots__ = tuple(fields)
+    type = PacketType.ERROR
+    required = ("content",)
+
+
+class MessageLogSetPacket(MessageLogPacket):
+    fields = {"content": STRING, "log": DICT, "room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_SET
+
+
+class MessageLogSetRequestPacket(JsonPacket):
+    fields = {"room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_SET_REQUEST
+
+
+class MessageLogAdditionPacket(JsonPacket):
+    # A message either as a string in content, or as the id, sender, timestamp and text fields.
+    fields = {
+        "content": STRING, "id": INTEGER, "sender": STRING, "timestamp": TIMESTAMP, "text": STRING, "room": STRING,
+    }
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_ADDITION
+
+    def validate(self):
+        if self.content is None and None in (self.id, self.sender, self.timestamp, self.text):
+            raise ProtocolError("MESSAGE_LOG_ADDITION packet has neither a content nor all the fields of a message.")
+
+    def get_message(self):
+        """
+        Returns the message of this packet, whether it was sent as fields or as a string.
+        :return:
+        """
+        if self.text is not None:
+            return Message(self.id, User(self.sender), self.text, self.timestamp)
+        return Message.from_string(self.content)
+
+
+class MessageLogBatchPacket(MessageLogPacket):
+    fields = {"content": STRING, "log": DICT, "room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_BATCH
+
+
+class MessageLogSinceRequestPacket(JsonPacket):
+    fields = {"last_id": INTEGER, "room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_SINCE_REQUEST
+    required = ("last_id",)
+
+
+class MessageLogSincePacket(MessageLogPacket):
+    fields = {"content": STRING, "log": DICT, "too_far_behind": BOOLEAN, "room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_SINCE
+    required = ("too_far_behind",)
+
+
+class MessageLogPageRequestPacket(JsonPacket):
+    fields = {"before_id": INTEGER, "size": INTEGER, "room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_PAGE_REQUEST
+    required = ("before_id", "size")
+
+    def validate(self):
+        if self.size < 1:
+            raise ProtocolError("MESSAGE_LOG_PAGE_REQUEST packet asks for a page of no messages.")
+
+
+class MessageLogPagePacket(MessageLogPacket):
+    fields = {"content": STRING, "log": DICT, "before_id": INTEGER, "has_more": BOOLEAN, "room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.MESSAGE_LOG_PAGE
+    required = ("before_id", "has_more")
+
+
+class CreateUserPacket(JsonPacket):
+    fields = {"username": STRING, "password": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.CREATE_USER
+    required = ("username", "password")
+
+
+class ServerInfoPacket(JsonPacket):
+    # Servers from before features, codecs and rooms leave those out.
+    fields = {
+        "server_name": STRING,
+        "char_limit": INTEGER,
+        "name_char_limit": INTEGER,
+        "user_creation_allowed": BOOLEAN,
+        "max_shown": INTEGER,
+        "features": LIST,
+        "codec": STRING,
+        "default_room": STRING,
+    }
+    __slots__ = tuple(fields)
+    type = PacketType.SERVER_INFO
+    required = ("server_name", "char_limit", "name_char_limit", "user_creation_allowed", "max_shown")
+
+
+class ServerInfoRequestPacket(JsonPacket):
+    # Clients from before features and codecs leave those out.
+    fields = {"features": LIST, "codecs": LIST}
+    __slots__ = tuple(fields)
+    type = PacketType.SERVER_INFO_REQUEST
+
+
+class JoinRoomPacket(JsonPacket):
+    fields = {"room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.JOIN_ROOM
+    required = ("room",)
+
+
+class LeaveRoomPacket(JsonPacket):
+    fields = {"room": STRING}
+    __slots__ = tuple(fields)
+    type = PacketType.LEAVE_ROOM
+    required = ("room",)
+
+
+class ResyncPacket(JsonPacket):
+    __slots__ = ()
+    type = PacketType.RESYNC
+
+
+PACKET_CLASSES = {
+    packet_class.type: packet_class
+    for packet_class in (
+        LoginRequestPacket, LogoutRequestPacket, LogMessagePacket, SuccessPacket, ErrorPacket, MessageLogSetPacket,
+        MessageLogSetRequestPacket, MessageLogAdditionPacket, MessageLogBatchPacket, MessageLogSinceRequestPacket,
+        MessageLogSincePacket, MessageLogPageRequestPacket, MessageLogPagePacket, CreateUserPacket, ServerInfoPacket,
+        ServerInfoRequestPacket, JoinRoomPacket, LeaveRoomPacket, ResyncPacket,
+    )
+}
+
+
+class PacketHandlers:
+    """
+    Packet types to the methods that handle them, for a class that handles packets.
+    Methods are registered in the class body with the handles decorator, and looked up by the packet's type:
+        handlers = PacketHandlers()
+
+        @handlers.handles(PacketType.SUCCESS)
+        def handle_success(self, packet):
+    Subclasses wanting to handle more types should register them on a copy, leaving their parent's alone.
+    """
+    def __init__(self, handlers=None):
+        self.handlers = dict(handlers or {})
+
+    def handles(self, *packet_types):
+        """
+        Returns a decorator registering a method as the handler of packet_types.
+        :param packet_types:
+        :return:
+        """
+        def register(method):
+            for packet_type in packet_types:
+                self.handlers[packet_type] = method
+            return method
+        return register
+
+    def get(self, packet_type):
+        """
+        Returns the method handling packet_type, None if nothing does.
+        :param packet_type:
+        :return:
+        """
+        return self.handlers.get(packet_type)
+
+    def copy(self):
+        return PacketHandlers(self.handlers)
+
+
+class JsonCodec:
+    """
+    The original codec. Packets are json objects, always zlib compressed.
+    """
+    name = CODEC_JSON
+
+    def encode(self, packet):
+        """
+        Encodes a packet into bytes.
+        :param packet:
+        :return:
+        """
+        return packet.encode()
+
+    def encode_shared(self, packet):
+        """
+        Encodes a packet so the same bytes can be sent to any connection using this codec.
+        :param packet:
+        :return:
+        """
+        return packet.encode()
+
+    def decode(self, data):
+        """
+        Decodes bytes back into a packet.
+        :param data:
+        :return:
+        """
+        return JsonPacket.decode(data)
+
+
+class BinaryCodec:
+    """
+    A compact codec. Every packet starts with its type code and a byte of flags, followed by its fields.
+    Each field is its name and a typed value, lists of a single type get packed in one go.
+    Only packets with more than COMPRESSION_THRESHOLD bytes of fields are compressed.
+
+    When streaming, every packet sent over the connection is compressed with one long lived zlib stream instead,
+    so field names, usernames and text repeated from earlier packets cost next to nothing.
+    """
+    name = CODEC_BINARY
+
+    def __init__(self, streaming=False, dictionary=None):
+        """
+        :param streaming: Whether to compress with a zlib stream kept for the whole connection.
+        :param dictionary: Bytes to seed the streams with, both ends need to use the same one.
+        """
+        self.streaming = streaming
+        self.compressor = None
+        self.decompressor = None
+        if streaming:
+            extra = {"zdict": dictionary} if dictionary else {}
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, STREAM_WBITS, STREAM_MEM_LEVEL, **extra)
+            self.decompressor = zlib.decompressobj(STREAM_WBITS, **extra)
+
+    def encode(self, packet):
+        """
+        Encodes a packet into bytes.
+        With streaming on, the result belongs to this connection's stream and can't be sent anywhere else.
+        :param packet:
+        :return:
+        """
+        if not self.streaming:
+            return self.encode_shared(packet)
+
+        body = self.encode_fields(packet)
+        if len(body) <= STREAM_COMPRESSION_THRESHOLD:
+            return BINARY_HEADER.pack(PACKET_TYPE_CODES[packet.type], 0) + body
+
+        # Once data went into the stream the other end needs to see it too, so this is sent even if it grew.
+        compressed_body = self.compressor.compress(body) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return BINARY_HEADER.pack(PACKET_TYPE_CODES[packet.type], FLAG_STREAM_COMPRESSED) + compressed_body[:-len(SYNC_FLUSH_TRAILER)]
+
+    def encode_shared(self, packet):
+        """
+        Encodes a packet without touching any stream, so the same bytes can be sent to any connection using this codec.
+        :param packet:
+        :return:
+        """
+        body = self.encode_fields(packet)
+        flags = 0
+        if len(body) > COMPRESSION_THRESHOLD:
+            compressed_body = zlib.compress(body)
+            if len(compressed_body) < len(body):
+                body = compressed_body
+                flags |= FLAG_COMPRESSED
+
+        return BINARY_HEADER.pack(PACKET_TYPE_CODES[packet.type], flags) + body
+
+    def encode_fields(self, packet):
+        """
+        Encodes every field of a packet, uncompressed.
+        :param packet:
+        :return:
+        """
+        body = bytearray()
+        for name, value in packet.items():
+            encoded_name = name.encode()
+            body += UINT8.pack(len(encoded_name))
+            body += encoded_name
+            self.write_value(body, value)
+        return body
+
+    def decode(self, data):
+        """
+        Decodes bytes back into a packet.
+        :param data:
+        :return:
+        """
+        try:
+            code, flags = BINARY_HEADER.unpack_from(data)
+            body = data[BINARY_HEADER.size:]
+            if flags & FLAG_COMPRESSED:
+                body = decompress(body)
+            elif flags & FLAG_STREAM_COMPRESSED:
+                if self.decompressor is None:
+                    raise ValueError("Got a stream compressed packet without streaming being negotiated.")
+                body = self.decompressor.decompress(body + SYNC_FLUSH_TRAILER, MAX_PACKET_SIZE)
+                if self.decompressor.unconsumed_tail:
+                    raise ProtocolError(f"Packet decompresses to more than {MAX_PACKET_SIZE} bytes.")
+
+            packet_class = PACKET_CLASSES[PACKET_TYPES_BY_CODE[code]]
+            raw_fields = {}
+            offset = 0
+            while offset < len(body):
+                name_length = body[offset]
+                name = body[offset + 1:offset + 1 + name_length].decode()
+                raw_fields[name], offset = self.read_value(body, offset + 1 + name_length)
+        except (struct.error, KeyError, IndexError, ValueError, zlib.error) as e:
+            raise ProtocolError(f"Malformed binary packet: {e}") from e
+        return packet_class.from_fields(raw_fields)
+
+    @staticmethod
+    def write_value(out, value):
+        """
+        Appends a value to out, prefixed by a byte saying what type it is.
+        :param out:
+        :param value:
+        :return:
+        """
+        if value is None:
+            out += b"N"
+        elif value is True:
+            out += b"T"
+        elif value is False:
+            out += b"F"
+        elif type(value) is int:
+            out += b"i"
+            out += INT64.pack(value)
+        elif type(value) is float:
+            out += b"f"
+            out += DOUBLE.pack(value)
+        elif type(value) is str:
+            data = value.encode()
+            out += b"s"
+            out += UINT32.pack(len(data))
+            out += data
+        elif isinstance(value, (list, tuple)):
+            BinaryCodec.write_list(out, value)
+        elif isinstance(value, dict):
+            out += b"d"
+            out += UINT32.pack(len(value))
+            for key, item in value.items():
+                BinaryCodec.write_value(out, str(key))
+                BinaryCodec.write_value(out, item)
+        else:
+            raise TypeError(f"Can't encode a value of type {type(value).__name__}.")
+
+    @staticmethod
+    def write_list(out, values):
+        """
+        Appends a list to out. Lists of only ints, floats or strings are packed together rather than item by item.
+        :param out:
+        :param values:
+        :return:
+        """
+        count = len(values)
+        if count and all(type(value) is int for value in values):
+            out += b"I"
+            out += UINT32.pack(count)
+            out += struct.pack(f"!{count}q", *values)
+        elif count and all(type(value) is float for value in values):
+            out += b"D"
+            out += UINT32.pack(count)
+            out += struct.pack(f"!{count}d", *values)
+        elif count and all(type(value) is str for value in values):
+            encoded_values = [value.encode() for value in values]
+            out += b"S"
+            out += UINT32.pack(count)
+            out += struct.pack(f"!{count}I", *map(len, encoded_values))
+            out += b"".join(encoded_values)
+        else:
+            out += b"l"
+            out += UINT32.pack(count)
+            for value in values:
+                BinaryCodec.write_value(out, value)
+
+    @staticmethod
+    def read_value(data, offset, depth=0):
+        """
+        Reads a value written by write_value, starting at offset.
+        Returns the value and the offset right after it.
+        :param data:
+        :param offset:
+        :param depth: How many lists and dicts the value is nested in.
+        :return:
+        """
+        tag = data[offset:offset + 1]
+        offset += 1
+        if tag == b"N":
+            return None, offset
+        if tag == b"T":
+            return True, offset
+        if tag == b"F":
+            return False, offset
+        if tag == b"i":
+            return INT64.unpack_from(data, offset)[0], offset + INT64.size
+        if tag == b"f":
+            return DOUBLE.unpack_from(data, offset)[0], offset + DOUBLE.size
+
+        count, = UINT32.unpack_from(data, offset)
+        offset += UINT32.size
+        if tag == b"s":
+            end = offset + count
+            if end > len(data):
+                raise ValueError("String runs past the end of the packet.")
+            return data[offset:end].decode(), end
+        if tag == b"I":
+            return list(struct.unpack_from(f"!{count}q", data, offset)), offset + count * INT64.size
+        if tag == b"D":
+            return list(struct.unpack_from(f"!{count}d", data, offset)), offset + count * DOUBLE.size
+        if tag == b"S":
+            lengths = struct.unpack_from(f"!{count}I", data, offset)
+            offset += count * UINT32.size
+            values = []
+            for length in lengths:
+                values.append(data[offset:offset + length].decode())
+                offset += length
+            if offset > len(data):
+                raise ValueError("Strings run past the end of the packet.")
+            return values, offset
+        if tag in (b"l", b"d") and depth >= MAX_NESTING:
+            raise ValueError(f"More than {MAX_NESTING} lists and dicts nested in each other.")
+        if tag == b"l":
+            values = []
+            for _ in range(count):
+                value, offset = BinaryCodec.read_value(data, offset, depth + 1)
+                values.append(value)
+            return values, offset
+        if tag == b"d":
+            values = {}
+            for _ in range(count):
+                key, offset = BinaryCodec.read_value(data, offset, depth + 1)
+                if type(key) is not str:
+                    raise ValueError(f"Dict key has to be a string, not {type(key).__name__}.")
+                values[key], offset = BinaryCodec.read_value(data, offset, depth + 1)
+            return values, offset
+        raise ValueError(f"Unknown value type {tag!r}.")
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec, JsonCodec)}
+
+
+def create_codec(name, features=()):
+    """
+    Creates the codec a connection will use, set up according to the features negotiated for it.
+    Streaming codecs keep state, so every connection needs its own instance.
+    :param name:
+    :param features:
+    :return:
+    """
+    if name == CODEC_BINARY and FEATURE_ZLIB_STREAM in features:
+        dictionary = PRESET_DICTIONARY if FEATURE_ZLIB_DICTIONARY in features else None
+        return BinaryCodec(streaming=True, dictionary=dictionary)
+    return CODECS[name]()
+
+
+def negotiate_codec(requested, framed):
+    """
+    Picks the codec to use with a client, out of the ones it asked for.
+    Only the json codec can be told apart without framing, so anything else needs framing.
+    :param requested:
+    :param framed:
+    :return:
+    """
+    if framed:
+        for codec in SUPPORTED_CODECS:
+            if codec in (requested or []):
+                return codec
+    return CODEC_JSON
+
+
+def frame(encoded_packet):
+    """
+    Prefixes an encoded packet with its length, so it can be told apart from the packets around it in a stream.
+    :param encoded_packet:
+    :return:
+    """
+    return FRAME_HEADER.pack(len(encoded_packet)) + encoded_packet
+
+
+def negotiate_features(requested, supported=SUPPORTED_FEATURES):
+    """
+    Picks the features out of the ones a client asked for that we also support, keeping our own order.
+    :param requested:
+    :param supported:
+    :return:
+    """
+    requested = requested or []
+    return [feature for feature in supported if feature in requested]
+
+
+def decompress(data, max_length=MAX_PACKET_SIZE):
+    """
+    Decompresses a whole zlib stream, raising a ProtocolError if it would come out bigger than max_length,
+    so a small packet can't be made to expand into gigabytes.
+    :param data:
+    :param max_length:
+    :return:
+    """
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, max_length)
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"Packet decompresses to more than {max_length} bytes.")
+    if not decompressor.eof:
+        raise ProtocolError("Packet is a truncated zlib stream.")
+    return result
+
+
+class PacketBuffer:
+    """
+    Collects the bytes read from a connection and splits them back into whole encoded packets.
+    Until framing is negotiated, packets are bare zlib streams and are split where each stream ends.
+    Once framed, every packet is read according to its length prefix.
+    """
+    def __init__(self, framed=False, max_unframed_size=MAX_UNFRAMED_PACKET_SIZE):
+        """
+        :param framed:
+        :param max_unframed_size: The most an unframed packet can decompress to.
+        """
+        self.framed = framed
+        self.buffer = bytearray()
+        self.max_unframed_size = max_unframed_size
+        # The unframed packet at the start of the buffer is decompressed as it arrives, only ever once.
+        self.decompressor = None
+        self.scanned = 0  # How much of the buffer the decompressor was given.
+        self.decompressed = 0  # How many bytes it decompressed to so far.
+
+    def feed(self, data):
+        """
+        Adds newly received data, returning an iterator over every packet that is now complete.
+        Anything left over is kept until the rest of it arrives.
+        :param data:
+        :return:
+        """
+        self.buffer += data
+        return self.packets()
+
+    def packets(self):
+        """
+        Yields every complete packet in the buffer, removing each from it as it goes.
+        Changing framed while iterating applies to the packets that follow.
+        Packets not yet iterated over stay in the buffer, to be picked up by a later call.
+        :return:
+        """
+        while self.buffer:
+            if self.framed:
+                end = self.framed_packet_end()
+                start = FRAME_HEADER.size
+            else:
+                end = self.legacy_packet_end()
+                start = 0
+
+            if end is None:
+                return
+
+            encoded_packet = bytes(self.buffer[start:end])
+            del self.buffer[:end]
+            yield encoded_packet
+
+    def framed_packet_end(self):
+        """
+        Returns where the first framed packet in the buffer ends, or None if it hasn't fully arrived yet.
+        :return:
+        """
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+
+        length, = FRAME_HEADER.unpack_from(self.buffer)
+        if length > MAX_PACKET_SIZE:
+            raise ProtocolError(f"Packet of {length} bytes is over the limit of {MAX_PACKET_SIZE}.")
+
+        end = FRAME_HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        return end
+
+    def legacy_packet_end(self):
+        """
+        Returns where the first unframed packet in the buffer ends, or None if it hasn't fully arrived yet.
+        Unframed packets carry no length, so this finds where the zlib stream of the packet finishes.
+        Only the bytes that arrived since the last call get decompressed.
+        :return:
+        """
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+            self.scanned = 0
+            self.decompressed = 0
+
+        data = bytes(self.buffer[self.scanned:])
+        self.scanned = len(self.buffer)
+        # One byte over the limit is enough to know it's been passed.
+        self.decompressed += len(self.decompressor.decompress(data, self.max_unframed_size - self.decompressed + 1))
+        if self.decompressed > self.max_unframed_size:
+            raise ProtocolError(f"Unframed packet decompresses to more than {self.max_unframed_size} bytes.")
+        if not self.decompressor.eof:
+            if len(self.buffer) > self.max_unframed_size:
+                raise ProtocolError(f"Unframed packet is over the limit of {self.max_unframed_size} bytes.")
+            return None
+
+        end = len(self.buffer) - len(self.decompressor.unused_data)
+        self.decompressor = None
+        return end
+
+
+def server_info_request(features=SUPPORTED_FEATURES, codecs=SUPPORTED_CODECS):
     """
     Function to request a server for it's info.
+    Also tells the server which optional features and codecs this client supports.
+    :param features:
+    :param codecs:
     :return:
     """
-    return JsonPacket(PacketType.SERVER_INFO_REQUEST)
+    return ServerInfoRequestPacket(features=list(features), codecs=list(codecs))
 
 
-def server_info(server_name: str, char_limit: int, name_char_limit: int, user_creation_allowed: bool, max_shown: int):
+def server_info(
+        server_name: str,
+        char_limit: int,
+        name_char_limit: int,
+        user_creation_allowed: bool,
+        max_shown: int,
+        features=(),
+        codec=CODEC_JSON,
+        default_room="general"
+):
     """
     A function that a JsonPacket ready to be sent to a client.
+    :param default_room: The room clients are put in when they log in.
     :return:
     """
-    return JsonPacket(
-        PacketType.SERVER_INFO,
+    return ServerInfoPacket(
         server_name=server_name,
         char_limit=char_limit,
         name_char_limit=name_char_limit,
         user_creation_allowed=user_creation_allowed,
-        max_shown=max_shown
+        max_shown=max_shown,
+        features=list(features),
+        codec=codec,
+        default_room=default_room
     )
 
 
@@ -110,25 +1018,27 @@ def login_message(user, password):
     :param password:
     :return:
     """
-    return JsonPacket(PacketType.LOGIN_REQUEST, user=user, password=password)
+    return LoginRequestPacket(user=user, password=password)
 
 
-def log_message(message):
+def log_message(message, room=None):
     """
     Creates a JsonPacket instance with needed information to log a message with the server.
     :param message:
+    :param room: The room to send it to, the server's default room if None.
     :return:
     """
-    return JsonPacket(PacketType.LOG_MESSAGE, content=message, timestamp=time.time())
+    return LogMessagePacket(content=message, timestamp=time.time(), room=room)
 
 
-def error_message(content):
+def error_message(content, retry_after=None):
     """
     Creates a JsonPacket instance that signifies an error occurred to the other party.
     :param content:
+    :param retry_after: For requests that were throttled, how many seconds until they would be allowed.
     :return:
     """
-    return JsonPacket(PacketType.ERROR, content=content)
+    return ErrorPacket(content=content, retry_after=retry_after)
 
 
 def success_message():
@@ -137,25 +1047,111 @@ def success_message():
     :param content:
     :return:
     """
-    return JsonPacket(PacketType.SUCCESS)
+    return SuccessPacket()
 
 
-def message_log_addition(content):
+def message_log_fields(messages, columnar=False):
+    """
+    Gets the fields that carry a list of messages in a packet, as columns or as the original list of strings.
+    :param messages:
+    :param columnar: Whether the client negotiated FEATURE_COLUMNAR_LOG.
+    :return:
+    """
+    if columnar:
+        return {"log": JsonPacket.encode_message_columns(messages)}
+    return {"content": JsonPacket.encode_message_log(messages)}
+
+
+def message_log_addition(content, columnar=False):
     """
     Creates a JsonPacket instance that updates all clients about a new message log.
     :param content:
+    :param columnar: Whether to send the message as fields, for clients that negotiated FEATURE_COLUMNAR_LOG.
+    :return:
+    """
+    if columnar:
+        return MessageLogAdditionPacket(
+            id=content.id,
+            sender=content.sender.name,
+            timestamp=content.timestamp,
+            text=content.message,
+            room=content.room
+        )
+    return MessageLogAdditionPacket(content=str(content), room=content.room)
+
+
+def message_log_batch(messages, columnar=False):
+    """
+    Creates a JsonPacket instance that adds several new messages to a clients log at once.
+    :param messages:
+    :param columnar: Whether the client negotiated FEATURE_COLUMNAR_LOG.
     :return:
     """
-    return JsonPacket(PacketType.MESSAGE_LOG_ADDITION, content=str(content))
+    return MessageLogBatchPacket(room=messages[0].room, **message_log_fields(messages, columnar))
 
 
-def message_log_set(log):
+def message_log_set(log, room=None, columnar=False):
     """
     Creates a JsonPacket instance that updates all clients about a new message log.
     :param log:
+    :param room: The room the log is of.
+    :param columnar: Whether the client negotiated FEATURE_COLUMNAR_LOG.
     :return:
     """
-    return JsonPacket(PacketType.MESSAGE_LOG_SET, content=JsonPacket.encode_message_log(log))
+    return MessageLogSetPacket(room=room, **message_log_fields(log, columnar))
+
+
+def message_log_since_request(last_id, room=None):
+    """
+    Requests only the messages that came after the last one this client has.
+    :param last_id: Id of the newest message the client has.
+    :param room: The room to get them from, the server's default room if None.
+    :return:
+    """
+    return MessageLogSinceRequestPacket(last_id=last_id, room=room)
+
+
+def message_log_since(messages, room=None, columnar=False):
+    """
+    Creates a JsonPacket instance with the messages a client missed.
+    Passing None instead tells the client it's too far behind, and should request a whole new message log set.
+    :param messages:
+    :param room: The room the messages are from.
+    :param columnar: Whether the client negotiated FEATURE_COLUMNAR_LOG.
+    :return:
+    """
+    if messages is None:
+        return MessageLogSincePacket(too_far_behind=True, room=room, **message_log_fields([], columnar))
+    return MessageLogSincePacket(too_far_behind=False, room=room, **message_log_fields(messages, columnar))
+
+
+def message_log_page_request(before_id, size, room=None):
+    """
+    Requests a page of the messages older than the one with the given id.
+    :param before_id: Id of the oldest message the client has.
+    :param size: How many messages to get, the server might send fewer.
+    :param room: The room to get them from, the server's default room if None.
+    :return:
+    """
+    return MessageLogPageRequestPacket(before_id=before_id, size=size, room=room)
+
+
+def message_log_page(messages, before_id, has_more, room=None, columnar=False):
+    """
+    Creates a JsonPacket instance with a page of older messages.
+    :param messages:
+    :param before_id: The id the page was requested before.
+    :param has_more: Whether there are even older messages left.
+    :param room: The room the messages are from.
+    :param columnar: Whether the client negotiated FEATURE_COLUMNAR_LOG.
+    :return:
+    """
+    return MessageLogPagePacket(
+        before_id=before_id,
+        has_more=has_more,
+        room=room,
+        **message_log_fields(messages, columnar)
+    )
 
 
 def logout_message():
@@ -163,15 +1159,16 @@ def logout_message():
     Creates a JsonPacket instance that can log out a user.
     :return:
     """
-    return JsonPacket(PacketType.LOGOUT_REQUEST)
+    return LogoutRequestPacket()
 
 
-def message_log_set_request():
+def message_log_set_request(room=None):
     """
     Requests that the current client be updated on the message log entirely.
+    :param room: The room to get the log of, the server's default room if None.
     :return:
     """
-    return JsonPacket(PacketType.MESSAGE_LOG_SET_REQUEST)
+    return MessageLogSetRequestPacket(room=room)
 
 
 def create_user(username, password):
@@ -181,5 +1178,31 @@ def create_user(username, password):
     :param password:
     :return:
     """
-    return JsonPacket(PacketType.CREATE_USER, username=username, password=password)
+    return CreateUserPacket(username=username, password=password)
+
+
+def resync():
+    """
+    Creates a JsonPacket instance telling a client it missed messages, and should sync its log again.
+    :return:
+    """
+    return ResyncPacket()
+
+
+def join_room(room):
+    """
+    Requests to join a room, creating it if nobody has yet.
+    :param room:
+    :return:
+    """
+    return JoinRoomPacket(room=room)
+
+
+def leave_room(room):
+    """
+    Requests to leave a room.
+    :param room:
+    :return:
+    """
+    return LeaveRoomPacket(room=room)
 
@@ -0,0 +1,138 @@
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from errors import RateLimitError
+from packet import PacketType
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, and up to burst of them at once after being idle.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """
+        Takes a token for one request.
+        Returns 0 if there was one, otherwise how many seconds until there will be.
+        :param now:
+        :return:
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+def parse_limits(limits):
+    """
+    Turns the limits of a [rate_limits] table of the config into packet types and their rate and burst.
+    A rate of 0, or a burst under 1, would never allow a request at all, so those are refused.
+    :param limits: Packet type names to tables with a rate and a burst.
+    :return:
+    """
+    parsed = {}
+    for name, limit in limits.items():
+        if name not in PacketType.__members__:
+            raise ValueError(f"Unknown packet type {name!r} in the rate limits.")
+        rate, burst = float(limit['rate']), float(limit.get('burst', 1))
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"The rate limit of {name} needs a rate above 0 and a burst of at least 1.")
+        parsed[PacketType[name]] = (rate, burst)
+    return parsed
+
+
+class RateLimiter:
+    """
+    Limits how fast each connection, and each IP address over all its connections, can make each kind of request.
+    With several workers, every worker counts the requests of an IP address on its own.
+    """
+    def __init__(self, connection_limits, ip_limits, clock=reactor):
+        """
+        :param connection_limits: Packet type names to tables with a rate and a burst, for every connection.
+        :param ip_limits: The same, for every IP address.
+        :param clock:
+        """
+        self.connection_limits = parse_limits(connection_limits)
+        self.ip_limits = parse_limits(ip_limits)
+        self.clock = clock
+        self.ip_buckets = {}  # (IP address, packet type) to its bucket.
+        self.throttled = 0  # Requests refused so far.
+
+    def check(self, protocol, packet_type):
+        """
+        Takes a token for a request, raising a RateLimitError if the connection or its IP address has none left.
+        Connections keep their own buckets in protocol.rate_buckets.
+        :param protocol:
+        :param packet_type:
+        :return:
+        """
+        now = self.clock.seconds()
+        retry_after = 0
+        if packet_type in self.connection_limits:
+            bucket = protocol.rate_buckets.get(packet_type)
+            if bucket is None:
+                bucket = protocol.rate_buckets[packet_type] = TokenBucket(*self.connection_limits[packet_type], now)
+            retry_after = bucket.take(now)
+
+        if not retry_after and packet_type in self.ip_limits:
+            key = (protocol.transport.getPeer().host, packet_type)
+            bucket = self.ip_buckets.get(key)
+            if bucket is None:
+                bucket = self.ip_buckets[key] = TokenBucket(*self.ip_limits[packet_type], now)
+            retry_after = bucket.take(now)
+
+        if retry_after:
+            self.throttled += 1
+            raise RateLimitError("Too many requests, slow down.", retry_after)
+
+    def prune(self):
+        """
+        Forgets the buckets of IP addresses that have been idle long enough to fill them back up.
+        :return:
+        """
+        now = self.clock.seconds()
+        for key in [key for key, bucket in self.ip_buckets.items() if bucket.full(now)]:
+            del self.ip_buckets[key]
+
+
+class LagMonitor:
+    """
+    Measures how late the reactor runs timed calls, which grows when it has more work than it can keep up with.
+    """
+    def __init__(self, interval=0.1, clock=reactor):
+        """
+        :param interval: How often to measure, in seconds.
+        :param clock:
+        """
+        self.interval = interval
+        self.clock = clock
+        self.lag = 0.0  # In seconds, of the latest measurement.
+        self.last_run = None
+        self.loop = LoopingCall(self.tick)
+        self.loop.clock = clock
+
+    def start(self):
+        self.last_run = self.clock.seconds()
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        now = self.clock.seconds()
+        self.lag = max(0.0, now - self.last_run - self.interval)
+        self.last_run = now
@@ -0,0 +1,101 @@
+from collections import deque
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+POLICY_DROP = "drop"  # Drop the broadcasts waiting for a slow client, and tell it to resync once it catches up.
+POLICY_DISCONNECT = "disconnect"  # Disconnect a slow client.
+SLOW_CONSUMER_POLICIES = (POLICY_DROP, POLICY_DISCONNECT)
+
+
+@implementer(IPushProducer)
+class SendQueue:
+    """
+    Holds what a connection sends while its transport can't keep up, counting how many bytes are waiting.
+    Registered as the producer of the transport, which pauses it whenever its own buffer fills up.
+    Once more than high_watermark bytes are waiting, on_overflow is called.
+    Once back under low_watermark, on_drained is called.
+    """
+    def __init__(self, transport, high_watermark, low_watermark, on_overflow, on_drained):
+        """
+        :param transport: The transport of the connection.
+        :param high_watermark: How many bytes can be waiting before the connection is considered slow.
+        :param low_watermark: How few bytes need to be waiting for it to stop being considered slow.
+        :param on_overflow: Called with no arguments when going over high_watermark.
+        :param on_drained: Called with no arguments when back under low_watermark, after an overflow.
+        """
+        self.transport = transport
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.on_overflow = on_overflow
+        self.on_drained = on_drained
+        self.chunks = deque()  # (data, droppable) waiting for the transport.
+        self.pending_bytes = 0
+        self.paused = False  # Set while the transport's buffer is full.
+        self.overflowed = False
+        self.dropped_bytes = 0  # Droppable data thrown away instead of sent, see drop and discard.
+        self.dropped_chunks = 0
+
+    def write(self, data, droppable=False):
+        """
+        Writes data to the transport, or queues it if the transport can't take more right now.
+        :param data:
+        :param droppable: Whether the data can be dropped if the client falls too far behind.
+        :return:
+        """
+        if not self.paused and not self.chunks:
+            self.transport.write(data)
+            return
+
+        self.chunks.append((data, droppable))
+        self.pending_bytes += len(data)
+        if not self.overflowed and self.pending_bytes > self.high_watermark:
+            self.overflowed = True
+            self.on_overflow()
+
+    def drop(self):
+        """
+        Drops every droppable chunk still waiting.
+        Returns how many were dropped.
+        :return:
+        """
+        kept = deque()
+        dropped = 0
+        for data, droppable in self.chunks:
+            if droppable:
+                dropped += 1
+                self.dropped_bytes += len(data)
+                self.pending_bytes -= len(data)
+            else:
+                kept.append((data, droppable))
+        self.chunks = kept
+        self.dropped_chunks += dropped
+        return dropped
+
+    def discard(self, size):
+        """
+        Counts a droppable chunk of size bytes as dropped, without it ever being queued.
+        Used for what's thrown away while the connection is still catching up.
+        :param size:
+        :return:
+        """
+        self.dropped_chunks += 1
+        self.dropped_bytes += size
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        # Writing can pause this again straight away, once the transport's buffer fills back up.
+        while self.chunks and not self.paused:
+            data, droppable = self.chunks.popleft()
+            self.pending_bytes -= len(data)
+            self.transport.write(data)
+
+        if self.overflowed and self.pending_bytes <= self.low_watermark:
+            self.overflowed = False
+            self.on_drained()
+
+    def stopProducing(self):
+        self.chunks.clear()
+        self.pending_bytes = 0
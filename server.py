@@ -1,47 +1,291 @@
 #!/usr/bin/env python3
 import os
 import sys
-from twisted.internet import protocol, reactor
-from twisted.internet.endpoints import TCP4ServerEndpoint
+import socket
+import time
+import argparse
+from twisted.internet import protocol, reactor, defer
+from twisted.internet.endpoints import TCP4ServerEndpoint, UNIXClientEndpoint
+from twisted.internet.task import LoopingCall
 from session import *
+from broadcast import BroadcastScheduler
+from cache import MessageLogCache
+from bus import HubFactory, connect_bus
+from sendqueue import SendQueue, POLICY_DISCONNECT
+from ratelimit import RateLimiter, LagMonitor
+from logs import start_logging, sample_packet_log
+from metrics import (
+    Registry, registry, listen_metrics, packets_received, connections_total, decode_seconds, handle_seconds,
+    encode_seconds
+)
 from packet import *
-from twisted.python import log
-import traceback
-from errors import SessionError
+from twisted.logger import Logger
+from errors import SessionError, ProtocolError, RateLimitError
 import toml
 from constants import CONFIG_FILE, DOCKER_ENV_KEY
 
+log = Logger()
+
+# Corked replies are written out once this many bytes are waiting, so a slow client's send queue still sees them
+# pile up, and reading from it pauses before a batch of pipelined requests is done.
+MAX_OUTBOX_BYTES = 64 * 1024
+
 
 class MessagingProtocol(protocol.Protocol):
-    def __init__(self, session: ServerSession):
+    handlers = PacketHandlers()  # Packet types to the methods handling them, see handle_message.
+
+    def __init__(self, session: ServerSession, broadcaster: BroadcastScheduler):
         self.session = session
+        self.broadcaster = broadcaster
         self.logged_in = False
+        self.packet_buffer = PacketBuffer(max_unframed_size=MAX_UNFRAMED_REQUEST_SIZE)
+        self.features = []
+        self.codec = create_codec(CODEC_JSON)
+        self.negotiated = False  # Set once SERVER_INFO went out, features and codec can't change after that.
+        self.outbox = []  # Encoded data waiting to go out in the next write.
+        self.outbox_bytes = 0
+        self.corked = False  # While set, sent packets are held in the outbox instead of written right away.
+        self.waiting = False  # Set while a packet waits on the database, later packets are held until it's done.
+        self.broken = False
+        self.aborted = False  # Set once the connection was aborted for being too slow.
+        self.disconnected = False
+        self.send_queue = None  # Made once connected, see SendQueue.
+        self.dropping = False  # Set while broadcasts are dropped, as this client fell too far behind.
+        self.read_pauses = set()  # Reasons reading from the client is paused for, it resumes once there are none.
+        self.rate_buckets = {}  # Packet types to the token bucket limiting them, see RateLimiter.
+
+    @property
+    def framed(self):
+        return self.packet_buffer.framed
 
     def connectionMade(self):
-        log.msg(f"Client connected: {self.transport.getPeer()}")
+        log.info("Client connected: {peer}", peer=self.transport.getPeer())
+        connections_total.inc()
+        self.factory.connections.add(self)
+        self.send_queue = SendQueue(
+            self.transport,
+            self.session.send_queue_high_bytes,
+            self.session.send_queue_low_bytes,
+            self.send_queue_overflowed,
+            self.send_queue_drained,
+        )
+        self.transport.registerProducer(self.send_queue, True)
+
+    def pause_reading(self, reason):
+        """
+        Stops reading from the client until resume_reading is called with the same reason.
+        :param reason:
+        :return:
+        """
+        if not self.read_pauses:
+            self.transport.pauseProducing()
+        self.read_pauses.add(reason)
+
+    def resume_reading(self, reason):
+        """
+        Reads from the client again, unless it's still paused for another reason.
+        :param reason:
+        :return:
+        """
+        self.read_pauses.discard(reason)
+        if not self.read_pauses and not self.disconnected:
+            self.transport.resumeProducing()
+            # Requests read before the pause are still waiting in the buffer.
+            self.handle_buffered_packets()
+
+    def send_queue_overflowed(self):
+        """
+        Called when the client stopped reading what's sent to it fast enough.
+        New requests aren't read until it catches up, so its replies can't pile up either.
+        Broadcasts are dropped, or the client disconnected, depending on the slow consumer policy.
+        :return:
+        """
+        if self.session.slow_consumer_policy == POLICY_DISCONNECT or FEATURE_RESYNC not in self.features:
+            # Clients that can't resync would never find out they missed messages.
+            log.warn("Disconnecting slow client, {pending} bytes waiting for it.", pending=self.send_queue.pending_bytes)
+            self.aborted = True
+            self.transport.abortConnection()
+            return
+
+        dropped = self.send_queue.drop()
+        self.dropping = True
+        log.warn(
+            "Client is too slow, dropped {dropped} broadcasts. {pending} bytes still waiting.",
+            dropped=dropped,
+            pending=self.send_queue.pending_bytes
+        )
+        self.pause_reading("send_queue")
+
+    def send_queue_drained(self):
+        """
+        Called when a client that fell behind caught up again.
+        :return:
+        """
+        if self.dropping:
+            self.dropping = False
+            self.send(resync())
+        self.resume_reading("send_queue")
 
     def dataReceived(self, data: bytes):
-        log.msg("Data received")
+        if sample_packet_log():
+            log.debug("Data received, {size} bytes.", size=len(data))
+        self.packet_buffer.feed(data)
+        if not self.waiting:
+            self.handle_buffered_packets()
+
+    def handle_buffered_packets(self):
+        """
+        Handles the packets waiting in the buffer, in order.
+        Stops at a packet that has to wait on the database, and stops reading from the client until it's done,
+        so replies always go out in the order the requests came in.
+        Also stops once reading is paused for any other reason, the rest is handled when it resumes.
+        :return:
+        """
+        if self.read_pauses or self.broken or self.aborted or self.disconnected:
+            return
+
+        # Replies to everything handled here, successes included, go out together in as few writes as possible.
+        self.corked = True
         try:
-            self.handle_message(data)
-        except SessionError as e:
-            log.err(f"Session Error: {str(e)}")
-            self.transport.write(error_message(str(e)).encode())
-        except zlib.error as e:
-            log.err("Client seems to be broken. Notifying and breaking connection.")
-            message = "\nYour client seems to broken or malformed.\n"
-            self.transport.write(error_message(message).encode())
-            self.transport.write(message.encode())  # Sending as plaintext so it pops up in their console.
-            self.transport.loseConnection()
-        except Exception as e:
-            log.err(e, "".join(traceback.format_exception(e)))
-            self.transport.write(error_message("Internal Server Error").encode())
+            for encoded_packet in self.packet_buffer.packets():
+                d = self.handle_packet(encoded_packet)
+                if self.broken or self.aborted:
+                    break
+                if not d.called:
+                    self.waiting = True
+                    self.pause_reading("database")
+                    d.addCallback(self.finished_waiting)
+                    break
+                if self.read_pauses:
+                    break
+        except (zlib.error, ProtocolError):
+            self.drop_broken_client()
+        finally:
+            self.corked = False
+            self.flush_outbox()
+
+    def finished_waiting(self, _):
+        """
+        Picks up handling the buffered packets again, once one that waited on the database is done.
+        :param _:
+        :return:
+        """
+        self.waiting = False
+        if not self.disconnected:
+            self.resume_reading("database")
+
+    def handle_packet(self, encoded_packet):
+        """
+        Handles a single encoded packet, reporting how it went back to the client.
+        Returns a Deferred that fires once it's handled, which it might already be.
+        :param encoded_packet:
+        :return:
+        """
+        start = time.perf_counter()
+        d = defer.maybeDeferred(self.handle_message, encoded_packet)
+        d.addCallbacks(self.request_succeeded, self.request_failed)
+        d.addCallback(lambda _: handle_seconds.observe(time.perf_counter() - start))
+        return d
+
+    def request_succeeded(self, _):
+        self.send(success_message())
+
+    def request_failed(self, failure):
+        """
+        Reports an error that happened while handling a packet back to the client.
+        :param failure:
+        :return:
+        """
+        if failure.check(RateLimitError):
+            log.info("Throttled: {error}", error=failure.getErrorMessage())
+            self.send(error_message(failure.getErrorMessage(), round(failure.value.retry_after, 3)))
+        elif failure.check(SessionError):
+            log.info("Session Error: {error}", error=failure.getErrorMessage())
+            self.send(error_message(failure.getErrorMessage()))
+        elif failure.check(zlib.error, ProtocolError):
+            log.info("Malformed packet: {error}", error=failure.getErrorMessage())
+            self.drop_broken_client()
+        else:
+            log.failure("Error while handling a message", failure)
+            self.send(error_message("Internal Server Error"))
+
+    def drop_broken_client(self):
+        """
+        Notifies a client that it's sending garbage and closes the connection.
+        :return:
+        """
+        log.warn("Client seems to be broken. Notifying and breaking connection.")
+        self.broken = True
+        message = "\nYour client seems to broken or malformed.\n"
+        self.send(error_message(message))
+        self.flush_outbox()
+        self.send_queue.write(message.encode())  # Sending as plaintext so it pops up in their console.
+        self.transport.loseConnection()
+
+    def send(self, packet):
+        """
+        Encodes a packet with this connection's codec and sends it to this client.
+        :param packet:
+        :return:
+        """
+        start = time.perf_counter()
+        encoded_packet = self.codec.encode(packet)
+        encode_seconds.observe(time.perf_counter() - start)
+        self.send_encoded(encoded_packet)
+
+    def send_encoded(self, *encoded_packets):
+        """
+        Sends already encoded packets in one write, framing them if this connection uses framing.
+        Lets one encoding of a packet be shared between many clients.
+        :param encoded_packets:
+        :return:
+        """
+        for encoded_packet in encoded_packets:
+            if self.framed:
+                self.outbox.append(FRAME_HEADER.pack(len(encoded_packet)))
+            self.outbox.append(encoded_packet)
+            self.outbox_bytes += len(encoded_packet)
+
+        if not self.corked or self.outbox_bytes >= MAX_OUTBOX_BYTES:
+            self.flush_outbox()
+
+    def broadcast_encoded(self, *encoded_packets):
+        """
+        Sends already encoded broadcasts, which get dropped instead if this client fell too far behind.
+        Only packets encoded without the connection's zlib stream can be dropped, so it never misses any of those.
+        :param encoded_packets:
+        :return:
+        """
+        data = []
+        for encoded_packet in encoded_packets:
+            if self.framed:
+                data.append(FRAME_HEADER.pack(len(encoded_packet)))
+            data.append(encoded_packet)
+        if self.dropping:
+            self.send_queue.discard(sum(len(part) for part in data))
+            return
+
+        self.flush_outbox()
+        self.send_queue.write(b"".join(data), droppable=True)
+
+    def flush_outbox(self):
+        """
+        Writes everything waiting in the outbox to the transport at once.
+        :return:
+        """
+        if self.outbox:
+            self.send_queue.write(b"".join(self.outbox))
+            self.outbox = []
+            self.outbox_bytes = 0
 
     def connectionLost(self, reason):
-        log.msg(f"Connection lost. {reason!r}")
+        log.info("Connection lost. {reason!r}", reason=reason)
+        self.disconnected = True
+        self.factory.connections.discard(self)
+        if self.send_queue is not None:
+            self.factory.connection_closed(self.send_queue)
         if self.logged_in:
-            user = self.session.logout_user(self)
-            self.send_server_message(self.session.abrupt_leave_announcement.format(user=user))
+            self.log_out(self.session.abrupt_leave_announcement)
 
     def handle_message(self, data):
         """
@@ -49,91 +293,347 @@ class MessagingProtocol(protocol.Protocol):
         :param data:
         :return:
         """
-        message = JsonPacket.decode(data)
-        log.msg(f"Handling message: {message}")
-        match message.type:
-            case PacketType.LOGIN_REQUEST:
-                if self.logged_in:
-                    raise SessionError("Already logged in!")
+        start = time.perf_counter()
+        message = self.codec.decode(data)
+        decode_seconds.observe(time.perf_counter() - start)
+        packets_received.inc(message.type.name)
+        if sample_packet_log():
+            log.debug("Handling message: {message}", message=message)
+        self.factory.rate_limiter.check(self, message.type)
+        handler = self.handlers.get(message.type)
+        if handler is None:
+            log.info("Improper Request")
+            raise SessionError("Improper request.")
+        return handler(self, message)
+
+    @handlers.handles(PacketType.LOGIN_REQUEST)
+    def handle_login_request(self, message):
+        if self.logged_in:
+            raise SessionError("Already logged in!")
+        self.factory.check_admission()
+
+        return self.session.login_user(message.user, message.password, self).addCallback(self.logged_in_as)
+
+    @handlers.handles(PacketType.LOGOUT_REQUEST)
+    def handle_logout_request(self, message):
+        if not self.logged_in:
+            raise SessionError("You need to login first.")
+
+        self.log_out(self.session.leave_announcement)
+
+    @handlers.handles(PacketType.LOG_MESSAGE)
+    def handle_log_message(self, message):
+        if not self.logged_in:
+            raise SessionError("You need to be logged in to send messages.")
 
-                self.session.login_user(message.user, message.password, self)
-                log.msg("Syncing login message logs...")
-                log.msg(self.session.logged_in_users)
-                self.logged_in = True
-                self.send_server_message(self.session.join_announcement.format(user=message.user))
+        d = self.session.log_message(message, self, message.room)
+        return d.addCallback(self.update_all_client_logs)
 
-            case PacketType.LOGOUT_REQUEST:
-                if not self.logged_in:
-                    raise SessionError("You need to login first.")
+    @handlers.handles(PacketType.MESSAGE_LOG_SET_REQUEST)
+    def handle_log_set_request(self, message):
+        if not self.logged_in:
+            raise SessionError("You need to be logged in to see messages.")
 
-                user = self.session.logout_user(self)
-                self.logged_in = False
-                self.send_server_message(self.session.leave_announcement.format(user=user))
+        room = self.session.get_member_room(self, message.room)
+        self.send_encoded(
+            self.factory.get_log_cache(room.name).get(self.codec, FEATURE_COLUMNAR_LOG in self.features)
+        )
 
-            case PacketType.LOG_MESSAGE:
-                if not self.logged_in:
-                    raise SessionError("You need to be logged in to send messages.")
+    @handlers.handles(PacketType.MESSAGE_LOG_SINCE_REQUEST)
+    def handle_since_request(self, message):
+        if not self.logged_in:
+            raise SessionError("You need to be logged in to see messages.")
 
-                self.session.log_message(message, self)
-                self.update_all_client_logs(self.session.get_latest_message())
+        room = self.session.get_member_room(self, message.room)
+        messages = self.session.get_messages_since(message.last_id, room.name)
+        self.send(message_log_since(messages, room.name, FEATURE_COLUMNAR_LOG in self.features))
 
-            case PacketType.MESSAGE_LOG_SET_REQUEST:
-                if not self.logged_in:
-                    raise SessionError("You need to be logged in to see messages.")
+    @handlers.handles(PacketType.MESSAGE_LOG_PAGE_REQUEST)
+    def handle_page_request(self, message):
+        if not self.logged_in:
+            raise SessionError("You need to be logged in to see messages.")
 
-                self.transport.write(message_log_set(self.session.get_message_log()).encode())
+        room = self.session.get_member_room(self, message.room)
+        columnar = FEATURE_COLUMNAR_LOG in self.features
 
-            case PacketType.CREATE_USER:
-                self.session.create_new_user(message.username, message.password)
+        def send_page(page):
+            messages, has_more = page
+            self.send(message_log_page(messages, message.before_id, has_more, room.name, columnar))
 
-            case PacketType.SERVER_INFO_REQUEST:
-                self.transport.write(
-                    server_info(
-                        self.session.server_name,
-                        self.session.msg_char_limit,
-                        self.session.name_char_limit,
-                        self.session.allow_user_creation,
-                        self.session.max_shown_messages
-                    ).encode()
-                )
+        d = self.session.get_message_page(message.before_id, message.size, room.name)
+        d.addCallback(send_page)
+        return d
 
-            case _:
-                log.err("Improper Request")
-                self.transport.write(error_message("Improper request.").encode())
-                return
+    @handlers.handles(PacketType.JOIN_ROOM)
+    def handle_join_room(self, message):
+        if not self.logged_in:
+            raise SessionError("You need to login first.")
+
+        announcement = self.session.join_announcement.format(user=self.session.logged_in_users[self])
+        d = self.session.join_room(self, message.room)
+        d.addCallback(lambda room: self.send_server_message(announcement, room.name))
+        return d
+
+    @handlers.handles(PacketType.LEAVE_ROOM)
+    def handle_leave_room(self, message):
+        if not self.logged_in:
+            raise SessionError("You need to login first.")
+
+        room = self.session.leave_room(self, message.room)
+        user = self.session.logged_in_users[self]
+        self.send_server_message(self.session.leave_announcement.format(user=user), room.name)
+
+    @handlers.handles(PacketType.CREATE_USER)
+    def handle_create_user(self, message):
+        return self.session.create_new_user(message.username, message.password)
+
+    @handlers.handles(PacketType.SERVER_INFO_REQUEST)
+    def handle_server_info_request(self, message):
+        if self.negotiated:
+            # Another codec or zlib stream would take over halfway through packets already sent with the current one.
+            raise SessionError("Server info was already sent, the protocol can't be changed on the same connection.")
+
+        # Older clients don't send features or codecs, and get the original unframed json protocol.
+        self.features = negotiate_features(message.features, self.factory.offered_features)
+        framed = FEATURE_FRAMING in self.features
+        codec = negotiate_codec(message.codecs, framed)
+        if codec != CODEC_BINARY:
+            # Only binary packets have room to say how they were compressed.
+            self.features = [f for f in self.features if f not in (FEATURE_ZLIB_STREAM, FEATURE_ZLIB_DICTIONARY)]
+        self.send(
+            server_info(
+                self.session.server_name,
+                self.session.msg_char_limit,
+                self.session.name_char_limit,
+                self.session.allow_user_creation,
+                self.session.max_shown_messages,
+                self.features,
+                codec,
+                self.session.default_room
+            )
+        )
+        # The info itself still goes out the old way, everything after it follows what was negotiated.
+        self.packet_buffer.framed = framed
+        self.codec = create_codec(codec, self.features)
+        self.negotiated = True
+
+    def logged_in_as(self, user):
+        """
+        Finishes logging in, once the session accepted the credentials.
+        :param user:
+        :return:
+        """
+        if self.disconnected:
+            # The client left while its login was being checked.
+            self.session.logout_user(self)
+            return
+        log.info("{user} logged in.", user=user)
+        self.logged_in = True
+        # Everyone starts out in the default room, clients from before rooms never leave it.
+        announcement = self.session.join_announcement.format(user=user.name)
+        d = self.session.join_room(self)
+        d.addCallback(lambda room: self.send_server_message(announcement, room.name))
+        return d
 
-        self.transport.write(success_message().encode())
+    def log_out(self, announcement):
+        """
+        Logs out, announcing it with the given announcement in every room the user was in.
+        :param announcement:
+        :return:
+        """
+        rooms = self.session.leave_all_rooms(self)
+        user = self.session.logout_user(self)
+        self.logged_in = False
+        for room in rooms:
+            self.send_server_message(announcement.format(user=user), room)
 
-    def send_server_message(self, message):
+    def send_server_message(self, message, room=None):
         """
-        Automatically sends a server message.
+        Automatically sends a server message to a room.
         :param message:
+        :param room: Name of the room, the default room if not given.
         :return:
         """
-        self.session.log_message_from_server(message)
-        self.update_all_client_logs(self.session.get_latest_message())
+        d = self.session.log_message_from_server(message, room)
+        d.addCallbacks(self.update_all_client_logs, lambda failure: log.failure("Server message failed", failure))
 
     def update_all_client_logs(self, message):
         """
-        Updates all the currently connected clients logs with a new message.
+        Updates the logs of every client in the message's room with it.
+        The message is queued, and goes out with every other message added in the same reactor tick.
         :param message:
         :return:
         """
-        log.msg("Adding new message to all clients.")
-        encoded_message = message_log_addition(message).encode()
-        for user in self.session.logged_in_users:
-            if user is not None:
-                user.transport.write(encoded_message)
+        if sample_packet_log():
+            log.debug("Adding new message to all clients.")
+        self.factory.get_log_cache(message.room).message_added(message)
+        self.broadcaster.queue(message)
+        if self.session.bus is not None:
+            self.session.bus.publish(message)
 
 
 class MessagingFactory(protocol.ServerFactory):
     protocol = MessagingProtocol
 
-    def __init__(self):
-        self.session = ServerSession()
+    def __init__(self, config_file=CONFIG_FILE):
+        self.session = ServerSession(config_file)
+        self.broadcaster = BroadcastScheduler(self.session, self.session.broadcast_window_ms / 1000)
+        self.log_caches = {}  # Room names to the cache of their log, made the first time one is needed.
+        self.offered_features = self.get_offered_features()
+        self.rate_limiter = RateLimiter(self.session.connection_rate_limits, self.session.ip_rate_limits)
+        self.prune_loop = LoopingCall(self.prune)
+        self.prune_loop.start(60, now=False)
+        self.lag_monitor = LagMonitor()
+        self.lag_monitor.start()
+        self.connections = set()  # Every connected MessagingProtocol.
+        self.dropped_chunks = 0  # Dropped by connections already closed, see SendQueue.
+        self.dropped_bytes = 0
+        self.registry = Registry(registry)  # Its own metrics, along with the ones shared by the whole process.
+        self.register_metrics()
+        # Before, not during, so queued writes get flushed while the database pools are still open.
+        reactor.addSystemEventTrigger("before", "shutdown", self.session.close)
+
+    def register_metrics(self):
+        """
+        Adds the metrics read from this factory and its session to its registry.
+        :return:
+        """
+        self.registry.gauge(
+            "messenger_logged_in_users",
+            "Users logged in, not counting the server's own.",
+            lambda: len(self.session.logged_in_users) - 1,
+        )
+        self.registry.gauge("messenger_connections", "Clients connected right now.", lambda: len(self.connections))
+        self.registry.gauge(
+            "messenger_send_queue_pending_bytes",
+            "Bytes held back in the send queues of every connection, not counting the transports' own buffers.",
+            lambda: sum(connection.send_queue.pending_bytes for connection in self.connections),
+        )
+        self.registry.counter_function(
+            "messenger_dropped_broadcasts_total",
+            "Broadcast chunks dropped instead of sent to clients that fell too far behind.",
+            lambda: self.dropped_chunks + sum(c.send_queue.dropped_chunks for c in self.connections),
+        )
+        self.registry.counter_function(
+            "messenger_dropped_broadcast_bytes_total",
+            "Bytes of broadcasts dropped instead of sent to clients that fell too far behind.",
+            lambda: self.dropped_bytes + sum(c.send_queue.dropped_bytes for c in self.connections),
+        )
+
+        broadcaster = self.broadcaster
+        self.registry.counter_function(
+            "messenger_broadcast_flushes_total",
+            "Batches of new messages sent out to their rooms.",
+            lambda: broadcaster.stats()["flushes"],
+        )
+        self.registry.counter_function(
+            "messenger_broadcast_messages_total",
+            "New messages sent out to their rooms.",
+            lambda: broadcaster.stats()["messages"],
+        )
+        self.registry.gauge(
+            "messenger_broadcast_largest_batch",
+            "Most messages sent out in one batch.",
+            lambda: broadcaster.stats()["largest_batch"],
+        )
+        self.registry.gauge(
+            "messenger_broadcast_average_batch",
+            "Messages per batch, on average.",
+            lambda: broadcaster.stats()["average_batch"],
+        )
+        self.registry.gauge(
+            "messenger_broadcast_average_flush_latency_seconds",
+            "Time from a batch's first message being queued to the batch being sent, on average.",
+            lambda: broadcaster.stats()["average_flush_latency"],
+        )
+        self.registry.gauge(
+            "messenger_broadcast_last_flush_latency_seconds",
+            "Time from the last batch's first message being queued to the batch being sent.",
+            lambda: broadcaster.stats()["last_flush_latency"],
+        )
+
+        self.registry.counter_function(
+            "messenger_log_cache_hits_total",
+            "Message log requests answered with an already encoded log.",
+            lambda: sum(cache.stats()["hits"] for cache in self.log_caches.values()),
+        )
+        self.registry.counter_function(
+            "messenger_log_cache_misses_total",
+            "Message log requests that had to encode the log.",
+            lambda: sum(cache.stats()["misses"] for cache in self.log_caches.values()),
+        )
+        self.registry.counter_function(
+            "messenger_requests_throttled_total",
+            "Requests refused for going over a rate limit.",
+            lambda: self.rate_limiter.throttled,
+        )
 
     def buildProtocol(self, addr):
-        return MessagingProtocol(self.session)
+        messaging_protocol = MessagingProtocol(self.session, self.broadcaster)
+        messaging_protocol.factory = self
+        return messaging_protocol
+
+    def check_admission(self):
+        """
+        Raises a RateLimitError if the server is too far behind to take on another user.
+        :return:
+        """
+        max_lag = self.session.max_reactor_lag_ms / 1000
+        if max_lag and self.lag_monitor.lag > max_lag:
+            log.warn("Refusing a login, the reactor is {lag:.0f}ms behind.", lag=self.lag_monitor.lag * 1000)
+            raise RateLimitError("Server is too busy to log in right now.", max(1.0, self.lag_monitor.lag))
+
+    def message_from_bus(self, message):
+        """
+        Adds a message another worker logged, sending it to the clients in its room on this worker.
+        :param message:
+        :return:
+        """
+        if not self.session.add_recent_message(message):
+            return  # Nobody on this worker is in its room.
+        self.get_log_cache(message.room).message_added(message)
+        self.broadcaster.queue(message)
+
+    def connection_closed(self, send_queue):
+        """
+        Keeps what a closed connection's send queue dropped, so the dropped broadcast counters never go down.
+        :param send_queue:
+        :return:
+        """
+        self.dropped_chunks += send_queue.dropped_chunks
+        self.dropped_bytes += send_queue.dropped_bytes
+
+    def prune(self):
+        """
+        Forgets the rate limits of clients that have been quiet for a while, and takes idle rooms out of memory.
+        :return:
+        """
+        self.rate_limiter.prune()
+        for name in self.session.prune_rooms():
+            self.log_caches.pop(name, None)
+
+    def get_log_cache(self, room):
+        """
+        Gets the log cache of a room, making it if there isn't one yet.
+        :param room:
+        :return:
+        """
+        cache = self.log_caches.get(room)
+        if cache is None:
+            cache = self.log_caches[room] = MessageLogCache(self.session, room)
+        return cache
+
+    def get_offered_features(self):
+        """
+        Gets the protocol features this server is willing to use with its clients, according to its settings.
+        :return:
+        """
+        disabled = []
+        if not self.session.zlib_stream:
+            disabled.append(FEATURE_ZLIB_STREAM)
+        if not self.session.zlib_dictionary:
+            disabled.append(FEATURE_ZLIB_DICTIONARY)
+        return [feature for feature in SUPPORTED_FEATURES if feature not in disabled]
 
 
 def folder_check(config):
@@ -150,20 +650,146 @@ def folder_check(config):
         os.mkdir(f'{data_folder}')
 
 
-def get_log_file(config):
+def get_log_file(config, worker=None):
+    """
+    Gets the location of the log file for this server, or for one of its workers.
+    :param config:
+    :param worker: Number of the worker, None for the server or its launcher.
+    :return:
+    """
+    log_file = config['structure']['log_file']
+    if worker is not None:
+        name, extension = os.path.splitext(log_file)
+        log_file = f"{name}.worker{worker}{extension}"
+    return os.path.join(config['structure']['data_folder'], log_file)
+
+
+def get_bus_socket(config):
+    """
+    Gets the location of the Unix socket workers talk to each other through.
+    :param config:
+    :return:
+    """
+    return os.path.join(config['structure']['data_folder'], config.get('network', {}).get('bus_socket', "bus.sock"))
+
+
+def listen_shared(port, factory):
+    """
+    Listens on a port with SO_REUSEPORT, so every worker can listen on it and the kernel spreads connections among them.
+    :param port:
+    :param factory:
+    :return:
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    sock.listen(50)
+    sock.setblocking(False)
+    listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()  # The reactor has its own copy of it now.
+    return listening_port
+
+
+def start_metrics(factory, worker=None):
+    """
+    Serves the metrics of a factory over HTTP, if they are enabled.
+    Every worker serves its own, on the configured port plus its number.
+    :param factory:
+    :param worker: Number of the worker, None for a server running by itself.
+    :return:
+    """
+    session = factory.session
+    if not session.metrics_enabled:
+        return
+    port = session.metrics_port + (worker or 0)
+    listen_metrics(port, session.metrics_interface, factory.registry)
+    log.info("Serving metrics on {interface}:{port}.", interface=session.metrics_interface, port=port)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Keeps track of one worker process started by the launcher.
+    """
+    def __init__(self, number):
+        self.number = number
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        log.info("Worker {number} ended. {reason!r}", number=self.number, reason=reason.value)
+        self.ended.callback(None)
+
+
+def run_launcher(config, workers):
     """
-    Gets the location of the log file for this server.
+    Runs the hub of the bus, and starts every worker process.
     :param config:
+    :param workers: How many worker processes to start.
     :return:
     """
-    return os.path.join(config['structure']['data_folder'], config['structure']['log_file'])
+    bus_socket = get_bus_socket(config)
+    if os.path.exists(bus_socket):
+        os.remove(bus_socket)  # Left over from a launcher that didn't shut down cleanly.
+    reactor.listenUNIX(bus_socket, HubFactory())
+
+    processes = []
+    for number in range(workers):
+        process = WorkerProcess(number)
+        args = [sys.executable, os.path.abspath(__file__), "--worker", str(number)]
+        processes.append(
+            (process, reactor.spawnProcess(process, sys.executable, args, env=os.environ, path=os.getcwd()))
+        )
+    log.info("Started {workers} workers.", workers=workers)
+
+    def stop_workers():
+        # Let every worker flush its writes before the launcher goes.
+        for process, transport in processes:
+            if transport.pid is not None:
+                transport.signalProcess("TERM")
+        return defer.DeferredList([process.ended for process, transport in processes])
+
+    reactor.addSystemEventTrigger("before", "shutdown", stop_workers)
+
+
+def run_worker(config, worker):
+    """
+    Runs one worker process, connected to the others through the launcher's hub.
+    :param config:
+    :param worker: Number of this worker.
+    :return:
+    """
+    factory = MessagingFactory()
+    d = connect_bus(UNIXClientEndpoint(reactor, get_bus_socket(config)), factory.session, factory.message_from_bus)
+
+    def connected(_):
+        listen_shared(config['port'], factory)
+        start_metrics(factory, worker)
+        log.info("Worker {worker} listening.", worker=worker)
+
+    def failed(failure):
+        log.failure("Could not connect to the bus.", failure)
+        reactor.stop()
+
+    d.addCallbacks(connected, failed)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="server.py", description="Runs a messenger server.")
+    parser.add_argument('--worker', type=int, default=None, help=argparse.SUPPRESS)  # Only used by the launcher.
+    args = parser.parse_args()
+
     config = toml.load(CONFIG_FILE)
     folder_check(config)
-    log.startLogging(open(get_log_file(config), 'w'))
+    start_logging(get_log_file(config, args.worker), config.get('logging', {}))
 
-    endpoint = TCP4ServerEndpoint(reactor, toml.load(CONFIG_FILE)['port'])
-    endpoint.listen(MessagingFactory())
+    workers = config.get('network', {}).get('workers', 1)
+    if args.worker is not None:
+        run_worker(config, args.worker)
+    elif workers > 1:
+        run_launcher(config, workers)
+    else:
+        factory = MessagingFactory()
+        endpoint = TCP4ServerEndpoint(reactor, config['port'])
+        endpoint.listen(factory)
+        start_metrics(factory)
     reactor.run()
@@ -1,61 +1,69 @@
 import os
 import time
+from collections import deque
+from itertools import islice
 from errors import SessionError
 import sqlite3
-from twisted.python import log
+from twisted.logger import Logger
+from twisted.internet import reactor, defer
 import toml
 from constants import CONFIG_FILE
+from storage import Storage, MAX_SQLITE_INTEGER
+from sendqueue import SLOW_CONSUMER_POLICIES, POLICY_DROP
+from message import Message, User
 
+log = Logger()
 
-class User:
-    def __init__(self, name):
-        self.name = name
 
-    def __eq__(self, other):
-        return type(other) == type(self) and self.name == other.name
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
 
-    def __repr__(self):
-        return f"{self.name}"
 
-
-class Message:
-    def __init__(self, id: int, user: User, message: str, timestamp):
+class Room:
+    def __init__(self, name, max_shown_messages):
         """
-        Represents a message from one user.
-        :param id:
-        :param user:
-        :param message:
-        :param timestamp:
+        A conversation with its own members and history. Messages only go out to the members of their room.
+        :param name:
+        :param max_shown_messages: How many of its latest messages to keep in memory.
         """
-        self.id = id
-        self.sender = user
-        self.message = message
-        self.timestamp = timestamp
-
-    def __lt__(self, other):
-        if type(other) != type(self):
-            return False
-
-        return self.timestamp < other.timestamp
-
-    def __repr__(self):
-        return f"{self.id}:{self.sender.name}:{self.timestamp}:{self.message}"
+        self.name = name
+        self.members = set()  # Protocol instances of the users in the room.
+        # The latest messages, oldest first, so the usual reads never have to touch the database.
+        self.recent_messages = deque(maxlen=max_shown_messages)
+        self.last_active = 0.0  # When it last got a message or a member joined or left, see prune_rooms.
 
-    @staticmethod
-    def from_string(string):
+    def add_recent_message(self, message):
         """
-        converts into this class from a string
-        :param string:
+        Adds a message to the recent ones, keeping them in order of id.
+        With several workers, messages from other workers can arrive after newer ones from this one.
+        :param message:
         :return:
         """
-        args = string.split(":")
-        print(args)
-        print(Message(int(args[0]), User(args[1]), ":".join(args[3:]), args[2]))
-        return Message(int(args[0]), User(args[1]), ":".join(args[3:]), args[2])
+        recent_messages = self.recent_messages
+        if not recent_messages or recent_messages[-1].id < message.id:
+            recent_messages.append(message)
+            return
+
+        index = len(recent_messages)
+        while index > 0 and recent_messages[index - 1].id > message.id:
+            index -= 1
+        if index == 0 and len(recent_messages) == recent_messages.maxlen:
+            return  # Older than every message kept.
+        if len(recent_messages) == recent_messages.maxlen:
+            recent_messages.popleft()
+            index -= 1
+        recent_messages.insert(index, message)
+
+    def __repr__(self):
+        return f"{self.name}"
 
 
 class ServerSession:
-    def __init__(self):
+    def __init__(self, config_file=CONFIG_FILE, clock=reactor):
+        """
+        :param config_file: The toml config to read settings from.
+        :param clock: What to schedule write behind flushes with, the reactor by default.
+        """
+        self.clock = clock
         # Default settings.
         self.server_name = "Messenger Server"
         self.server_user_name = "server"
@@ -64,17 +72,58 @@ class ServerSession:
         self.msg_char_limit = 200
         self.name_char_limit = 20
         self.max_shown_messages = 200
+        self.max_page_size = 100
         self.leave_announcement = "{user} has left."
         self.join_announcement = "{user} has joined."
         self.abrupt_leave_announcement = "{user} left unexpectedly."
         self.database = "messenger.db"
-        self.get_toml_config()
-
+        self.broadcast_window_ms = 0
+        self.zlib_stream = True
+        self.zlib_dictionary = True
+        self.synchronous = "FULL"
+        self.write_behind = False
+        self.write_behind_ms = 50
+        self.write_behind_rows = 500
+        self.read_connections = 2
+        self.default_room = "general"
+        self.room_char_limit = 20
+        self.max_joined_rooms = 20
+        self.room_idle_seconds = 300
+        self.send_queue_high_bytes = 1024 * 1024
+        self.send_queue_low_bytes = 256 * 1024
+        self.slow_consumer_policy = POLICY_DROP
+        self.connection_rate_limits = {}  # Packet type names to their rate and burst, nothing is limited by default.
+        self.ip_rate_limits = {}
+        self.max_reactor_lag_ms = 0  # 0 never refuses logins.
+        self.metrics_enabled = False
+        self.metrics_port = 9100
+        self.metrics_interface = "127.0.0.1"
+        self.get_toml_config(config_file)
+
+        # Startup happens before the reactor runs, so it's fine for it to wait on the database.
+        # Once running, every query goes through self.storage instead, off the reactor thread.
         self.con = sqlite3.connect(self.database)
+        self.configure_database()
         self.generate_database()
+        # Messages get their ids here instead of from SQLite, so they can be sent out before they are written.
+        self.next_message_id = self.get_next_message_id()
+        self.pending_messages = []  # Rows waiting for the next write behind flush.
+        self.delayed_flush = None
+        self.rooms = {}  # Room names to the rooms in memory, see load_room.
+        self.joined_rooms = {}  # Protocol instances to the names of the rooms they are in.
+        # Messages other workers logged in rooms that aren't in memory here. They might not be in the database yet
+        # when one of those rooms is loaded, so the last few are kept to fill it in with.
+        self.unloaded_room_messages = deque(maxlen=2 * self.write_behind_rows)
+        self.load_rooms()
         self.logged_in_users = {}  # Relate twister protocol instances to users.
-        self.server_user = self.login_user(self.server_user_name, self.server_user_pass, None)
-        log.msg("Server successfully logged in.")
+        self.users_by_name = {}  # The other way around, logged in usernames to their protocol instance.
+        self.server_user = self.login_server_user()
+        log.info("Server successfully logged in.")
+        self.con.close()
+        self.con = None
+
+        self.storage = Storage(self.database, self.synchronous, self.read_connections)
+        self.bus = None  # Connects the workers, when running with more than one. See bus.py.
 
     def get_toml_config(self, name=CONFIG_FILE):
         """
@@ -92,84 +141,427 @@ class ServerSession:
         self.msg_char_limit = config['session']['database']['message_character_limit']
         self.name_char_limit = config['session']['database']['username_character_limit']
         self.max_shown_messages = config['session']['database']['max_shown_messages']
+        self.max_page_size = config['session']['database'].get('max_page_size', self.max_page_size)
+        self.synchronous = config['session']['database'].get('synchronous', self.synchronous).upper()
+        self.write_behind = config['session']['database'].get('write_behind', self.write_behind)
+        self.write_behind_ms = config['session']['database'].get('write_behind_ms', self.write_behind_ms)
+        self.write_behind_rows = config['session']['database'].get('write_behind_rows', self.write_behind_rows)
+        self.read_connections = config['session']['database'].get('read_connections', self.read_connections)
         self.leave_announcement = config['session']['announcements']['leave']
         self.join_announcement = config['session']['announcements']['join']
         self.abrupt_leave_announcement = config['session']['announcements']['abrupt_leave']
+        rooms = config['session'].get('rooms', {})
+        self.default_room = rooms.get('default_room', self.default_room)
+        self.room_char_limit = rooms.get('room_name_character_limit', self.room_char_limit)
+        self.max_joined_rooms = rooms.get('max_joined_rooms', self.max_joined_rooms)
+        self.room_idle_seconds = rooms.get('room_idle_seconds', self.room_idle_seconds)
+        # Newer settings, older config files might not have them.
+        network = config.get('network', {})
+        self.broadcast_window_ms = network.get('broadcast_window_ms', self.broadcast_window_ms)
+        self.zlib_stream = network.get('zlib_stream', self.zlib_stream)
+        self.zlib_dictionary = network.get('zlib_dictionary', self.zlib_dictionary)
+        self.send_queue_high_bytes = network.get('send_queue_high_bytes', self.send_queue_high_bytes)
+        self.send_queue_low_bytes = network.get('send_queue_low_bytes', self.send_queue_low_bytes)
+        self.slow_consumer_policy = network.get('slow_consumer_policy', self.slow_consumer_policy)
+        if self.slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(
+                f"Unknown slow consumer policy {self.slow_consumer_policy!r}, expected one of {SLOW_CONSUMER_POLICIES}."
+            )
+        rate_limits = config.get('rate_limits', {})
+        self.connection_rate_limits = rate_limits.get('connection', self.connection_rate_limits)
+        self.ip_rate_limits = rate_limits.get('ip', self.ip_rate_limits)
+        self.max_reactor_lag_ms = rate_limits.get('max_reactor_lag_ms', self.max_reactor_lag_ms)
+        metrics = config.get('metrics', {})
+        self.metrics_enabled = metrics.get('enabled', self.metrics_enabled)
+        self.metrics_port = metrics.get('port', self.metrics_port)
+        self.metrics_interface = metrics.get('interface', self.metrics_interface)
+
+    def configure_database(self):
+        """
+        Switches the database to write ahead logging, and sets how often SQLite makes sure writes hit the disk.
+        :return:
+        """
+        if self.synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode {self.synchronous!r}, expected one of {SYNCHRONOUS_MODES}.")
+
+        cur = self.con.cursor()
+        cur.execute("PRAGMA journal_mode=WAL;")
+        cur.execute(f"PRAGMA synchronous={self.synchronous};")  # Can't be a parameter, checked above instead.
+        cur.close()
 
     def generate_database(self):
         """
         Generates the database if it already was not so.
         :return:
         """
-        log.msg("Generating database...")
+        log.info("Generating database...")
         generate_database_queries = [
             f'CREATE TABLE IF NOT EXISTS users(name text PRIMARY KEY, password text NOT NULL CHECK(typeof("name") = "text" AND length("name") <= {self.name_char_limit}));',
-            f'CREATE TABLE IF NOT EXISTS messages(id integer PRIMARY KEY AUTOINCREMENT, message text NOT NULL, timestamp integer NOT NULL, sender text NOT NULL, FOREIGN KEY(sender) REFERENCES users(name) CHECK(typeof("message") = "text" AND length("message") <= {self.msg_char_limit}));',
+            f'CREATE TABLE IF NOT EXISTS messages(id integer PRIMARY KEY AUTOINCREMENT, message text NOT NULL, timestamp integer NOT NULL, sender text NOT NULL, room text NOT NULL DEFAULT {self.quoted_default_room()}, FOREIGN KEY(sender) REFERENCES users(name) CHECK(typeof("message") = "text" AND length("message") <= {self.msg_char_limit}));',
             f"INSERT OR IGNORE INTO users(name, password) VALUES('{self.server_user_name}', '{self.server_user_pass}');"
         ]
         for query in generate_database_queries:
             cur = self.con.cursor()
-            log.msg(query)
+            log.debug("{query}", query=query)
             cur.execute(query)
             cur.close()
+
+        # Databases from before rooms existed, all of their messages end up in the default room.
+        cur = self.con.cursor()
+        columns = [column[1] for column in cur.execute("PRAGMA table_info(messages);").fetchall()]
+        if "room" not in columns:
+            log.info("Adding rooms to the database, existing messages go to {room!r}.", room=self.default_room)
+            cur.execute(f"ALTER TABLE messages ADD COLUMN room text NOT NULL DEFAULT {self.quoted_default_room()};")
+        # Reading a room's history walks this index, instead of every message of every room.
+        cur.execute("CREATE INDEX IF NOT EXISTS messages_room_id ON messages(room, id);")
+        cur.close()
         self.con.commit()
 
-    def log_message(self, message, protocol):
+    def quoted_default_room(self):
+        """
+        Returns the default room name as an SQL string literal, as column defaults can't be parameters.
+        :return:
+        """
+        return "'" + self.default_room.replace("'", "''") + "'"
+
+    def load_rooms(self):
+        """
+        Creates the default room, filling it with its latest messages.
+        Every other room is read from the database the first time someone joins it, see load_room.
+        :return:
         """
-        Adds a raw message to the message log.
+        cur = self.con.cursor()
+        query = "SELECT * FROM messages WHERE room=? ORDER BY id DESC LIMIT ?;"
+        room = Room(self.default_room, self.max_shown_messages)
+        for message in reversed(cur.execute(query, (self.default_room, self.max_shown_messages)).fetchall()):
+            room.recent_messages.append(self.from_database_to_message_instance(message))
+        cur.close()
+        self.rooms = {self.default_room: room}
+
+    def get_room(self, name=None):
+        """
+        Gets a room that's in memory by its name, raising a SessionError if it isn't. Defaults to the default room.
+        :param name:
+        :return:
+        """
+        if name is None:
+            name = self.default_room
+
+        room = self.rooms.get(name)
+        if room is None:
+            raise SessionError(f"You need to join room {name!r} first.")
+        return room
+
+    def check_room_name(self, name):
+        """
+        Raises a SessionError if a room can't have this name.
+        :param name:
+        :return:
+        """
+        if not isinstance(name, str) or not name:
+            raise SessionError("Room names cannot be empty.")
+        if len(name) > self.room_char_limit:
+            raise SessionError(f"Room name is over {self.room_char_limit} characters.")
+
+    def load_room(self, name):
+        """
+        Gets a room, reading its latest messages from the database if it isn't in memory yet.
+        Rooms that never had a message are made empty.
+        Returns a Deferred that fires with the room.
+        :param name:
+        :return:
+        """
+        if name in self.rooms:
+            return defer.succeed(self.rooms[name])
+        self.check_room_name(name)
+
+        def got_rows(rows):
+            room = self.rooms.get(name)
+            if room is not None:
+                return room  # Loaded by someone else in the meantime.
+
+            room = Room(name, self.max_shown_messages)
+            for row in reversed(rows):
+                room.recent_messages.append(self.from_database_to_message_instance(row))
+            loaded_ids = {message.id for message in room.recent_messages}
+            for message in self.unloaded_room_messages:
+                if message.room == name and message.id not in loaded_ids:
+                    room.add_recent_message(message)
+            room.last_active = self.clock.seconds()
+            self.rooms[name] = room
+            return room
+
+        # Queued writes go first, in case the room was only just taken out of memory.
+        d = self.flush_pending_messages()
+        d.addCallback(lambda _: self.storage.get_messages_before(MAX_SQLITE_INTEGER, self.max_shown_messages, name))
+        d.addCallback(got_rows)
+        return d
+
+    def prune_rooms(self):
+        """
+        Takes every room without members that has been idle for room_idle_seconds out of memory.
+        The default room always stays. Returns the names of the rooms taken out.
+        :return:
+        """
+        now = self.clock.seconds()
+        idle = [
+            name for name, room in self.rooms.items()
+            if name != self.default_room and not room.members and now - room.last_active >= self.room_idle_seconds
+        ]
+        for name in idle:
+            del self.rooms[name]
+        return idle
+
+    def add_recent_message(self, message):
+        """
+        Adds a message another worker logged to the recent messages of its room.
+        Returns whether its room is in memory here.
         :param message:
+        :return:
+        """
+        room = self.rooms.get(message.room)
+        if room is None:
+            self.unloaded_room_messages.append(message)
+            return False
+        room.add_recent_message(message)
+        room.last_active = self.clock.seconds()
+        return True
+
+    def join_room(self, protocol, name=None):
+        """
+        Adds the user of this protocol to a room, so they get its messages.
+        Returns a Deferred that fires with the room, once it's loaded.
         :param protocol:
+        :param name:
+        :return:
+        """
+        if name is None:
+            name = self.default_room
+        joined = self.joined_rooms.get(protocol, set())
+        if name in joined:
+            raise SessionError(f"Already in room {name!r}.")
+        if len(joined) >= self.max_joined_rooms:
+            raise SessionError(f"Can't be in more than {self.max_joined_rooms} rooms at once.")
+
+        def loaded(room):
+            if protocol not in self.logged_in_users:
+                raise SessionError("Logged out before the room was joined.")
+            self.joined_rooms.setdefault(protocol, set()).add(room.name)
+            room.members.add(protocol)
+            room.last_active = self.clock.seconds()
+            return room
+
+        return self.load_room(name).addCallback(loaded)
+
+    def leave_room(self, protocol, name=None):
+        """
+        Removes the user of this protocol from a room.
+        Returns the room.
+        :param protocol:
+        :param name:
+        :return:
+        """
+        room = self.get_member_room(protocol, name)
+        self.joined_rooms[protocol].discard(room.name)
+        room.members.discard(protocol)
+        room.last_active = self.clock.seconds()
+        return room
+
+    def leave_all_rooms(self, protocol):
+        """
+        Removes the user of this protocol from every room it's in.
+        Returns the names of the rooms it left.
+        :param protocol:
+        :return:
+        """
+        names = self.joined_rooms.pop(protocol, set())
+        for name in names:
+            room = self.rooms[name]
+            room.members.discard(protocol)
+            room.last_active = self.clock.seconds()
+        return sorted(names)
+
+    def get_member_room(self, protocol, name=None):
+        """
+        Gets a room the user of this protocol is in, raising a SessionError if it isn't in it.
+        :param protocol:
+        :param name:
+        :return:
+        """
+        if name is None:
+            name = self.default_room
+        if name not in self.joined_rooms.get(protocol, ()):
+            raise SessionError(f"You need to join room {name!r} first.")
+        return self.rooms[name]
+
+    def log_message(self, message, protocol, room=None):
+        """
+        Adds a raw message to the message log of a room the sender is in.
+        Returns a Deferred that fires with the message instance that was logged.
+        :param message:
+        :param protocol:
+        :param room: Name of the room, the default room if not given.
         :return:
         """
         if len(message.content) > self.msg_char_limit:
             raise SessionError(f"Message is over {self.msg_char_limit} characters, not logging.")
 
-        self.insert_message_into_database(self.logged_in_users[protocol], message.content, message.timestamp)
+        room = self.get_member_room(protocol, room)
+        return self.insert_message_into_database(self.logged_in_users[protocol], message.content, message.timestamp, room)
 
-    def log_message_from_server(self, message):
+    def log_message_from_server(self, message, room=None):
         """
-        Adds a message from the server.
+        Adds a message from the server to a room.
+        Returns a Deferred that fires with the message instance that was logged.
         :param message:
+        :param room: Name of the room, the default room if not given.
         :return:
         """
-        self.insert_message_into_database(self.server_user, message, time.time())
+        return self.insert_message_into_database(self.server_user, message, time.time(), self.get_room(room))
 
-    def insert_message_into_database(self, sender, message, timestamp):
+    def insert_message_into_database(self, sender, message, timestamp, room):
         """
-        Inserts the json of a message into the databaase.
+        Inserts the json of a message into the databaase, and into the recent messages of its room.
+        Returns a Deferred that fires with the message instance once it's committed.
+        With write behind on, the insert is queued for the next flush and the Deferred fires straight away.
         :param message:
         :param sender:
         :param timestamp:
+        :param room:
+        :return:
+        """
+        if self.bus is not None:
+            # Ids come from the hub when running with several workers, so they stay in order across all of them.
+            d = self.bus.next_message_id()
+            d.addCallback(self.store_message, sender, message, timestamp, room)
+            return d
+
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return self.store_message(message_id, sender, message, timestamp, room)
+
+    def store_message(self, message_id, sender, message, timestamp, room):
+        """
+        Inserts a message that already has its id.
+        Returns a Deferred that fires with the message instance once it's committed.
+        :param message_id:
+        :param sender:
+        :param message:
+        :param timestamp:
+        :param room:
+        :return:
+        """
+        message_instance = Message(message_id, User(sender.name), message, timestamp, room.name)
+        row = (message_instance.id, message, timestamp, sender.name, room.name)
+        room.add_recent_message(message_instance)
+        room.last_active = self.clock.seconds()
+
+        if self.write_behind:
+            self.pending_messages.append(row)
+            if len(self.pending_messages) >= self.write_behind_rows:
+                self.flush_pending_messages()
+            elif self.delayed_flush is None:
+                self.delayed_flush = self.clock.callLater(self.write_behind_ms / 1000, self.flush_pending_messages)
+            return defer.succeed(message_instance)
+
+        def insert_failed(failure):
+            # Don't leave a message that never made it into the database among the recent ones.
+            if message_instance in room.recent_messages:
+                room.recent_messages.remove(message_instance)
+            return failure
+
+        d = self.storage.insert_message(row)
+        d.addCallbacks(lambda _: message_instance, insert_failed)
+        return d
+
+    def flush_pending_messages(self):
+        """
+        Writes every queued message to the database in one transaction.
+        Returns a Deferred that fires once they are written.
+        :return:
+        """
+        if self.delayed_flush is not None and self.delayed_flush.active():
+            self.delayed_flush.cancel()
+        self.delayed_flush = None
+
+        rows, self.pending_messages = self.pending_messages, []
+        if not rows:
+            return defer.succeed(None)
+        d = self.storage.insert_messages(rows)
+        d.addErrback(lambda failure: log.failure("Write behind flush failed", failure))
+        return d
+
+    def get_next_message_id(self):
+        """
+        Gets the id the next message should be inserted with.
         :return:
         """
-        query = "INSERT INTO messages(message, timestamp, sender) VALUES(?, ?, ?)"
         cur = self.con.cursor()
-        cur.execute(query, (message, timestamp, sender.name))
-        self.con.commit()
+        max_id = cur.execute("SELECT MAX(id) FROM messages;").fetchone()[0] or 0
+        sequence = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages';").fetchone()
+        cur.close()
+        return max(max_id, sequence[0] if sequence else 0) + 1
+
+    def close(self):
+        """
+        Writes out anything still queued and closes the database.
+        Returns a Deferred that fires once everything is written.
+        :return:
+        """
+        d = self.flush_pending_messages()
+        d.addBoth(lambda _: self.storage.close())
+        return d
+
+    def login_server_user(self):
+        """
+        Logs in the user the server makes announcements as.
+        Only used at startup, before the reactor runs.
+        :return:
+        """
+        query = "SELECT name FROM users WHERE name=? AND password=?;"
+        cur = self.con.cursor()
+        user = cur.execute(query, (self.server_user_name, self.server_user_pass)).fetchone()
         cur.close()
+        if not user:
+            raise SessionError("Server user credentials are incorrect.")
+
+        server_user = User(user[0])
+        self.logged_in_users[None] = server_user
+        self.users_by_name[server_user.name] = None
+        return server_user
 
     def login_user(self, user, password, protocol):
         """
         Logs in a user.
-        Returns the instance of the object that was created.
+        Returns a Deferred that fires with the instance of the object that was created.
         :param user:
         :param password:
         :param protocol:
         :return:
         """
-        query = "SELECT name FROM users WHERE name=? AND password=?;"
-
-        cur = self.con.cursor()
-        user = cur.execute(query, (user, password)).fetchone()
-        if not user:
-            raise SessionError("Username or Password incorrect. Please try again.")
-
-        login_user = User(user[0])
-        if login_user in self.logged_in_users.values():
-            raise SessionError(f"Account {user[0]!r} is already logged in.")
-        self.logged_in_users[protocol] = login_user
-        cur.close()
-        return login_user
+        def credentials_checked(correct):
+            if not correct:
+                raise SessionError("Username or Password incorrect. Please try again.")
+
+            # Only checked once the password is, so a wrong one never tells whether the account is online.
+            if self.is_logged_in(user):
+                raise SessionError(f"Account {user!r} is already logged in.")
+            if self.bus is not None:
+                # It could also be logged in on another worker.
+                return self.bus.claim(user).addCallback(claimed)
+            return claimed(True)
+
+        def claimed(got_name):
+            if not got_name or self.is_logged_in(user):
+                raise SessionError(f"Account {user!r} is already logged in.")
+            login_user = User(user)
+            self.logged_in_users[protocol] = login_user
+            self.users_by_name[user] = protocol
+            return login_user
+
+        d = self.storage.check_credentials(user, password)
+        d.addCallback(credentials_checked)
+        return d
 
     def logout_user(self, protocol):
         """
@@ -178,43 +570,84 @@ class ServerSession:
         :param protocol:
         :return:
         """
-        user = self.logged_in_users[protocol]
-        del self.logged_in_users[protocol]
+        user = self.logged_in_users.pop(protocol)
+        del self.users_by_name[user.name]
+        if self.bus is not None:
+            self.bus.release(user.name)
         return user.name
 
-    def get_message_log(self, length=None):
+    def is_logged_in(self, name):
         """
-        Gets the message log up to a certain length, default being the set variable MAX_SHOWN_MESSAGES.
+        Checks if a user with this name is currently logged in.
+        :param name:
+        :return:
+        """
+        return name in self.users_by_name
+
+    def get_message_log(self, length=None, room=None):
+        """
+        Gets the message log of a room up to a certain length, default being the set variable MAX_SHOWN_MESSAGES.
+        Newest messages come first. Served from the recent messages, so it's never longer than MAX_SHOWN_MESSAGES,
+        older ones can be read with get_message_page.
         :param length:
+        :param room: Name of the room, the default room if not given.
         :return:
         """
         # Set our default parameter.
         if length is None:
             length = self.max_shown_messages
 
-        query = f"SELECT * FROM messages ORDER BY id DESC LIMIT {length};"
-        cur = self.con.cursor()
-        messages = cur.execute(query).fetchall()
-        result = []
-        for message in messages:
-            result.append(self.from_database_to_message_instance(message))
-        cur.close()
-        return result
+        return list(islice(reversed(self.get_room(room).recent_messages), length))
 
-    def get_latest_message(self):
+    def get_messages_since(self, last_id, room=None):
         """
-        Returns the latest message in the table.
+        Gets every message of a room newer than the one with the given id, newest first.
+        Returns None if some of them are older than the recent messages go back, meaning a whole log is needed instead.
+        :param last_id:
+        :param room: Name of the room, the default room if not given.
         :return:
         """
-        query = "SELECT * FROM messages ORDER BY id DESC LIMIT 1;"
-        cur = self.con.cursor()
-        latest_message = cur.execute(query).fetchone()
-        cur.close()
-        return self.from_database_to_message_instance(latest_message)
+        recent_messages = self.get_room(room).recent_messages
+        result = []
+        for message in reversed(recent_messages):
+            if message.id <= last_id:
+                return result
+            result.append(message)
+
+        # Ran out of recent messages before reaching last_id. Fine if they are all the messages there are,
+        # or if the oldest one kept comes right after last_id, so nothing can be missing in between.
+        if len(recent_messages) < self.max_shown_messages or recent_messages[0].id == last_id + 1:
+            return result
+        return None
+
+    def get_message_page(self, before_id, size, room=None):
+        """
+        Gets up to size messages of a room older than the one with the given id, newest first.
+        Pages by id rather than offset, so it costs the same however far back it goes.
+        Returns a Deferred that fires with the messages, and whether there are even older ones.
+        :param before_id: Ids past what SQLite can hold are treated as the newest one possible.
+        :param size: Capped at max_page_size.
+        :param room: Name of the room, the default room if not given.
+        :return:
+        """
+        before_id = max(0, min(before_id, MAX_SQLITE_INTEGER))
+        size = max(0, min(size, self.max_page_size))
+        room = self.get_room(room)
+
+        def got_rows(rows):
+            # One more row than asked for is read, only to tell whether there are more.
+            messages = [self.from_database_to_message_instance(row) for row in rows[:size]]
+            return messages, len(rows) > size
+
+        d = self.flush_pending_messages()
+        d.addCallback(lambda _: self.storage.get_messages_before(before_id, size + 1, room.name))
+        d.addCallback(got_rows)
+        return d
 
     def create_new_user(self, username, password):
         """
         Creates a new user in the database.
+        Returns a Deferred that fires once the user is created.
         :param username:
         :param password:
         :return:
@@ -222,28 +655,10 @@ class ServerSession:
         if len(username) > self.name_char_limit:
             raise SessionError("Username too long. Did not create user.")
 
-        if username in self.get_all_usernames():
-            raise SessionError("Username already taken.")
-
         if ":" in username:
             raise SessionError("Usernames cannot use the character ':' in them.")
 
-        query = "INSERT INTO users(name, password) VALUES (?, ?);"
-        cur = self.con.cursor()
-        cur.execute(query, (username, password))
-        self.con.commit()
-        cur.close()
-
-    def get_all_usernames(self):
-        """
-        Gets all the usernames currently taken in the database
-        :return:
-        """
-        query = "SELECT name FROM users;"
-        cur = self.con.cursor()
-        users = cur.execute(query).fetchall()
-        cur.close()
-        return users
+        return self.storage.create_user(username, password)
 
     @staticmethod
     def from_database_to_message_instance(db_tuple):
@@ -252,4 +667,4 @@ class ServerSession:
         :param db_tuple:
         :return:
         """
-        return Message(db_tuple[0], User(db_tuple[3]), db_tuple[1], db_tuple[2])
+        return Message(db_tuple[0], User(db_tuple[3]), db_tuple[1], db_tuple[2], db_tuple[4])
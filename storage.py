@@ -0,0 +1,178 @@
+import sqlite3
+import time
+from twisted.enterprise import adbapi
+from twisted.logger import Logger
+from errors import SessionError
+from metrics import db_insert_seconds, sqlite_commit_seconds
+
+INSERT_MESSAGE_QUERY = "INSERT INTO messages(id, message, timestamp, sender, room) VALUES(?, ?, ?, ?, ?)"
+# Both look up a single row through the primary key index on name, however many users there are.
+CREDENTIALS_QUERY = "SELECT 1 FROM users WHERE name=? AND password=? LIMIT 1;"
+USERNAME_TAKEN_QUERY = "SELECT 1 FROM users WHERE name=? LIMIT 1;"
+MAX_SQLITE_INTEGER = 2 ** 63 - 1  # Bigger integers can't be bound to a query, so no id is ever above this.
+
+log = Logger()
+
+
+class TimedConnection(adbapi.Connection):
+    """
+    A pool connection that times every commit made through it.
+    """
+    def commit(self):
+        start = time.perf_counter()
+        self._connection.commit()
+        sqlite_commit_seconds.observe(time.perf_counter() - start)
+
+
+class Storage:
+    """
+    Runs every database query of a running server away from the reactor thread.
+    Writes go through one dedicated writer thread, so they happen one at a time and in order.
+    Reads go through a small pool of read only connections, which WAL mode lets run alongside the writer.
+    Every method returns a Deferred.
+    """
+    def __init__(self, database, synchronous="FULL", read_connections=2):
+        """
+        :param database: Path to the SQLite file, it needs to exist and be in WAL mode already.
+        :param synchronous: SQLite synchronous mode for the writer, already checked to be a valid one.
+        :param read_connections: How many read only connections, and threads, to read with.
+        """
+        self.database = database
+        self.synchronous = synchronous
+        self.writer = adbapi.ConnectionPool(
+            "sqlite3",
+            database,
+            check_same_thread=False,
+            cp_min=1,
+            cp_max=1,
+            cp_openfun=self.configure_writer,
+            cp_noisy=False,
+        )
+        self.writer.connectionFactory = TimedConnection
+        self.readers = adbapi.ConnectionPool(
+            "sqlite3",
+            f"file:{database}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cp_min=1,
+            cp_max=max(1, read_connections),
+            cp_noisy=False,
+        )
+
+    def configure_writer(self, connection):
+        """
+        Sets up the writer connection when its thread opens it.
+        :param connection:
+        :return:
+        """
+        connection.execute(f"PRAGMA synchronous={self.synchronous};")
+
+    def insert_message(self, row):
+        """
+        Inserts a single message row, committing it straight away.
+        :param row: The id, message, timestamp, sender name and room of the message.
+        :return:
+        """
+        return self.timed_insert(self.writer.runOperation(INSERT_MESSAGE_QUERY, row))
+
+    def insert_messages(self, rows):
+        """
+        Inserts many message rows in one transaction.
+        If that fails, they are inserted one by one so a single bad row doesn't lose the rest.
+        :param rows:
+        :return:
+        """
+        return self.timed_insert(self.writer.runWithConnection(self._insert_messages, rows))
+
+    @staticmethod
+    def timed_insert(d):
+        """
+        Times an insert, from now until its Deferred fires.
+        :param d:
+        :return:
+        """
+        start = time.perf_counter()
+
+        def inserted(result):
+            db_insert_seconds.observe(time.perf_counter() - start)
+            return result
+
+        return d.addBoth(inserted)
+
+    @staticmethod
+    def _insert_messages(connection, rows):
+        """
+        Runs in the writer thread.
+        :param connection:
+        :param rows:
+        :return:
+        """
+        try:
+            connection.cursor().executemany(INSERT_MESSAGE_QUERY, rows)
+            connection.commit()
+            return
+        except sqlite3.Error:
+            connection.rollback()
+            log.error("Batch insert of {count} messages failed, inserting them one at a time.", count=len(rows))
+
+        for row in rows:
+            try:
+                connection.cursor().execute(INSERT_MESSAGE_QUERY, row)
+                connection.commit()
+            except sqlite3.Error as e:
+                connection.rollback()
+                log.error("Dropping message {id}: {error}", id=row[0], error=e)
+
+    def check_credentials(self, name, password):
+        """
+        Fires with whether a user with this name and password exists.
+        :param name:
+        :param password:
+        :return:
+        """
+        d = self.readers.runQuery(CREDENTIALS_QUERY, (name, password))
+        d.addCallback(lambda rows: bool(rows))
+        return d
+
+    def create_user(self, name, password):
+        """
+        Creates a new user, failing with a SessionError if the name is taken.
+        The check and the insert happen in the same transaction on the writer, so two signups can't race.
+        :param name:
+        :param password:
+        :return:
+        """
+        return self.writer.runInteraction(self._create_user, name, password)
+
+    @staticmethod
+    def _create_user(transaction, name, password):
+        """
+        Runs in the writer thread.
+        :param transaction:
+        :param name:
+        :param password:
+        :return:
+        """
+        transaction.execute(USERNAME_TAKEN_QUERY, (name,))
+        if transaction.fetchone():
+            raise SessionError("Username already taken.")
+        transaction.execute("INSERT INTO users(name, password) VALUES (?, ?);", (name, password))
+
+    def get_messages_before(self, before_id, size, room):
+        """
+        Fires with the raw rows of up to size messages of a room older than before_id, newest first.
+        :param before_id:
+        :param size:
+        :param room:
+        :return:
+        """
+        query = "SELECT * FROM messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?;"
+        return self.readers.runQuery(query, (room, before_id, size))
+
+    def close(self):
+        """
+        Closes every connection. Anything still queued on the writer is finished first.
+        :return:
+        """
+        self.writer.close()
+        self.readers.close()
@@ -0,0 +1,82 @@
+import hashlib
+import pytest
+from errors import ProtocolError
+from packet import (
+    BinaryCodec, PRESET_DICTIONARY, FEATURE_ZLIB_STREAM, FEATURE_ZLIB_DICTIONARY, CODEC_BINARY, MAX_NESTING,
+    BINARY_HEADER, PACKET_TYPE_CODES, PacketType, UINT32, create_codec, error_message
+)
+
+
+def encode_value(value):
+    out = bytearray()
+    BinaryCodec.write_value(out, value)
+    return bytes(out)
+
+
+def packet_with(name, encoded_value):
+    header = BINARY_HEADER.pack(PACKET_TYPE_CODES[PacketType.ERROR], 0)
+    return header + bytes([len(name)]) + name.encode() + encoded_value
+
+
+@pytest.mark.parametrize("value", [
+    None, True, False, 0, -2 ** 63, 1.5, "", "héllo", [], [1, 2, 3], [0.5, 1.5], ["a", "bc"],
+    [1, "a", None, [True]], {"a": 1, "b": [{"c": "d"}]},
+])
+def test_read_value_round_trip(value):
+    data = encode_value(value) + b"trailing"
+    assert BinaryCodec.read_value(data, 0) == (value, len(data) - len(b"trailing"))
+
+
+def test_nesting_up_to_the_limit():
+    value = []
+    for _ in range(MAX_NESTING - 1):
+        value = [value]
+    assert BinaryCodec.read_value(encode_value(value), 0)[0] == value
+    with pytest.raises(ValueError):
+        BinaryCodec.read_value(encode_value([value]), 0)
+
+
+@pytest.mark.parametrize("tag", [b"l", b"d"])
+def test_too_deep_nesting_is_a_protocol_error(tag):
+    # Far deeper than the recursion limit, so only the nesting limit stops it.
+    nested = (tag + UINT32.pack(1)) * 100000
+    with pytest.raises(ProtocolError):
+        BinaryCodec().decode(packet_with("content", nested))
+
+
+@pytest.mark.parametrize("key", [[1], 5, None, {"a": 1}])
+def test_non_string_dict_key_is_a_protocol_error(key):
+    value = b"d" + UINT32.pack(1) + encode_value(key) + encode_value("value")
+    with pytest.raises(ProtocolError):
+        BinaryCodec().decode(packet_with("content", value))
+
+
+@pytest.mark.parametrize("value", [
+    b"s" + UINT32.pack(10) + b"short",
+    b"S" + UINT32.pack(2) + UINT32.pack(1) + UINT32.pack(10) + b"ab",
+    b"I" + UINT32.pack(3) + b"\0" * 8,
+    b"i\0\0",
+    b"l" + UINT32.pack(2) + b"N",
+    b"?",
+    b"s" + UINT32.pack(2) + b"\xff\xfe",
+])
+def test_malformed_values_are_protocol_errors(value):
+    with pytest.raises(ProtocolError):
+        BinaryCodec().decode(packet_with("content", value))
+
+
+def test_preset_dictionary_is_frozen():
+    # Changing these bytes breaks every peer using the old ones, bump the version in FEATURE_ZLIB_DICTIONARY too.
+    assert FEATURE_ZLIB_DICTIONARY == "zlib_dictionary_v2"
+    assert hashlib.sha256(PRESET_DICTIONARY).hexdigest() == (
+        "0287cd098a9f867100eed2f04dd41c7eb31aa4b8283a401956f2cf9e9c3f4409"
+    )
+
+
+def test_stream_with_dictionary_round_trip():
+    features = (FEATURE_ZLIB_STREAM, FEATURE_ZLIB_DICTIONARY)
+    sender = create_codec(CODEC_BINARY, features)
+    receiver = create_codec(CODEC_BINARY, features)
+    for i in range(3):
+        content = f"Error number {i}, the server has a lot to say about it this time around."
+        assert receiver.decode(sender.encode(error_message(content))).content == content
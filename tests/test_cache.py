@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+from cache import MessageLogCache
+from message import Message, User
+from packet import create_codec, CODEC_BINARY, CODEC_JSON
+
+
+class FakeSession:
+    max_shown_messages = 3
+
+    def __init__(self, messages):
+        self.messages = messages  # Newest first, like get_message_log returns them.
+
+    def get_room(self, name=None):
+        return SimpleNamespace(name=name or "general")
+
+    def get_message_log(self, length=None, room=None):
+        return self.messages[:self.max_shown_messages]
+
+
+def message(message_id):
+    return Message(message_id, User("alice"), f"message {message_id}", float(message_id), "general")
+
+
+def test_hits_and_misses_per_codec_and_layout():
+    cache = MessageLogCache(FakeSession([message(2), message(1)]))
+    json_codec, binary_codec = create_codec(CODEC_JSON), create_codec(CODEC_BINARY)
+    assert cache.get(json_codec) is cache.get(json_codec)
+    cache.get(binary_codec)
+    cache.get(binary_codec, columnar=True)
+    assert cache.stats() == {"hits": 1, "misses": 3, "hit_rate": 0.25}
+
+
+def test_new_messages_replace_the_encodings():
+    cache = MessageLogCache(FakeSession([message(2), message(1)]))
+    codec = create_codec(CODEC_BINARY)
+    cache.get(codec, columnar=True)
+    cache.message_added(message(3))
+    log = codec.decode(cache.get(codec, columnar=True)).get_messages()
+    assert [m.id for m in log] == [3, 2, 1]
+    assert cache.stats()["misses"] == 2
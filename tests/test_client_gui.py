@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+import pytest
+from message import Message, User
+
+client_gui = pytest.importorskip("client_gui")
+ScrollableMessageBox = client_gui.ScrollableMessageBox
+
+
+def message(message_id):
+    return Message(message_id, User("alice"), f"message {message_id}", float(message_id), "general")
+
+
+def message_box(ids, visible_rows=10):
+    # Only the scrolling state is used, so no window is needed.
+    requested = []
+    box = SimpleNamespace(
+        message_log=[message(message_id) for message_id in ids],
+        message_ids=set(ids),
+        max_messages=100,
+        top=0,
+        visible_rows=visible_rows,
+        has_older=True,
+        loading_older=False,
+        request_older=requested.append,
+        redraw=lambda: None,
+    )
+    box.scroll_to = lambda top: ScrollableMessageBox.scroll_to(box, top)
+    box.insert = lambda new: ScrollableMessageBox.insert(box, new)
+    return box, requested
+
+
+def test_log_shorter_than_the_view_asks_for_older_messages():
+    box, requested = message_box([5, 6, 7])
+    box.scroll_to(0)
+    assert requested == [5]
+
+
+def test_keeps_asking_until_the_view_is_filled():
+    box, requested = message_box([5, 6, 7], visible_rows=5)
+    box.scroll_to(0)
+    ScrollableMessageBox.add_older_messages(box, [message(4)], True)
+    assert requested == [5, 4]
+    ScrollableMessageBox.add_older_messages(box, [message(3), message(2)], False)
+    box.scroll_to(100)
+    assert requested == [5, 4]
+
+
+def test_long_log_waits_for_scrolling_back():
+    box, requested = message_box(range(1, 31))
+    box.scroll_to(0)
+    assert requested == []
+    box.scroll_to(20)
+    assert requested == [1]
@@ -0,0 +1,19 @@
+from metrics import Registry
+
+
+def test_factories_keep_their_own_gauges():
+    shared = Registry()
+    shared.counter("shared_total", "Shared.").inc()
+    first, second = Registry(shared), Registry(shared)
+    first.gauge("connections", "Connections.", lambda: 1)
+    second.gauge("connections", "Connections.", lambda: 2)
+    assert "connections 1" in first.render()
+    assert "connections 2" in second.render()
+    assert first.render().count("# TYPE shared_total counter") == 1
+
+
+def test_counter_functions_render_as_counters():
+    registry = Registry()
+    count = [3]
+    registry.counter_function("flushes_total", "Flushes.", lambda: count[0])
+    assert "# TYPE flushes_total counter\nflushes_total 3\n" in registry.render()
@@ -0,0 +1,28 @@
+import json
+import zlib
+import pytest
+from errors import ProtocolError
+from packet import BinaryCodec, JsonPacket, log_message
+
+
+def json_log_message(timestamp):
+    return zlib.compress(f'{{"type": "LOG_MESSAGE", "content": "hi", "timestamp": {timestamp}}}'.encode())
+
+
+@pytest.mark.parametrize("timestamp", ["NaN", "Infinity", "-Infinity", "1e400", str(2 ** 64)])
+def test_log_message_with_a_timestamp_that_cant_be_stored_is_refused(timestamp):
+    with pytest.raises(ProtocolError):
+        JsonPacket.decode(json_log_message(timestamp))
+
+
+@pytest.mark.parametrize("timestamp", [float("nan"), float("inf")])
+def test_binary_log_message_with_a_timestamp_that_cant_be_stored_is_refused(timestamp):
+    packet = log_message("hi")
+    packet.timestamp = timestamp
+    codec = BinaryCodec()
+    with pytest.raises(ProtocolError):
+        codec.decode(codec.encode(packet))
+
+
+def test_log_message_with_a_real_timestamp():
+    assert JsonPacket.decode(json_log_message(json.dumps(1700000000.25))).timestamp == 1700000000.25
@@ -0,0 +1,103 @@
+import time
+import zlib
+import pytest
+from errors import ProtocolError
+from packet import (
+    PacketBuffer, BinaryCodec, JsonPacket, FRAME_HEADER, MAX_PACKET_SIZE, frame, login_message,
+    create_codec, CODEC_BINARY, FEATURE_ZLIB_STREAM, decompress
+)
+
+
+def bomb(size):
+    return zlib.compress(b"\0" * size, 9)
+
+
+def test_framed_packets_split_across_reads():
+    packets = [b"first", b"", b"third packet"]
+    data = b"".join(frame(packet) for packet in packets)
+    buffer = PacketBuffer(framed=True)
+    received = []
+    for i in range(len(data)):
+        received += list(buffer.feed(data[i:i + 1]))
+    assert received == packets
+    assert not buffer.buffer
+
+
+def test_framed_packet_over_the_limit():
+    buffer = PacketBuffer(framed=True)
+    with pytest.raises(ProtocolError):
+        list(buffer.feed(FRAME_HEADER.pack(MAX_PACKET_SIZE + 1)))
+
+
+def test_unframed_packets_split_where_each_stream_ends():
+    packets = [login_message("alice", "pw").encode(), login_message("bob", "pw").encode()]
+    data = b"".join(packets)
+    buffer = PacketBuffer()
+    received = []
+    for i in range(0, len(data), 7):
+        received += list(buffer.feed(data[i:i + 7]))
+    assert received == packets
+    assert JsonPacket.decode(received[1]).user == "bob"
+
+
+def test_unframed_packet_then_framing():
+    buffer = PacketBuffer()
+    first = login_message("alice", "pw").encode()
+    received = []
+    for packet in buffer.feed(first + frame(b"framed")):
+        received.append(packet)
+        buffer.framed = True
+    assert received == [first, b"framed"]
+
+
+def test_unframed_bomb_is_refused_without_decompressing_it_all():
+    buffer = PacketBuffer(max_unframed_size=64 * 1024)
+    data = bomb(64 * 1024 * 1024)
+    start = time.process_time()
+    with pytest.raises(ProtocolError):
+        for i in range(0, len(data), 64 * 1024):
+            list(buffer.feed(data[i:i + 64 * 1024]))
+    assert time.process_time() - start < 1
+
+
+def test_unframed_packet_is_only_decompressed_once():
+    # Fed a byte at a time, a quadratic rescan of the buffer would take far longer than this.
+    data = zlib.compress(bytes(range(256)) * 1000)
+    buffer = PacketBuffer()
+    start = time.process_time()
+    received = []
+    for i in range(len(data)):
+        received += list(buffer.feed(data[i:i + 1]))
+    assert received == [data]
+    assert time.process_time() - start < 1
+
+
+def test_unframed_garbage():
+    with pytest.raises(zlib.error):
+        list(PacketBuffer().feed(b"not zlib at all"))
+
+
+def test_decompress_limit():
+    assert decompress(zlib.compress(b"x" * 100), 100) == b"x" * 100
+    with pytest.raises(ProtocolError):
+        decompress(zlib.compress(b"x" * 101), 100)
+    with pytest.raises(ProtocolError):
+        decompress(zlib.compress(b"x" * 100)[:-3])
+
+
+def test_json_decode_bomb():
+    with pytest.raises(ProtocolError):
+        JsonPacket.decode(bomb(MAX_PACKET_SIZE + 1))
+
+
+def test_binary_decode_bomb():
+    with pytest.raises(ProtocolError):
+        BinaryCodec().decode(b"\x03\x01" + bomb(MAX_PACKET_SIZE + 1))
+
+
+def test_stream_decode_bomb():
+    receiver = create_codec(CODEC_BINARY, (FEATURE_ZLIB_STREAM,))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 12, 5)
+    body = compressor.compress(b"\0" * (MAX_PACKET_SIZE + 1)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    with pytest.raises(ProtocolError):
+        receiver.decode(b"\x03\x02" + body[:-4])
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+import pytest
+from twisted.internet.task import Clock
+from errors import RateLimitError
+from packet import PacketType
+from ratelimit import TokenBucket, RateLimiter, parse_limits
+
+
+def test_burst_then_rate():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(0) == pytest.approx(0.5)
+    assert bucket.take(0.5) == 0
+    assert bucket.take(0.5) == pytest.approx(0.5)
+
+
+def test_refill_stops_at_burst():
+    bucket = TokenBucket(rate=1, burst=2, now=0)
+    bucket.take(0)
+    assert bucket.full(1000)
+    assert bucket.tokens == 2
+
+
+def test_fractional_tokens_say_how_long_to_wait():
+    bucket = TokenBucket(rate=4, burst=1, now=0)
+    bucket.take(0)
+    assert bucket.take(0.125) == pytest.approx(0.125)
+
+
+@pytest.mark.parametrize("limit", [{"rate": 0, "burst": 5}, {"rate": -1}, {"rate": 1, "burst": 0.5}])
+def test_limits_that_never_allow_a_request_are_refused(limit):
+    with pytest.raises(ValueError):
+        parse_limits({"LOG_MESSAGE": limit})
+
+
+def test_unknown_packet_type_is_refused():
+    with pytest.raises(ValueError):
+        parse_limits({"TELEPORT": {"rate": 1}})
+
+
+def test_connection_and_ip_limits():
+    clock = Clock()
+    limiter = RateLimiter({"LOG_MESSAGE": {"rate": 1, "burst": 2}}, {"LOG_MESSAGE": {"rate": 1, "burst": 3}}, clock)
+    peer = SimpleNamespace(host="10.0.0.1")
+
+    def connection():
+        return SimpleNamespace(rate_buckets={}, transport=SimpleNamespace(getPeer=lambda: peer))
+
+    first, second = connection(), connection()
+    limiter.check(first, PacketType.LOG_MESSAGE)
+    limiter.check(first, PacketType.LOG_MESSAGE)
+    with pytest.raises(RateLimitError):
+        limiter.check(first, PacketType.LOG_MESSAGE)
+    limiter.check(second, PacketType.LOG_MESSAGE)  # The third request of the IP address.
+    with pytest.raises(RateLimitError) as error:
+        limiter.check(second, PacketType.LOG_MESSAGE)
+    assert error.value.retry_after == pytest.approx(1)
+    limiter.check(first, PacketType.LOGIN_REQUEST)  # Not limited.
+    assert limiter.throttled == 2
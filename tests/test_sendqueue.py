@@ -0,0 +1,58 @@
+from sendqueue import SendQueue
+
+
+class FakeTransport:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+def make_queue():
+    events = []
+    transport = FakeTransport()
+    queue = SendQueue(transport, 10, 4, lambda: events.append("overflow"), lambda: events.append("drained"))
+    return queue, transport, events
+
+
+def test_writes_straight_through_when_not_paused():
+    queue, transport, events = make_queue()
+    queue.write(b"hello")
+    assert transport.written == [b"hello"]
+    assert queue.pending_bytes == 0
+
+
+def test_overflow_and_drain():
+    queue, transport, events = make_queue()
+    queue.pauseProducing()
+    queue.write(b"123456")
+    queue.write(b"123456", droppable=True)
+    assert events == ["overflow"]
+    assert queue.pending_bytes == 12
+
+    queue.resumeProducing()
+    assert transport.written == [b"123456", b"123456"]
+    assert queue.pending_bytes == 0
+    assert events == ["overflow", "drained"]
+
+
+def test_drop_only_droppable_chunks():
+    queue, transport, events = make_queue()
+    queue.pauseProducing()
+    queue.write(b"keep")
+    queue.write(b"drop me", droppable=True)
+    assert queue.drop() == 1
+    assert queue.pending_bytes == 4
+    assert (queue.dropped_chunks, queue.dropped_bytes) == (1, 7)
+
+    queue.resumeProducing()
+    assert transport.written == [b"keep"]
+
+
+def test_discard_counts_without_queueing():
+    queue, transport, events = make_queue()
+    queue.discard(20)
+    assert (queue.dropped_chunks, queue.dropped_bytes) == (1, 20)
+    assert queue.pending_bytes == 0
+    assert transport.written == []
@@ -0,0 +1,86 @@
+import os
+import pytest
+import toml
+from twisted.internet.testing import StringTransport
+from constants import CONFIG_FILE
+from packet import FEATURE_FRAMING, FEATURE_RESYNC, CODEC_JSON, frame, server_info_request, message_log_since_request
+from server import MessagingFactory, MAX_OUTBOX_BYTES
+
+
+class SlowTransport(StringTransport):
+    """
+    A transport whose client reads nothing until drain is called.
+    Like a TCP transport, it pauses its producer once more than buffer_size bytes are waiting in it.
+    """
+    buffer_size = 4 * 1024
+
+    def write(self, data):
+        super().write(data)
+        if len(self.value()) > self.buffer_size and self.producer is not None:
+            self.producer.pauseProducing()
+
+    def drain(self):
+        self.clear()
+        self.producer.resumeProducing()
+
+
+@pytest.fixture
+def factory(tmp_path):
+    config = toml.load(CONFIG_FILE)
+    config['structure']['data_folder'] = str(tmp_path)
+    config['rate_limits'] = {}
+    path = os.path.join(tmp_path, "config.toml")
+    with open(path, "w") as config_file:
+        toml.dump(config, config_file)
+    factory = MessagingFactory(path)
+    # Small enough for a few thousand short replies to go over.
+    factory.session.send_queue_high_bytes = 16 * 1024
+    factory.session.send_queue_low_bytes = 4 * 1024
+    yield factory
+    factory.prune_loop.stop()
+    factory.lag_monitor.stop()
+
+
+def connect(factory, features):
+    client = factory.buildProtocol(None)
+    transport = SlowTransport()
+    client.makeConnection(transport)
+    client.dataReceived(server_info_request(features, (CODEC_JSON,)).encode())
+    transport.clear()
+    return client, transport
+
+
+def pipelined_requests(count):
+    # Not logged in, so every one of them is answered with an error.
+    return frame(message_log_since_request(0).encode()) * count
+
+
+def test_pipelined_requests_stop_at_the_watermark(factory):
+    client, transport = connect(factory, (FEATURE_FRAMING, FEATURE_RESYNC))
+    high_watermark = factory.session.send_queue_high_bytes
+    client.dataReceived(pipelined_requests(5000))
+
+    assert client.read_pauses == {"send_queue"}
+    assert client.send_queue.pending_bytes <= high_watermark + MAX_OUTBOX_BYTES
+    assert client.packet_buffer.buffer
+
+    # Every request still gets its reply, once the client catches up.
+    replies = 0
+    while client.read_pauses:
+        replies += len(transport.value())
+        transport.drain()
+        assert client.send_queue.pending_bytes <= high_watermark + MAX_OUTBOX_BYTES
+    assert not client.packet_buffer.buffer
+    assert transport.producerState == "producing"
+
+
+def test_pipelined_requests_stop_once_aborted(factory):
+    # Without resync, a client that falls behind is disconnected instead.
+    client, transport = connect(factory, (FEATURE_FRAMING,))
+    client.dataReceived(pipelined_requests(5000))
+
+    assert client.aborted
+    assert client.packet_buffer.buffer
+    written = len(transport.value()) + client.send_queue.pending_bytes
+    client.dataReceived(pipelined_requests(10))
+    assert len(transport.value()) + client.send_queue.pending_bytes == written
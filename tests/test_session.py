@@ -0,0 +1,182 @@
+import os
+import sqlite3
+from types import SimpleNamespace
+import pytest
+import toml
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from constants import CONFIG_FILE
+from errors import SessionError
+from message import Message, User
+from session import Room, ServerSession
+
+
+def message(message_id):
+    return Message(message_id, User("alice"), f"message {message_id}", float(message_id), "general")
+
+
+def room_with(*ids, max_shown_messages=3):
+    room = Room("general", max_shown_messages)
+    for message_id in ids:
+        room.add_recent_message(message(message_id))
+    return room
+
+
+def messages_since(room, last_id):
+    # Only the room and the ring size are used, so a whole session with its database isn't needed.
+    session = SimpleNamespace(get_room=lambda name=None: room, max_shown_messages=room.recent_messages.maxlen)
+    messages = ServerSession.get_messages_since(session, last_id)
+    return None if messages is None else [m.id for m in messages]
+
+
+def test_add_recent_message_keeps_order_and_size():
+    room = room_with(1, 4, 2, 3)
+    assert [m.id for m in room.recent_messages] == [2, 3, 4]
+    room.add_recent_message(message(1))  # Older than everything kept.
+    assert [m.id for m in room.recent_messages] == [2, 3, 4]
+
+
+@pytest.mark.parametrize("last_id, expected", [
+    (10, []),
+    (9, [10]),
+    (7, [10, 9, 8]),  # The oldest message kept comes right after last_id, nothing can be missing.
+    (6, None),  # Message 7 might exist, it isn't kept anymore.
+    (0, None),
+])
+def test_messages_since_with_a_full_ring(last_id, expected):
+    assert messages_since(room_with(8, 9, 10), last_id) == expected
+
+
+def test_messages_since_with_every_message_kept():
+    assert messages_since(room_with(3, 5), 0) == [5, 3]
+    assert messages_since(room_with(), 4) == []
+
+
+def test_wrong_password_does_not_tell_whether_the_account_is_online():
+    session = SimpleNamespace(
+        storage=SimpleNamespace(check_credentials=lambda user, password: defer.succeed(password == "right")),
+        is_logged_in=lambda name: name == "alice",
+        bus=None,
+    )
+    errors = []
+    ServerSession.login_user(session, "alice", "wrong", object()).addErrback(errors.append)
+    ServerSession.login_user(session, "alice", "right", object()).addErrback(errors.append)
+    assert [error.trap(SessionError) and error.getErrorMessage() for error in errors] == [
+        "Username or Password incorrect. Please try again.",
+        "Account 'alice' is already logged in.",
+    ]
+
+
+class FakeStorage:
+    """
+    Answers the queries rooms are loaded with straight from the database file, once fire is called.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.waiting = []
+
+    def get_messages_before(self, before_id, size, room):
+        d = defer.Deferred()
+        self.waiting.append((d, (room, before_id, size)))
+        return d
+
+    def fire(self):
+        connection = sqlite3.connect(self.path)
+        query = "SELECT * FROM messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?;"
+        waiting, self.waiting = self.waiting, []
+        for d, parameters in waiting:
+            d.callback(connection.execute(query, parameters).fetchall())
+        connection.close()
+
+
+@pytest.fixture
+def make_session(tmp_path):
+    config = toml.load(CONFIG_FILE)
+    config['structure']['data_folder'] = str(tmp_path)
+    config['session']['database']['max_shown_messages'] = 3
+    config['session']['rooms']['max_joined_rooms'] = 3
+    path = os.path.join(tmp_path, "config.toml")
+    with open(path, "w") as config_file:
+        toml.dump(config, config_file)
+
+    def make_session(*rows):
+        """
+        Makes a session over a database holding the given (id, room) messages.
+        """
+        ServerSession(path, clock=Clock()).storage.close()
+        database = os.path.join(tmp_path, config['structure']['db'])
+        with sqlite3.connect(database) as connection:
+            connection.executemany(
+                "INSERT INTO messages(id, message, timestamp, sender, room) VALUES (?, ?, 1.0, 'server', ?);",
+                [(message_id, f"message {message_id}", room) for message_id, room in rows],
+            )
+        session = ServerSession(path, clock=Clock())
+        session.storage.close()
+        session.storage = FakeStorage(database)
+        return session
+    return make_session
+
+
+def logged_in(session, name="alice"):
+    protocol = object()
+    session.logged_in_users[protocol] = User(name)
+    session.users_by_name[name] = protocol
+    return protocol
+
+
+def test_only_the_default_room_is_loaded_at_startup(make_session):
+    session = make_session((1, "general"), (2, "other"), (3, "other"))
+    assert list(session.rooms) == ["general"]
+
+    joined = []
+    session.join_room(logged_in(session), "other").addCallback(joined.append)
+    assert not joined
+    session.storage.fire()
+    assert [room.name for room in joined] == ["other"]
+    assert [m.id for m in session.rooms["other"].recent_messages] == [2, 3]
+
+
+def test_messages_from_other_workers_fill_in_a_room_being_loaded(make_session):
+    session = make_session((1, "other"))
+    assert not session.add_recent_message(Message(5, User("bob"), "hi", 2.0, "other"))
+    session.join_room(logged_in(session), "other")
+    session.storage.fire()
+    assert [m.id for m in session.rooms["other"].recent_messages] == [1, 5]
+
+
+def test_logging_out_while_a_room_loads(make_session):
+    session = make_session()
+    protocol = logged_in(session)
+    failures = []
+    session.join_room(protocol, "other").addErrback(failures.append)
+    session.logout_user(protocol)
+    session.storage.fire()
+    assert failures and failures[0].check(SessionError)
+    assert not session.rooms["other"].members
+
+
+def test_joined_rooms_are_limited(make_session):
+    session = make_session()
+    protocol = logged_in(session)
+    for name in ("general", "a", "b"):
+        session.join_room(protocol, name)
+    session.storage.fire()
+    with pytest.raises(SessionError):
+        session.join_room(protocol, "c")
+
+
+def test_idle_rooms_without_members_are_pruned(make_session):
+    session = make_session()
+    alice, bob = logged_in(session), logged_in(session, "bob")
+    for protocol in (alice, bob):
+        session.join_room(protocol, "quiet")
+    session.join_room(alice, "busy")
+    session.storage.fire()
+    session.leave_room(alice, "quiet")
+    session.leave_room(bob, "quiet")
+
+    session.clock.advance(session.room_idle_seconds - 1)
+    assert session.prune_rooms() == []
+    session.clock.advance(1)
+    assert session.prune_rooms() == ["quiet"]
+    assert sorted(session.rooms) == ["busy", "general"]
@@ -0,0 +1,48 @@
+import math
+import sqlite3
+from storage import Storage
+
+
+class CountingConnection:
+    """
+    Wraps a SQLite connection, counting its commits.
+    """
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute(
+            "CREATE TABLE messages(id integer PRIMARY KEY, message text NOT NULL, timestamp integer NOT NULL, "
+            "sender text NOT NULL, room text NOT NULL);"
+        )
+        self.commits = 0
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def commit(self):
+        self.commits += 1
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def ids(self):
+        return [row[0] for row in self.connection.execute("SELECT id FROM messages ORDER BY id;")]
+
+
+def rows(*timestamps):
+    return [(i, f"message {i}", timestamp, "alice", "general") for i, timestamp in enumerate(timestamps, 1)]
+
+
+def test_batch_commits_once():
+    connection = CountingConnection()
+    Storage._insert_messages(connection, rows(1.0, 2.0, 3.0))
+    assert connection.commits == 1
+    assert connection.ids() == [1, 2, 3]
+
+
+def test_bad_row_makes_the_batch_commit_row_by_row():
+    # What a NaN timestamp used to do, before LOG_MESSAGE packets with one were refused.
+    connection = CountingConnection()
+    Storage._insert_messages(connection, rows(1.0, math.nan, 3.0))
+    assert connection.commits == 2
+    assert connection.ids() == [1, 3]